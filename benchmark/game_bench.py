@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+"""
+Game benchmark.
+
+This program measures the performance of game classes and checks that they
+follow the contract of the framework (see AbstractGame), without a server and
+without networking. It plays thousands of random games and reports the time and
+memory per call of the functions called by the framework (move, state, view,
+current_player and game_over):
+
+    python3 game_bench.py                            # all games of games_list.py
+    python3 game_bench.py TicTacToe Yahtzee --games 50000
+    python3 game_bench.py games.mygame --moves mymoves:random_move
+
+Games are passed by class name (games of games_list.py), by module (all game
+classes defined in it) or as module:class. Modules are imported relative to the
+server directory or to the current directory.
+
+Random moves are created by a move generator, a function receiving the state
+returned to the current player, the player's ID and a random number generator:
+
+    def random_move(state, player_id, rng):
+        return {'position':rng.randrange(9)}
+
+Generators for the games of this repository are included. For other games, a
+generator is passed as module:function (--moves). Moves do not have to be legal,
+illegal moves are simply rejected by the game and another move is created.
+Without a generator, only the contract is checked.
+
+Checks of the contract include: the number of players, the types returned by
+current_player and game_over, state returning a dictionary that can be encoded
+as JSON and does not use keys added by the framework, state not changing the
+game, players sharing a view receiving the same state, moves being answered with None or an error message that can be encoded as
+JSON, and no function raising an exception, not even for nonsensical moves.
+
+The contract is checked in the first games only (--checked-games), the checks
+would dominate the run otherwise. Time is measured for every single call
+(perf_counter_ns). Memory is measured in a separate run with fewer games, since
+tracemalloc slows down every allocation: the peak of memory allocated during a
+call, and the memory still allocated after the call. The overhead of measuring
+is subtracted.
+"""
+
+import argparse
+import importlib
+import inspect
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'), os.getcwd()]
+
+import games_list
+from abstract_game import AbstractGame
+
+METHODS = ('move', 'state', 'view', 'current_player', 'game_over')
+FRAMEWORK_KEYS = ('current', 'gameover', 'version') # added to the state by the framework
+ATTEMPTS = 100 # moves created before a game counts as stuck
+JUNK_MOVES = ({}, {'': None}, {'position':'x', 'msg':[], 'name':0, 'roll_dice':{}})
+
+def tictactoe_move(state, player_id, rng):
+    free = [position for position, mark in enumerate(state['board']) if mark == -1]
+    return {'position':rng.choice(free or [0])}
+
+def yahtzee_move(state, player_id, rng):
+    if 'current_name' not in state: # players choose their names first
+        return {'name':f'player {player_id}'}
+
+    free = [category for category, points in state['scorecard'].items() if points is None]
+    choice = rng.random()
+    if choice < 0.3:
+        return {'roll_dice':rng.sample(range(5), rng.randint(1, 5))}
+    if choice < 0.8:
+        return {'score':'add points', 'category':rng.choice(free)}
+    return {'score':'cross out', 'category':rng.choice(free)}
+
+def echo_move(state, player_id, rng):
+    return {'msg':rng.choice(['hello', 'error', 'quit'] if rng.random() < 0.02 else ['hello', 'world'])}
+
+def chat_move(state, player_id, rng):
+    if rng.random() < 0.2:
+        return {'name':f'player {player_id}'}
+    return {'message':rng.choice(['hi', 'hello', 'good game', ' '])}
+
+GENERATORS = {'TicTacToe':tictactoe_move, 'Yahtzee':yahtzee_move, 'Echo':echo_move, 'Chat':chat_move}
+
+class Stats:
+    """
+    Class Stats.
+
+    This class collects the measurements and the contract violations of a
+    single game class.
+    """
+
+    def __init__(self):
+        self.calls = dict.fromkeys(METHODS, 0)
+        self.nanoseconds = dict.fromkeys(METHODS, 0)
+        self.peak = dict.fromkeys(METHODS, 0) # bytes allocated at most during calls
+        self.kept = dict.fromkeys(METHODS, 0) # bytes still allocated after calls
+        self.measured = dict.fromkeys(METHODS, 0) # calls measured for memory
+        self.games = self.accepted = self.rejected = self.truncated = 0
+        self.violations = {} # message -> number of occurrences
+
+    def violation(self, message):
+        """
+        Record a violation of the contract.
+
+        Parameters:
+        message (str): description
+        """
+        self.violations[message] = self.violations.get(message, 0) + 1
+
+class Runner:
+    """
+    Class Runner.
+
+    This class calls the functions of a game class the way the framework does,
+    measures every call and checks the results.
+    """
+
+    def __init__(self, game_class, generator, stats, checked_games, memory=False):
+        """
+        Parameters:
+        game_class (class): game class
+        generator (function): move generator, None to check the contract only
+        stats (Stats): measurements of the game class
+        checked_games (int): number of games checked, the remaining games are only measured
+        memory (bool): measure memory instead of time (requires tracemalloc to be running)
+        """
+        self._game_class = game_class
+        self._generator = generator
+        self._stats = stats
+        self._checked_games = checked_games
+        self._memory = memory
+        self._overhead = self._calibrate()
+
+    def _calibrate(self):
+        """
+        Measure a function doing nothing, so that the overhead of measuring
+        can be subtracted from all measurements.
+
+        Returns:
+        int: nanoseconds or bytes per call
+        """
+        if self._memory:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            int()
+            return tracemalloc.get_traced_memory()[1] - before
+
+        samples = []
+        for _ in range(1000):
+            start = time.perf_counter_ns()
+            int()
+            samples.append(time.perf_counter_ns() - start)
+        return min(samples)
+
+    def call(self, game, method, *args):
+        """
+        Call a function of a game and measure the call. Exceptions are recorded
+        as violations of the contract.
+
+        Parameters:
+        game (AbstractGame): game
+        method (str): name of the function
+        args: arguments
+
+        Returns:
+        tuple(bool, object):
+            bool: True, if the function returned without an exception
+            object: return value
+        """
+        function = getattr(game, method)
+
+        try:
+            if self._memory:
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                result = function(*args)
+                current, peak = tracemalloc.get_traced_memory()
+                self._stats.peak[method] += max(peak - before - self._overhead, 0)
+                self._stats.kept[method] += max(current - before - self._overhead, 0)
+                self._stats.measured[method] += 1
+            else:
+                start = time.perf_counter_ns()
+                result = function(*args)
+                self._stats.nanoseconds[method] += max(time.perf_counter_ns() - start - self._overhead, 0)
+                self._stats.calls[method] += 1
+        except Exception as err:
+            self._stats.violation(f'{method} raised {type(err).__name__}: {err}')
+            return False, None
+
+        return True, result
+
+    def play(self, players, max_moves, rng):
+        """
+        Play a single game with random moves.
+
+        Parameters:
+        players (int): number of players
+        max_moves (int): the game is truncated after this number of moves
+        rng (Random): random number generator
+        """
+        stats = self._stats
+
+        try:
+            game = self._game_class(players)
+        except Exception as err:
+            stats.violation(f'constructor raised {type(err).__name__}: {err}')
+            return
+
+        stats.games += 1
+        check = stats.games <= self._checked_games
+        if not self._round(game, players, check):
+            return
+
+        for _ in range(max_moves):
+            ok, over = self.call(game, 'game_over')
+            if not ok or over:
+                return
+
+            ok, current = self.call(game, 'current_player')
+            if not ok: return
+            if not current:
+                stats.violation('current_player returned no player while the game is not over')
+                return
+
+            player_id = rng.choice(current)
+            ok, state = self.call(game, 'state', player_id)
+            if not ok or not self._generator: return
+
+            for _ in range(ATTEMPTS):
+                ok, error = self.call(game, 'move', self._generator(state, player_id, rng), player_id)
+                if not ok: return
+                if check: self._check_error(error)
+                if error is None: break
+                stats.rejected += 1
+            else:
+                stats.violation('no legal move found')
+                return
+
+            stats.accepted += 1
+            if not self._round(game, players, check):
+                return
+
+        stats.truncated += 1
+
+    def _round(self, game, players, check):
+        """
+        Retrieve everything the framework retrieves after a move: the state and
+        the view of every player, the current players and the game status. In
+        checked games, the results are checked, and in the first game, moves
+        the framework would pass on to the game but no game can accept are
+        submitted as well. They must not raise exceptions.
+
+        Parameters:
+        game (AbstractGame): game
+        players (int): number of players
+        check (bool): check the results
+
+        Returns:
+        bool: True, if the game can be continued
+        """
+        views = {} # view key -> state
+        for player_id in range(players):
+            ok, state = self.call(game, 'state', player_id)
+            if not ok: return False
+            ok, view = self.call(game, 'view', player_id)
+            if not ok: return False
+            if check:
+                self._check_state(game, state, player_id)
+                self._check_view(views, view, state)
+
+        ok, current = self.call(game, 'current_player')
+        if not ok: return False
+        if check and (not isinstance(current, list) or not all(isinstance(p, int) and 0 <= p < players for p in current)):
+            self._stats.violation(f'current_player must return a list of player IDs, returned {current!r}')
+            return False
+
+        ok, over = self.call(game, 'game_over')
+        if not ok: return False
+        if check and not isinstance(over, bool):
+            self._stats.violation(f'game_over must return a bool, returned {type(over).__name__}')
+
+        if self._stats.games == 1 and not over and current:
+            for junk in JUNK_MOVES:
+                ok, error = self.call(game, 'move', dict(junk), current[0])
+                if not ok: return False
+                self._check_error(error)
+                self._stats.accepted += error is None
+                self._stats.rejected += error is not None
+
+        return True
+
+    def _check_view(self, views, view, state):
+        """
+        Check that players sharing a view receive the same state.
+
+        Parameters:
+        views (dict): view key -> state of the first player with that view
+        view: view key
+        state: state
+        """
+        try:
+            shared = views.setdefault(view, state)
+        except TypeError:
+            self._stats.violation(f'view must return a hashable key, returned {type(view).__name__}')
+            return
+
+        if json.dumps(shared, sort_keys=True, default=repr) != json.dumps(state, sort_keys=True, default=repr):
+            self._stats.violation('players sharing a view received different states')
+
+    def _check_state(self, game, state, player_id):
+        """
+        Check a state returned by the game.
+
+        Parameters:
+        game (AbstractGame): game
+        state: state
+        player_id (int): player ID
+        """
+        if not isinstance(state, dict):
+            self._stats.violation(f'state must return a dict, returned {type(state).__name__}')
+            return
+
+        for key in FRAMEWORK_KEYS:
+            if key in state:
+                self._stats.violation(f"state must not contain key '{key}', it is added by the framework")
+
+        try:
+            encoded = json.dumps(state)
+        except (TypeError, ValueError) as err:
+            self._stats.violation(f'state cannot be encoded as JSON: {err}')
+            return
+
+        ok, again = self.call(game, 'state', player_id)
+        if ok and json.dumps(again, default=repr) != encoded:
+            self._stats.violation('state changes the game (a second call returned a different state)')
+
+    def _check_error(self, error):
+        """
+        Check the value returned by a move.
+
+        Parameters:
+        error: None or error message
+        """
+        try:
+            json.dumps(error)
+        except (TypeError, ValueError):
+            self._stats.violation(f'move must return None or an error message that can be encoded as JSON, returned {error!r}')
+
+def load_games(names):
+    """
+    Import the game classes to be benchmarked.
+
+    Parameters:
+    names (list): class names, modules or module:class, all games of games_list.py if empty
+
+    Returns:
+    list: game classes
+    """
+    if not names:
+        return list(games_list.games)
+
+    classes = []
+    bundled = {game_class.__name__:game_class for game_class in games_list.games}
+
+    for name in names:
+        if name in bundled:
+            classes.append(bundled[name])
+        elif ':' in name:
+            module, class_name = name.split(':', 1)
+            classes.append(getattr(importlib.import_module(module), class_name))
+        else:
+            module = importlib.import_module(name)
+            classes += [member for _, member in inspect.getmembers(module, inspect.isclass)
+                        if issubclass(member, AbstractGame) and member is not AbstractGame
+                        and member.__module__ == module.__name__]
+
+    return classes
+
+def load_generator(name):
+    """
+    Import a move generator passed as module:function.
+
+    Parameters:
+    name (str): module:function
+
+    Returns:
+    function: move generator
+    """
+    module, function = name.split(':', 1)
+    return getattr(importlib.import_module(module), function)
+
+def player_count(game_class, requested, stats):
+    """
+    Return the number of players of the benchmarked games and check the limits
+    reported by the game class.
+
+    Parameters:
+    game_class (class): game class
+    requested (int): number of players passed on the command line, None for the default
+    stats (Stats): measurements of the game class
+
+    Returns:
+    int: number of players, None if the limits are invalid
+    """
+    try:
+        low, high = game_class.min_players(), game_class.max_players()
+    except Exception as err:
+        stats.violation(f'min_players or max_players raised {type(err).__name__}: {err}')
+        return None
+
+    if not (isinstance(low, int) and isinstance(high, int) and 1 <= low <= high):
+        stats.violation(f'min_players and max_players must be ints with 1 <= min <= max, returned {low!r} and {high!r}')
+        return None
+
+    return min(max(requested or 2, low), high)
+
+def benchmark(game_class, generator, options):
+    """
+    Benchmark a game class.
+
+    Parameters:
+    game_class (class): game class
+    generator (function): move generator, None to check the contract only
+    options (Namespace): command line options
+
+    Returns:
+    tuple(Stats, int): measurements and number of players, None if the game cannot be played
+    """
+    stats = Stats()
+    players = player_count(game_class, options.players, stats)
+    if players is None:
+        return stats, None
+
+    rng = random.Random(options.seed)
+    runner = Runner(game_class, generator, stats, options.checked_games)
+    for _ in range(options.games):
+        runner.play(players, options.max_moves, rng)
+
+    memory = Stats() # the games of this run are not counted
+    tracemalloc.start()
+    try:
+        runner = Runner(game_class, generator, memory, 0, memory=True)
+        for _ in range(options.memory_games):
+            runner.play(players, options.max_moves, rng)
+    finally:
+        tracemalloc.stop()
+
+    stats.peak, stats.kept, stats.measured = memory.peak, memory.kept, memory.measured
+    return stats, players
+
+def summary(game_class, generator, stats, players):
+    """
+    Summarize the measurements of a game class.
+
+    Parameters:
+    game_class (class): game class
+    generator (function): move generator, None if there is none
+    stats (Stats): measurements
+    players (int): number of players, None if the game could not be played
+
+    Returns:
+    dict: summary
+    """
+    methods = {}
+    for method in METHODS:
+        calls, measured = stats.calls[method], stats.measured[method]
+        methods[method] = {
+            'calls':calls,
+            'ns_per_call':stats.nanoseconds[method] / calls if calls else None,
+            'calls_per_second':calls / stats.nanoseconds[method] * 1e9 if stats.nanoseconds[method] else None,
+            'peak_bytes_per_call':stats.peak[method] / measured if measured else None,
+            'kept_bytes_per_call':stats.kept[method] / measured if measured else None}
+
+    return {
+        'game':game_class.__name__,
+        'players':players,
+        'generator':generator.__name__ if generator else None,
+        'games':stats.games,
+        'moves_accepted':stats.accepted,
+        'moves_rejected':stats.rejected,
+        'games_truncated':stats.truncated,
+        'methods':methods,
+        'violations':stats.violations}
+
+def print_summary(report):
+    """
+    Print the summary of a game class in a human readable format.
+
+    Parameters:
+    report (dict): summary
+    """
+    print(f"{report['game']}: {report['games']} games ({report['players']} players), "
+          f"{report['moves_accepted']} moves accepted, {report['moves_rejected']} rejected, "
+          f"{report['games_truncated']} games truncated")
+    if not report['generator']:
+        print('    no move generator, only the contract was checked (see --moves)')
+
+    print(f"    {'function':16}{'calls':>10}{'ns/call':>10}{'calls/s':>12}{'peak B':>10}{'kept B':>10}")
+    format_value = lambda value, width, digits=0: f'{value:>{width}.{digits}f}' if value is not None else f"{'-':>{width}}"
+    for method, entry in report['methods'].items():
+        print(f"    {method:16}{entry['calls']:>10}" + format_value(entry['ns_per_call'], 10) +
+              format_value(entry['calls_per_second'], 12) + format_value(entry['peak_bytes_per_call'], 10) +
+              format_value(entry['kept_bytes_per_call'], 10))
+
+    if report['violations']:
+        print('    contract violations:')
+        for message, count in sorted(report['violations'].items()):
+            print(f'    {count:>8}  {message}')
+    else:
+        print('    contract: ok')
+    print('')
+
+def parse_arguments():
+    """
+    Parse the command line.
+
+    Returns:
+    Namespace: options
+    """
+    parser = argparse.ArgumentParser(description='Benchmark and contract check for game classes.')
+    parser.add_argument('names', nargs='*', metavar='GAME', help='class name, module or module:class (default: all games of games_list.py)')
+    parser.add_argument('--moves', metavar='MODULE:FUNCTION', help='move generator for games without a bundled one')
+    parser.add_argument('--games', type=int, default=10000, metavar='N', help='games played per game class (default: 10000)')
+    parser.add_argument('--checked-games', type=int, default=100, metavar='N', help='games checked against the contract, the remaining games are only measured (default: 100)')
+    parser.add_argument('--memory-games', type=int, default=100, metavar='N', help='games played while measuring memory (default: 100)')
+    parser.add_argument('--max-moves', type=int, default=200, metavar='N', help='moves before a game is truncated (default: 200)')
+    parser.add_argument('--players', type=int, metavar='N', help='players per game (default: 2, within the limits of the game)')
+    parser.add_argument('--seed', type=int, metavar='N', help='seed of the random number generator')
+    parser.add_argument('--json', metavar='FILE', help="write the results as JSON to a file ('-' for standard output)")
+    return parser.parse_args()
+
+def main():
+    options = parse_arguments()
+    custom = load_generator(options.moves) if options.moves else None
+
+    reports = []
+    for game_class in load_games(options.names):
+        generator = custom or GENERATORS.get(game_class.__name__)
+        reports.append(summary(game_class, generator, *benchmark(game_class, generator, options)))
+
+    if options.json == '-':
+        json.dump(reports, sys.stdout, indent=2)
+        print('')
+    else:
+        for report in reports:
+            print_summary(report)
+        if options.json:
+            with open(options.json, 'w') as file:
+                json.dump(reports, file, indent=2)
+
+    sys.exit(1 if any(report['violations'] for report in reports) else 0)
+
+if __name__ == '__main__':
+    main()
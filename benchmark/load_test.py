@@ -0,0 +1,685 @@
+#!/usr/bin/env python3
+"""
+Load test.
+
+This program measures the capacity of the game server. It simulates any number
+of clients playing TicTacToe, Yahtzee and Chat sessions against a local server
+and reports the throughput, the latency per request type and the memory used by
+the server:
+
+    python3 load_test.py --tictactoe 500 --duration 30
+    python3 load_test.py --start-server --yahtzee 100 --observers 2 --json results.json
+
+Every session is played by simulated players, and optionally watched by
+observers. Once a game is over, the players start a new session, until the
+duration of the test has expired. Chat sessions end after a fixed number of
+messages. Players can wait a random time before every move (think time).
+
+The clients are coroutines of a single asyncio event loop sending raw requests,
+so that thousands of clients can be simulated without the overhead of the API.
+By default, every request opens a new connection (protocol version 1). With
+--persistent, every client sends its requests over a persistent connection
+instead (protocol version 2). If a single process cannot generate enough load,
+the sessions can be spread over several processes (--processes).
+
+Latencies are measured from sending a request to receiving the response. State
+and join requests include waiting for other clients, so their latencies depend
+on the think time. Moves and observe requests are answered right away, their
+latencies reflect the server alone.
+
+The server's memory (resident set size, including worker processes) is only
+reported on Linux, if the server was started by this program (--start-server)
+or if its process ID is passed (--server-pid).
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server', 'game_server.py')
+TERMINATOR = b'EOT\0' # protocol version 1, terminates a request
+HEADER = struct.Struct('!I') # protocol version 2, frame header containing the payload length
+REQUEST_TIMEOUT = 60 # seconds, requests taking longer count as errors
+PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+
+class RequestFailed(Exception): pass
+
+class Results:
+    """
+    Class Results.
+
+    This class collects the latencies and errors of all requests sent by the
+    clients of a process.
+    """
+
+    def __init__(self):
+        self.latencies = {} # request type -> list of seconds
+        self.errors = {} # request type and message -> number of errors
+        self.completed = 0 # requests completed before the end of the test
+
+    def record(self, request_type, latency, in_time):
+        """
+        Record a response.
+
+        Parameters:
+        request_type (str): request type
+        latency (float): seconds
+        in_time (bool): True, if the response was received before the end of the test
+        """
+        self.latencies.setdefault(request_type, []).append(latency)
+        self.completed += in_time
+
+    def error(self, request_type, message):
+        """
+        Record an error.
+
+        Parameters:
+        request_type (str): request type
+        message (str): error message
+        """
+        key = f'{request_type}: {message}'
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def merge(self, other):
+        """
+        Add the results of another process.
+
+        Parameters:
+        other (Results): results
+        """
+        for request_type, latencies in other.latencies.items():
+            self.latencies.setdefault(request_type, []).extend(latencies)
+        for key, count in other.errors.items():
+            self.errors[key] = self.errors.get(key, 0) + count
+        self.completed += other.completed
+
+class Client:
+    """
+    Class Client.
+
+    This class sends the requests of a single simulated client and records
+    their latencies.
+    """
+
+    def __init__(self, options, results, deadline):
+        """
+        Parameters:
+        options (Namespace): command line options
+        results (Results): results of this process
+        deadline (float): end of the test (monotonic clock)
+        """
+        self._options = options
+        self._results = results
+        self._deadline = deadline
+        self._streams = None # reader and writer of the persistent connection
+
+    async def request(self, request):
+        """
+        Send a request and return the data of the response.
+
+        Parameters:
+        request (dict): request
+
+        Returns:
+        data of the response
+
+        Raises:
+        RequestFailed: if the request failed or the server returned an error
+        """
+        payload = json.dumps(request).encode()
+        start = time.perf_counter()
+
+        try:
+            send = self._send_persistent if self._options.persistent else self._send
+            response = await asyncio.wait_for(send(payload), REQUEST_TIMEOUT)
+        except (OSError, EOFError, ValueError, asyncio.TimeoutError) as err:
+            self._results.error(request['type'], type(err).__name__)
+            raise RequestFailed
+        except asyncio.CancelledError:
+            self.close() # a response may still arrive
+            raise
+
+        self._results.record(request['type'], time.perf_counter() - start, time.monotonic() < self._deadline)
+
+        if response['status'] != 'ok':
+            self._results.error(request['type'], response['message'])
+            raise RequestFailed
+
+        return response['data']
+
+    async def _send(self, payload):
+        """
+        Send a request over a new connection (protocol version 1).
+
+        Parameters:
+        payload (bytes): JSON encoded request
+
+        Returns:
+        dict: response
+        """
+        reader, writer = await asyncio.open_connection(self._options.host, self._options.port)
+
+        try:
+            writer.write(payload + TERMINATOR)
+            return json.loads(await reader.read())
+        finally:
+            writer.close()
+
+    async def _send_persistent(self, payload):
+        """
+        Send a request over the persistent connection of this client (protocol
+        version 2), which is opened by the first request.
+
+        Parameters:
+        payload (bytes): JSON encoded request
+
+        Returns:
+        dict: response
+        """
+        try:
+            if not self._streams:
+                self._streams = await asyncio.open_connection(self._options.host, self._options.port)
+                handshake = json.dumps({'type':'protocol', 'version':2}).encode()
+                self._streams[1].write(handshake + TERMINATOR)
+                if (await self._receive())['status'] != 'ok':
+                    raise ValueError('handshake failed')
+
+            self._streams[1].write(HEADER.pack(len(payload)) + payload)
+            return await self._receive()
+        except:
+            self.close()
+            raise
+
+    async def _receive(self):
+        """
+        Receive a frame from the persistent connection.
+
+        Returns:
+        dict: response
+        """
+        reader = self._streams[0]
+        size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+        return json.loads(await reader.readexactly(size))
+
+    def close(self):
+        """
+        Close the persistent connection, if there is one.
+        """
+        if self._streams:
+            self._streams[1].close()
+            self._streams = None
+
+class Player:
+    """
+    Class Player.
+
+    This class holds a simulated client's membership in a game session and
+    provides the requests of the framework.
+    """
+
+    def __init__(self, client, game, token):
+        """
+        Parameters:
+        client (Client): client sending the requests
+        game (str): name of the game
+        token (str): game session
+        """
+        self._client = client
+        self._game = game
+        self._token = token
+        self._observer = False
+        self.player_id = None
+        self._key = None
+
+    async def join(self, players, name):
+        """
+        Start or join the game session.
+
+        Parameters:
+        players (int): number of players
+        name (str): player name
+        """
+        data = await self._client.request({
+            'type':'join', 'game':self._game, 'token':self._token, 'players':players, 'name':name})
+        self.player_id, self._key = data['player_id'], data['key']
+
+    async def observe(self, name):
+        """
+        Observe a player of the game session.
+
+        Parameters:
+        name (str): name of the player
+        """
+        data = await self._client.request({
+            'type':'observe', 'game':self._game, 'token':self._token, 'name':name})
+        self.player_id, self._key = data['player_id'], data['key']
+        self._observer = True
+
+    async def move(self, **move):
+        """
+        Submit a move.
+
+        Parameters:
+        move: the move's keyword arguments
+        """
+        await self._client.request({
+            'type':'move', 'game':self._game, 'token':self._token,
+            'player_id':self.player_id, 'key':self._key, 'move':move})
+
+    async def state(self):
+        """
+        Retrieve the game state, waiting for it to change if necessary.
+
+        Returns:
+        dict: game state
+        """
+        return await self._client.request({
+            'type':'state', 'game':self._game, 'token':self._token,
+            'player_id':self.player_id, 'key':self._key, 'observer':self._observer})
+
+async def think(options):
+    """
+    Wait before a move, for a random time with the mean passed on the command
+    line (exponential distribution).
+
+    Parameters:
+    options (Namespace): command line options
+    """
+    if options.think:
+        await asyncio.sleep(random.expovariate(1000 / options.think))
+
+async def play_tictactoe(player, name, options, joined):
+    """
+    Play a game of TicTacToe, choosing random positions.
+
+    Parameters:
+    player (Player): player
+    name (str): player name
+    options (Namespace): command line options
+    joined (Event): set once the players have joined
+    """
+    await player.join(2, name)
+    joined.set()
+
+    state = await player.state()
+    while not state['gameover']:
+        if player.player_id in state['current']:
+            await think(options)
+            free = [position for position, mark in enumerate(state['board']) if mark == -1]
+            await player.move(position=random.choice(free))
+        state = await player.state()
+
+async def play_yahtzee(player, name, options, joined):
+    """
+    Play a game of Yahtzee. Every turn, the dice are rolled once more, and the
+    points are added to the category Chance, or a category is crossed out once
+    Chance has been used.
+
+    Parameters:
+    player (Player): player
+    name (str): player name
+    options (Namespace): command line options
+    joined (Event): set once the players have joined
+    """
+    await player.join(options.yahtzee_players, name)
+    joined.set()
+    await player.move(name=name)
+
+    state = await player.state()
+    rolled = False
+    while not state['gameover']:
+        if player.player_id in state['current'] and 'current_name' in state:
+            await think(options)
+            free = [category for category, points in state['scorecard'].items() if points is None]
+            if not rolled:
+                await player.move(roll_dice=[0, 1, 2, 3, 4])
+            elif 'Chance' in free: # always valid
+                await player.move(score='add points', category='Chance')
+            else:
+                await player.move(score='cross out', category=free[0])
+            rolled = not rolled
+        state = await player.state()
+
+async def play_chat(player, name, options, joined):
+    """
+    Take part in a chat, sending a fixed number of messages.
+
+    Parameters:
+    player (Player): player
+    name (str): player name
+    options (Namespace): command line options
+    joined (Event): set once the players have joined
+    """
+    await player.join(options.chat_players, name)
+    joined.set()
+    await player.move(name=name)
+
+    for i in range(options.chat_messages):
+        await think(options)
+        await player.move(message=f'message {i}')
+        await player.state() # returned right away after a move
+
+async def watch(observer, joined):
+    """
+    Observe the first player of a session (p0) until the game is over.
+
+    Parameters:
+    observer (Player): observer
+    joined (Event): set once the players have joined
+    """
+    await joined.wait()
+    await observer.observe('p0')
+
+    state = await observer.state()
+    while not state['gameover']:
+        state = await observer.state()
+
+async def run_session(game, play, players, index, options, results, deadline):
+    """
+    Play one game session after the other until the test ends.
+
+    Parameters:
+    game (str): name of the game
+    play (function): coroutine function playing a game
+    players (int): number of players per session
+    index (int): index of the session, makes tokens unique
+    options (Namespace): command line options
+    results (Results): results of this process
+    deadline (float): end of the test (monotonic clock)
+    """
+    clients = [Client(options, results, deadline) for _ in range(players + options.observers)]
+    prefix = f'bench-{os.getpid()}-{index}'
+    games = 0
+
+    while time.monotonic() < deadline:
+        token = f'{prefix}-{games}'
+        joined = asyncio.Event()
+        playing = [asyncio.ensure_future(play(Player(client, game, token), f'p{i}', options, joined))
+                   for i, client in enumerate(clients[:players])]
+        watching = [asyncio.ensure_future(watch(Player(client, game, token), joined)) for client in clients[players:]]
+
+        try:
+            await asyncio.gather(*playing)
+        except RequestFailed: # start over with a new session
+            pass
+        finally:
+            for task in playing + watching:
+                task.cancel()
+            await asyncio.gather(*playing, *watching, return_exceptions=True)
+
+        games += 1
+
+    for client in clients:
+        client.close()
+
+async def run_sessions(sessions, options, deadline):
+    """
+    Run game sessions until the test ends.
+
+    Parameters:
+    sessions (list): (game, index) of each session
+    options (Namespace): command line options
+    deadline (float): end of the test (monotonic clock)
+
+    Returns:
+    Results: results
+    """
+    games = {
+        'TicTacToe':(play_tictactoe, 2),
+        'Yahtzee':(play_yahtzee, options.yahtzee_players),
+        'Chat':(play_chat, options.chat_players)}
+
+    results = Results()
+    tasks = [asyncio.ensure_future(run_session(game, *games[game], index, options, results, deadline))
+             for game, index in sessions]
+
+    # let running games finish, then stop:
+    _, pending = await asyncio.wait(tasks, timeout=deadline - time.monotonic() + REQUEST_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    return results
+
+def run_process(sessions, options, deadline):
+    """
+    Run game sessions in an event loop of their own (entry point of each
+    process).
+
+    Parameters:
+    sessions (list): (game, index) of each session
+    options (Namespace): command line options
+    deadline (float): end of the test (monotonic clock)
+
+    Returns:
+    Results: results
+    """
+    return asyncio.run(run_sessions(sessions, options, deadline))
+
+def server_rss(pid):
+    """
+    Return the memory used by the server, including its worker processes.
+
+    Parameters:
+    pid (int): process ID of the server
+
+    Returns:
+    int: resident set size in bytes, None if unavailable
+    """
+    try:
+        pids = [pid]
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as file:
+                pids += [int(child) for child in file.read().split()]
+
+        total = 0
+        for p in pids:
+            with open(f'/proc/{p}/status') as file:
+                for line in file:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        return total
+    except (OSError, ValueError):
+        return None
+
+class MemoryMonitor:
+    """
+    Class MemoryMonitor.
+
+    This class samples the memory used by the server in a background thread.
+    """
+
+    def __init__(self, pid, interval=0.5):
+        """
+        Parameters:
+        pid (int): process ID of the server, None to disable
+        interval (float): seconds between samples (optional)
+        """
+        self.peak = self.last = None
+        self._pid = pid
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        if pid: self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self._interval)
+
+    def _sample(self):
+        rss = server_rss(self._pid)
+        if rss is not None:
+            self.last = rss
+            self.peak = max(self.peak or 0, rss)
+
+    def stop(self):
+        """
+        Stop sampling after a final sample.
+        """
+        if self._pid:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+
+def start_server(options):
+    """
+    Start the server found in this repository, using its config module, and
+    wait until it accepts connections.
+
+    Parameters:
+    options (Namespace): command line options
+
+    Returns:
+    Popen: server process
+    """
+    server = subprocess.Popen([sys.executable, os.path.abspath(SERVER)], cwd=os.path.dirname(os.path.abspath(SERVER)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for _ in range(100):
+        try:
+            socket.create_connection((options.host, options.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+    server.terminate()
+    sys.exit(f'server not reachable on {options.host}:{options.port}')
+
+def summary(results, options, elapsed, memory):
+    """
+    Summarize the results.
+
+    Parameters:
+    results (Results): results of all processes
+    options (Namespace): command line options
+    elapsed (float): seconds the test took, including finishing the last games
+    memory (MemoryMonitor): memory used by the server
+
+    Returns:
+    dict: summary, latencies in milliseconds
+    """
+    latency = {}
+    for request_type, values in sorted(results.latencies.items()):
+        values.sort()
+        entry = {'count':len(values), 'mean':sum(values) / len(values) * 1000}
+        for name, fraction in PERCENTILES:
+            entry[name] = values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+        entry['max'] = values[-1] * 1000
+        latency[request_type] = entry
+
+    return {
+        'options':vars(options),
+        'duration':options.duration,
+        'elapsed':elapsed,
+        'requests':sum(entry['count'] for entry in latency.values()),
+        'throughput':results.completed / options.duration, # requests per second
+        'errors':results.errors,
+        'latency':latency,
+        'server_rss':{'peak':memory.peak, 'end':memory.last} if memory.peak else None}
+
+def print_summary(report):
+    """
+    Print the summary in a human readable format.
+
+    Parameters:
+    report (dict): summary
+    """
+    print(f"{report['requests']} requests in {report['elapsed']:.1f} s, "
+          f"{report['throughput']:.0f} requests/s, {sum(report['errors'].values())} errors\n")
+
+    print(f"{'type':10}{'count':>10}{'mean':>10}{'p50':>10}{'p99':>10}{'p999':>10}{'max':>10}  (ms)")
+    for request_type, entry in report['latency'].items():
+        print(f"{request_type:10}{entry['count']:>10}" +
+              ''.join(f'{entry[name]:>10.2f}' for name in ('mean', 'p50', 'p99', 'p999', 'max')))
+
+    if report['errors']:
+        print('\nerrors:')
+        for message, count in sorted(report['errors'].items()):
+            print(f'{count:>10}  {message}')
+
+    if report['server_rss']:
+        rss = report['server_rss']
+        print(f"\nserver memory: {rss['peak'] / 1e6:.1f} MB peak, {rss['end'] / 1e6:.1f} MB at the end")
+
+def parse_arguments():
+    """
+    Parse the command line.
+
+    Returns:
+    Namespace: options
+    """
+    parser = argparse.ArgumentParser(description='Load test for the game server.')
+    parser.add_argument('--host', default='127.0.0.1', help='server IP (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=4711, help='server port (default: 4711)')
+    parser.add_argument('--tictactoe', type=int, default=0, metavar='N', help='concurrent TicTacToe sessions (2 players each)')
+    parser.add_argument('--yahtzee', type=int, default=0, metavar='N', help='concurrent Yahtzee sessions')
+    parser.add_argument('--yahtzee-players', type=int, default=2, metavar='N', help='players per Yahtzee session (default: 2)')
+    parser.add_argument('--chat', type=int, default=0, metavar='N', help='concurrent Chat sessions')
+    parser.add_argument('--chat-players', type=int, default=4, metavar='N', help='players per Chat session (default: 4)')
+    parser.add_argument('--chat-messages', type=int, default=20, metavar='N', help='messages per player and Chat session (default: 20)')
+    parser.add_argument('--observers', type=int, default=0, metavar='N', help='observers per session (default: 0)')
+    parser.add_argument('--think', type=float, default=0, metavar='MS', help='mean think time before a move in milliseconds (default: 0)')
+    parser.add_argument('--duration', type=float, default=10, metavar='S', help='seconds to start new games (default: 10)')
+    parser.add_argument('--persistent', action='store_true', help='one persistent connection per client (protocol version 2)')
+    parser.add_argument('--processes', type=int, default=1, metavar='N', help='processes generating the load (default: 1)')
+    parser.add_argument('--start-server', action='store_true', help='start server/game_server.py of this repository and stop it afterwards')
+    parser.add_argument('--server-pid', type=int, metavar='PID', help='process ID of a running server, for measuring its memory')
+    parser.add_argument('--json', metavar='FILE', help="write the results as JSON to a file ('-' for standard output)")
+
+    options = parser.parse_args()
+    if not options.tictactoe + options.yahtzee + options.chat:
+        parser.error('no sessions, pass --tictactoe, --yahtzee or --chat')
+    return options
+
+def main():
+    options = parse_arguments()
+    server = start_server(options) if options.start_server else None
+    memory = MemoryMonitor(server.pid if server else options.server_pid)
+
+    sessions = [] # (game, index)
+    for game, count in (('TicTacToe', options.tictactoe), ('Yahtzee', options.yahtzee), ('Chat', options.chat)):
+        sessions += [(game, len(sessions) + i) for i in range(count)]
+    shares = [sessions[i::options.processes] for i in range(options.processes)]
+
+    try:
+        start = time.monotonic()
+        deadline = start + options.duration
+
+        if options.processes == 1:
+            results = run_process(sessions, options, deadline)
+        else:
+            with multiprocessing.Pool(options.processes) as pool:
+                results = Results()
+                for share in pool.starmap(run_process, [(share, options, deadline) for share in shares]):
+                    results.merge(share)
+
+        elapsed = time.monotonic() - start
+    finally:
+        memory.stop()
+        if server:
+            server.terminate()
+            server.wait()
+
+    report = summary(results, options, elapsed, memory)
+
+    if options.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print('')
+    else:
+        print_summary(report)
+        if options.json:
+            with open(options.json, 'w') as file:
+                json.dump(report, file, indent=2)
+
+if __name__ == '__main__':
+    main()
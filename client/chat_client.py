@@ -13,38 +13,38 @@ from game_server_api import GameServerAPI, GameServerError, IllegalMove
 game = GameServerAPI(server='127.0.0.1', port=4711, game='Chat', token='mychat', players=2)
 
 def thread_output(text_area):
-    while True:
-        try:
-            state = game.state()
-        except Exception as e:
-            print(e)
-            window.destroy()
-
-        messages = state['messages']
-        message_list = []
-        prev_name = ''
-
-        for name, message in messages:
-            if name != prev_name:
-                message_list.append(('', 'text'))
-                message_list.append((name, 'name'))
-
-            message_list.append((message, 'text'))
-            prev_name = name
-
-        text_area.config(state=tk.NORMAL)
-        text_area.delete(1.0, tk.END)
-
-        if not messages:
-            text_area.insert(1.0,
-                '\nNo messages yet.\n\nType a message below,\nhit Enter to send it.')
-
-        for line in message_list:
-            text, attribute = line
-            text_area.insert(tk.END, text + '\n', attribute)
-
-        text_area.config(state=tk.DISABLED)
-        text_area.see(tk.END)
+    try:
+        for state in game.subscribe():
+            show_messages(text_area, state['messages'])
+    except Exception as e:
+        print(e)
+        window.destroy()
+
+def show_messages(text_area, messages):
+    message_list = []
+    prev_name = ''
+
+    for name, message in messages:
+        if name != prev_name:
+            message_list.append(('', 'text'))
+            message_list.append((name, 'name'))
+
+        message_list.append((message, 'text'))
+        prev_name = name
+
+    text_area.config(state=tk.NORMAL)
+    text_area.delete(1.0, tk.END)
+
+    if not messages:
+        text_area.insert(1.0,
+            '\nNo messages yet.\n\nType a message below,\nhit Enter to send it.')
+
+    for line in message_list:
+        text, attribute = line
+        text_area.insert(tk.END, text + '\n', attribute)
+
+    text_area.config(state=tk.DISABLED)
+    text_area.see(tk.END)
 
 def entry_handler(_):
     message = entry.get()
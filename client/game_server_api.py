@@ -11,9 +11,13 @@ be used to
 - restart a game without starting a new session
 """
 
+import copy
 import json
 import socket
+import struct
+import threading
 import traceback
+import zlib
 
 class GameServerError(Exception):
     pass
@@ -28,7 +32,7 @@ class GameServerAPI:
     This class provides API functions to communicate with the game server.
     """
 
-    def __init__(self, server, port, game, token, players=None, name=''):
+    def __init__(self, server, port, game, token, players=None, name='', keep_alive=False, compression=False, delta=False):
         """
         Parameters needed in order to connect to the server and to start or join
         a game session are passed to this constructor. Parameter game specifies
@@ -48,13 +52,44 @@ class GameServerAPI:
         function. They will receive the same data calling the state function as
         you do.
 
+        Clients running on the same host as the server can connect via a Unix
+        domain socket, if the server provides one (see server's config module).
+        To do so, pass its path prefixed by 'unix://' as the server argument,
+        for example 'unix:///tmp/game_server.sock'. The port is ignored then.
+        This avoids the overhead of the TCP stack, which is useful for training
+        an AI.
+
+        The optional parameter keep_alive lets the API send all requests over a
+        single persistent connection instead of opening a new connection for
+        every request. This saves a lot of overhead when many requests are sent,
+        for example when training an AI. The connection is shared by all API
+        objects using the same server, and requests are answered independently
+        of each other. For example, one thread can wait for the state of one
+        game session, while another thread submits moves to a different session
+        over the same connection. If the server does not support persistent
+        connections, the API falls back to separate connections.
+
+        The optional parameter compression asks the server to compress large
+        responses, like the message history of a chat. This saves bandwidth on
+        slow networks at the cost of some CPU time. Responses are decompressed
+        transparently. Compression is only available on persistent connections,
+        so it implies keep_alive.
+
+        The optional parameter delta lets the server send only what has changed
+        since the last state retrieved, for example the new messages of a chat
+        instead of its whole history. The API rebuilds the full state, so the
+        state function returns the same data as without this option.
+
         Parameters:
-        server (str): server
+        server (str): server, or path of a Unix domain socket prefixed by 'unix://'
         port (int): port number
         game (str): name of the game
         token (str): name of the game session
         players (int): total number of players (optional)
         name (str): player name (optional)
+        keep_alive (bool): use a persistent connection (optional)
+        compression (bool): receive compressed responses (optional)
+        delta (bool): receive differences between states (optional)
 
         Raises:
         AssertionError: for invalid arguments
@@ -65,6 +100,9 @@ class GameServerAPI:
         assert type(token) == str and len(token) > 0, self._error('token')
         assert players == None or type(players) == int and players > 0, self._error('players')
         assert type(name) == str, self._error('name')
+        assert type(keep_alive) == bool, self._error('keep_alive')
+        assert type(compression) == bool, self._error('compression')
+        assert type(delta) == bool, self._error('delta')
 
         # server:
         self._server = server
@@ -79,9 +117,18 @@ class GameServerAPI:
         self._key = None
         self._observer = False
 
+        # state version of the last state received:
+        self._version = -1 # no state received yet
+
+        # delta mode:
+        self._delta = delta
+        self._base = None # (ID, state), last state received in delta mode
+
         # tcp connections:
+        self._compression = compression
         self._buffer_size = 4096 # bytes, corresponds to server-side buffer size value
         self._request_size_max = int(1e6) # bytes, updated after joining a game
+        self._connection = _Connection.get(server, port, self._buffer_size, keep_alive or compression, compression)
 
     def join(self):
         """
@@ -117,6 +164,8 @@ class GameServerAPI:
         self._player_id = response['player_id']
         self._key = response['key']
         self._request_size_max = response['request_size_max']
+        self._version = -1
+        self._base = None
 
         return self._player_id
 
@@ -160,7 +209,7 @@ class GameServerAPI:
             else:
                 raise GameServerError(err)
 
-    def state(self):
+    def state(self, timeout=None):
         """
         Retrieve the game state.
 
@@ -168,10 +217,11 @@ class GameServerAPI:
         returned as a dictionary. Refer to the documentation of a specific game
         to find out about the structure and content of the dictionary.
 
-        Independent of the game, the dictionary always contains these two keys:
+        Independent of the game, the dictionary always contains these keys:
 
         'current': a list of player IDs, indicating whose player's turn it is
         'gameover': a boolean value indicating whether the game is over or still active
+        'version': a number that increases with every change of the game state
 
         This function will block until the game state changes. Only then does
         the server respond with the updated state. This is more efficient than
@@ -182,26 +232,161 @@ class GameServerAPI:
         - after a move was performed to allow clients to get the new state
         - when the game was restarted and a client still has to get the old game's state
 
+        The API passes the version of the last state received to the server,
+        which responds as soon as there is a newer state. Repeating a request,
+        for example after a connection problem, is therefore safe. The optional
+        parameter timeout limits the time to wait for a newer state. If it
+        expires, the state is returned unchanged, which can be detected by
+        comparing its version.
+
+        Parameters:
+        timeout (float): seconds to wait at most (optional)
+
         Returns:
         dict: game state
 
         Raises:
+        AssertionError: for invalid arguments
         GameServerError: in case the state could not be retrieved
         """
+        assert timeout == None or type(timeout) in (int, float) and timeout >= 0, self._error('timeout')
+
         if self._player_id is None: raise GameServerError('join a game first')
 
-        state, err, _ = self._send({
-            'type':'state',
+        request = self._state_request('state')
+        if timeout is not None: request['timeout'] = timeout
+
+        state, err, _ = self._send(request)
+
+        if err: raise GameServerError(err)
+
+        return self._received_state(state)
+
+    def subscribe(self):
+        """
+        Subscribe to the game state.
+
+        This function returns an iterator over the game state. Instead of
+        sending a request for every state, the server pushes each new state over
+        a connection of its own, which stays open while iterating:
+
+        for state in game.subscribe():
+            ...
+
+        The first state is returned as soon as it is newer than the last state
+        retrieved, just like the state function would. The connection is closed
+        when the loop is left. If states change faster than they are read, the
+        server skips the states in between and sends the newest one. The version
+        of the state (see function state) reveals skipped states.
+
+        If the server does not support subscriptions, the iterator calls the
+        state function repeatedly instead.
+
+        Returns:
+        iterator: game states
+
+        Raises:
+        GameServerError: while iterating, in case the state could not be retrieved
+        """
+        if self._player_id is None: raise GameServerError('join a game first')
+
+        return self._subscription()
+
+    def _subscription(self):
+        """
+        Receive the states pushed by the server (generator). See function
+        subscribe for details.
+
+        Yields:
+        dict: game state
+        """
+        connection = _Connection(self._server, self._port, self._buffer_size, True, self._compression)
+        responses = connection.stream(self._state_request('subscribe'), self._request_size_max)
+
+        while True:
+            try:
+                response = next(responses)
+            except StopIteration: # server does not support persistent connections
+                break
+            except:
+                _, err, _ = self._api_error(self._failure())
+                raise GameServerError(err)
+
+            if response['status'] != 'ok': raise GameServerError(response['message'])
+
+            yield self._received_state(response['data'])
+
+        while True:
+            yield self.state()
+
+    def _state_request(self, request_type):
+        """
+        Prepare a state request or a subscription.
+
+        Parameters:
+        request_type (str): 'state' or 'subscribe'
+
+        Returns:
+        dict: request
+        """
+        request = {
+            'type':request_type,
             'game':self._game,
             'token':self._token,
             'player_id':self._player_id,
             'key':self._key,
-            'observer':self._observer})
+            'observer':self._observer}
 
-        if err: raise GameServerError(err)
+        # only wait for a state newer than the last one received:
+        request['since_version'] = self._version
+
+        if self._delta:
+            request['delta'] = True
+            if self._base: request['base'] = self._base[0]
+
+        return request
+
+    def _received_state(self, data):
+        """
+        Process a state received from the server.
+
+        Parameters:
+        data (dict): data received from the server
+
+        Returns:
+        dict: game state
+        """
+        if self._delta:
+            state = self._rebuild_state(data)
+        else:
+            state = data
+
+        self._version = state.get('version', -1) # missing if the server does not support versions
 
         return state
 
+    def _rebuild_state(self, data):
+        """
+        Rebuild the game state from a state received in delta mode. The server
+        either sends the full state or the difference to the state with the ID
+        passed as base. The state is stored as base for the next request. A copy
+        is returned, so that the caller can modify it.
+
+        Parameters:
+        data (dict): data received from the server
+
+        Returns:
+        dict: game state
+        """
+        if 'delta' in data:
+            state = _apply_delta(self._base[1], data['delta'])
+        else:
+            state = data['state']
+
+        self._base = (data['base'], state)
+
+        return copy.deepcopy(state)
+
     def observe(self):
         """
         Observe another player.
@@ -234,6 +419,8 @@ class GameServerAPI:
         self._player_id = response['player_id']
         self._key = response['key']
         self._observer = True
+        self._version = -1
+        self._base = None
 
         return self._player_id
 
@@ -275,55 +462,57 @@ class GameServerAPI:
             str: status (okay or error type)
         """
         # prepare data:
+        request_id = self._connection.new_id()
+        if request_id is not None:
+            data = dict(data, id=request_id)
+
         try:
-            request = json.dumps(data).encode() + b'EOT\0'
-        except:
-            return self._api_error('data could not be converted to JSON')
+            # send data to server and receive its response:
+            response = self._connection.exchange(data, request_id, self._request_size_max)
 
-        if len(request) > self._request_size_max:
-            return self._api_error('request size limit exceeded')
+            # return data:
+            if response['status'] != 'ok': # server responded with an error
+                return None, response['message'], response['status']
 
-        # create a socket:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sd:
-            try:
-                # connect to server:
-                sd.connect((self._server, self._port))
-            except:
-                return self._api_error(f'unable to connect to {self._server}:{self._port}')
+            return response['data'], None, None
 
-            try:
-                # send data to server:
-                sd.sendall(request)
-
-                # receive data from server:
-                response = bytearray()
-
-                while True:
-                    data = sd.recv(self._buffer_size)
-                    if not data: break
-                    response += data
-
-                if not response: raise self._NoResponse
-                response = json.loads(response.decode())
-
-                # return data:
-                if response['status'] != 'ok': # server responded with an error
-                    return None, response['message'], response['status']
-
-                return response['data'], None, None
-
-            except socket.timeout:
-                return self._api_error('connection timed out')
-            except self._NoResponse:
-                return self._api_error('empty or no response received from server')
-            except (ConnectionResetError, BrokenPipeError):
-                return self._api_error('connection closed by server')
-            except UnicodeDecodeError:
-                return self._api_error('could not decode binary data received from server')
-            except json.decoder.JSONDecodeError:
-                return self._api_error('corrupt json received from server')
-            except:
-                return self._api_error('unexpected exception:\n' + traceback.format_exc())
+        except:
+            return self._api_error(self._failure())
+
+    def _failure(self):
+        """
+        Return an error message describing the exception being handled, which
+        was raised while communicating with the server.
+
+        Returns:
+        str: error message
+        """
+        try:
+            raise
+        except self._EncodingFailed:
+            return 'data could not be converted to JSON'
+        except self._SizeExceeded:
+            return 'request size limit exceeded'
+        except self._ConnectionFailed:
+            if self._server.startswith(_UNIX_PREFIX):
+                return f'unable to connect to {self._server}'
+            return f'unable to connect to {self._server}:{self._port}'
+        except socket.timeout:
+            return 'connection timed out'
+        except self._NoResponse:
+            return 'empty or no response received from server'
+        except (ConnectionResetError, BrokenPipeError):
+            return 'connection closed by server'
+        except UnicodeDecodeError:
+            return 'could not decode binary data received from server'
+        except json.decoder.JSONDecodeError:
+            return 'corrupt json received from server'
+        except _DecodeError:
+            return 'corrupt data received from server'
+        except zlib.error:
+            return 'could not decompress data received from server'
+        except:
+            return 'unexpected exception:\n' + traceback.format_exc()
 
     @staticmethod
     def _api_error(message):
@@ -338,3 +527,786 @@ class GameServerAPI:
 
     class _NoResponse(Exception):
         pass
+
+    class _ConnectionFailed(Exception):
+        pass
+
+    class _EncodingFailed(Exception):
+        pass
+
+    class _SizeExceeded(Exception):
+        pass
+
+_UNIX_PREFIX = 'unix://' # server addresses starting with this prefix are Unix domain sockets
+_TERMINATOR = b'EOT\0' # protocol version 1, terminates a request
+_HEADER = struct.Struct('!I') # protocol version 2, frame header containing the payload length
+_COMPRESSED = 0x80000000 # protocol version 2, header flag for compressed payloads
+
+def _apply_delta(state, delta):
+    """
+    Apply the difference between two states to the older state. The format of
+    the difference is described in the server's delta module.
+
+    Parameters:
+    state (dict): older state, remains unchanged
+    delta (dict): difference
+
+    Returns:
+    dict: newer state
+    """
+    state = dict(state)
+
+    for key in delta.get('del', []):
+        del state[key]
+
+    state.update(delta.get('set', {}))
+
+    for key, items in delta.get('append', {}).items():
+        state[key] = state[key] + items
+
+    for key, nested in delta.get('dicts', {}).items():
+        state[key] = _apply_delta(state[key], nested)
+
+    return state
+
+class _DecodeError(Exception): pass
+
+class _JSONCodec:
+    """
+    Class _JSONCodec.
+
+    This codec encodes data as JSON. It is used for all requests, unless the
+    server supports a different codec (see class _Connection). The codecs are
+    identical to the ones in the server's codec module.
+    """
+
+    name = 'json'
+
+    def encode(self, data):
+        """
+        Encode data.
+
+        Parameters:
+        data: data compatible with JSON
+
+        Returns:
+        bytes: encoded data
+
+        Raises:
+        TypeError: if the data is not compatible with JSON
+        """
+        return json.dumps(data).encode()
+
+    def decode(self, payload):
+        """
+        Decode data without copying the payload first.
+
+        Parameters:
+        payload (bytes-like object): encoded data
+
+        Returns:
+        decoded data
+
+        Raises:
+        UnicodeDecodeError: if the data is not valid UTF-8
+        json.decoder.JSONDecodeError: if the data is not valid JSON
+        """
+        return json.loads(str(payload, 'utf-8'))
+
+class _BinaryCodec:
+    """
+    Class _BinaryCodec.
+
+    This codec encodes the same data types as JSON in a compact binary format.
+    Every value starts with a single byte (tag), followed by its content:
+
+    N, T, F: None, True, False
+    b, i, q: integer (8, 32 or 64 bit), L: larger integer (decimal string)
+    d: float (64 bit)
+    s: string with up to 255 bytes (8 bit length, UTF-8)
+    S: longer string (32 bit length, UTF-8)
+    a: list of 8 bit integers (32 bit length, packed in a single step)
+    l: list (32 bit length, values)
+    m: dictionary (32 bit length, pairs of string key and value)
+
+    All numbers are big-endian. Lists of small integers, like game boards, are
+    very common in game states, which is why they have a tag of their own. Like
+    JSON, tuples are encoded as lists, and dictionary keys are converted to
+    strings. Short strings are cached in both directions, since the same
+    dictionary keys appear in every game state.
+    """
+
+    name = 'binary'
+
+    _UINT32 = struct.Struct('!I')
+    _INT8 = struct.Struct('!b')
+    _INT32 = struct.Struct('!i')
+    _INT64 = struct.Struct('!q')
+    _FLOAT = struct.Struct('!d')
+    _CACHE_SIZE = 1024 # short strings, like dictionary keys, are cached
+
+    def __init__(self):
+        self._encoded = {} # string -> encoded string including tag and length
+        self._decoded = {} # encoded string -> string
+
+    def encode(self, data):
+        """
+        Encode data.
+
+        Parameters:
+        data: data compatible with JSON
+
+        Returns:
+        bytes: encoded data
+
+        Raises:
+        TypeError: if the data is not compatible with JSON
+        """
+        parts = []
+        self._encode(data, parts)
+        return b''.join(parts)
+
+    def _encode(self, value, parts):
+        """
+        Encode a single value and append the result to a list.
+
+        Parameters:
+        value: value
+        parts (list): encoded values
+        """
+        if value is None:
+            parts.append(b'N')
+        elif value is True:
+            parts.append(b'T')
+        elif value is False:
+            parts.append(b'F')
+        elif isinstance(value, str):
+            parts.append(self._encode_str(value))
+        elif isinstance(value, int):
+            if -0x80 <= value < 0x80:
+                parts.append(b'b' + self._INT8.pack(value))
+            elif -0x80000000 <= value < 0x80000000:
+                parts.append(b'i' + self._INT32.pack(value))
+            elif -0x8000000000000000 <= value < 0x8000000000000000:
+                parts.append(b'q' + self._INT64.pack(value))
+            else:
+                parts.append(b'L' + self._encode_str(str(int(value))))
+        elif isinstance(value, float):
+            parts.append(b'd' + self._FLOAT.pack(value))
+        elif isinstance(value, dict):
+            parts.append(b'm' + self._UINT32.pack(len(value)))
+            for key, val in value.items():
+                parts.append(self._encode_str(key if isinstance(key, str) else self._key(key)))
+                self._encode(val, parts)
+        elif isinstance(value, (list, tuple)):
+            if value and all(type(val) == int for val in value) and -0x80 <= min(value) and max(value) < 0x80:
+                parts.append(b'a' + self._UINT32.pack(len(value)) + struct.pack(f'!{len(value)}b', *value))
+            else:
+                parts.append(b'l' + self._UINT32.pack(len(value)))
+                for val in value:
+                    self._encode(val, parts)
+        else:
+            raise TypeError(f'Object of type {type(value).__name__} is not serializable')
+
+    def _encode_str(self, value):
+        """
+        Encode a string.
+
+        Parameters:
+        value (str): string
+
+        Returns:
+        bytes: encoded string
+        """
+        encoded = self._encoded.get(value)
+        if encoded: return encoded
+
+        encoded = value.encode()
+
+        if len(encoded) < 0x100:
+            encoded = bytes((0x73, len(encoded))) + encoded # s
+            if len(self._encoded) == self._CACHE_SIZE: self._encoded.clear()
+            self._encoded[value] = encoded
+            return encoded
+
+        return b'S' + self._UINT32.pack(len(encoded)) + encoded
+
+    @staticmethod
+    def _key(key):
+        """
+        Convert a dictionary key into a string, like JSON does.
+
+        Parameters:
+        key: dictionary key
+
+        Returns:
+        str: key
+        """
+        if key is None or isinstance(key, (int, float)):
+            return json.dumps(key)
+
+        raise TypeError(f'keys must be str, int, float, bool or None, not {type(key).__name__}')
+
+    def decode(self, payload):
+        """
+        Decode data.
+
+        Parameters:
+        payload (bytes-like object): encoded data
+
+        Returns:
+        decoded data
+
+        Raises:
+        _DecodeError: if the data is corrupt
+        """
+        try:
+            data = bytes(payload)
+            value, offset = self._decode(data, 0)
+        except (struct.error, IndexError, TypeError, ValueError, RecursionError):
+            raise _DecodeError('corrupt binary data')
+
+        if offset != len(data):
+            raise _DecodeError('corrupt binary data')
+
+        return value
+
+    def _decode(self, data, offset):
+        """
+        Decode a single value.
+
+        Parameters:
+        data (bytes): encoded data
+        offset (int): position of the value's tag
+
+        Returns:
+        tuple(object, int):
+            object: value
+            int: position following the value
+        """
+        tag = data[offset]
+
+        if tag == 0x73: # s
+            end = offset + 2 + data[offset + 1]
+            encoded = data[offset:end]
+            value = self._decoded.get(encoded)
+
+            if value is None:
+                if end > len(data): raise ValueError('string exceeds data')
+                value = encoded[2:].decode()
+                if len(self._decoded) == self._CACHE_SIZE: self._decoded.clear()
+                self._decoded[encoded] = value
+
+            return value, end
+        if tag == 0x62: # b
+            return self._INT8.unpack_from(data, offset + 1)[0], offset + 2
+        if tag == 0x6d: # m
+            size, = self._UINT32.unpack_from(data, offset + 1)
+            offset += 5
+            value = {}
+            decoded = self._decoded
+            for _ in range(size):
+                # keys are short strings most of the time, which are cached:
+                key = None
+                if data[offset] == 0x73: # s
+                    end = offset + 2 + data[offset + 1]
+                    key = decoded.get(data[offset:end])
+                if key is None:
+                    key, end = self._decode(data, offset)
+                    if type(key) != str: raise ValueError('key must be a string')
+
+                # values without content are decoded right away:
+                tag = data[end]
+                if tag == 0x4e: # N
+                    value[key] = None
+                    offset = end + 1
+                elif tag == 0x54: # T
+                    value[key] = True
+                    offset = end + 1
+                elif tag == 0x46: # F
+                    value[key] = False
+                    offset = end + 1
+                else:
+                    value[key], offset = self._decode(data, end)
+            return value, offset
+        if tag == 0x61: # a
+            size, = self._UINT32.unpack_from(data, offset + 1)
+            offset += 5
+            return list(struct.unpack_from(f'!{size}b', data, offset)), offset + size
+        if tag == 0x6c: # l
+            size, = self._UINT32.unpack_from(data, offset + 1)
+            offset += 5
+            value = []
+            for _ in range(size):
+                val, offset = self._decode(data, offset)
+                value.append(val)
+            return value, offset
+        if tag == 0x54: # T
+            return True, offset + 1
+        if tag == 0x46: # F
+            return False, offset + 1
+        if tag == 0x4e: # N
+            return None, offset + 1
+        if tag == 0x69: # i
+            return self._INT32.unpack_from(data, offset + 1)[0], offset + 5
+        if tag == 0x64: # d
+            return self._FLOAT.unpack_from(data, offset + 1)[0], offset + 9
+        if tag == 0x53: # S
+            size, = self._UINT32.unpack_from(data, offset + 1)
+            end = offset + 5 + size
+            if end > len(data): raise ValueError('string exceeds data')
+            return data[offset + 5:end].decode(), end
+        if tag == 0x71: # q
+            return self._INT64.unpack_from(data, offset + 1)[0], offset + 9
+        if tag == 0x4c: # L
+            value, offset = self._decode(data, offset + 1)
+            return int(value), offset
+
+        raise ValueError('unknown tag')
+
+_JSON = _JSONCodec()
+_CODECS = {'binary':_BinaryCodec(), 'json':_JSON} # in order of preference
+
+class _Connection:
+    """
+    Class _Connection.
+
+    This class transfers requests to the server. By default, a new connection is
+    opened for every request (protocol version 1).
+
+    A persistent connection is shared by all API objects using the same server
+    and the same compression setting.
+    When connecting, a handshake is performed. From then on, all requests are
+    sent as frames over the same connection (protocol version 2). Every request
+    carries an ID, which the server includes in its response. A separate thread
+    receives the responses and hands them to the waiting callers, so that
+    responses can arrive in any order. If the server closes the connection, a
+    new one is established for the next request. If the server does not support
+    persistent connections, the class falls back to version 1.
+
+    The handshake proposes all codecs the API supports (see _CODECS). Requests
+    and responses on a persistent connection are encoded using the codec picked
+    by the server, for example a compact binary encoding. Otherwise, JSON is
+    used. If requested, the handshake also asks for compressed responses.
+
+    A subscription to the game state uses a persistent connection of its own,
+    which is not shared (see function stream).
+    """
+
+    _shared = {} # (server, port, compression) -> persistent connection
+    _shared_lock = threading.Lock()
+
+    def __init__(self, server, port, buffer_size, persistent, compression):
+        """
+        Parameters:
+        server (str): server
+        port (int): port number
+        buffer_size (int): bytes
+        persistent (bool): use a persistent connection
+        compression (bool): ask for compressed responses
+        """
+        self._server = server
+        self._port = port
+        self._buffer_size = buffer_size
+        self._persistent = persistent
+        self._compression = compression
+        self._sd = None
+        self._codec = _JSON # negotiated when connecting
+        self._lock = threading.RLock() # for connecting and sending
+        self._pending = {} # request ID -> _Pending
+        self._next_id = 0
+
+    @classmethod
+    def get(cls, server, port, buffer_size, persistent, compression):
+        """
+        Return a connection to the server. Persistent connections are shared.
+
+        Parameters:
+        server (str): server
+        port (int): port number
+        buffer_size (int): bytes
+        persistent (bool): use a persistent connection
+        compression (bool): ask for compressed responses
+
+        Returns:
+        _Connection: connection
+        """
+        if not persistent:
+            return cls(server, port, buffer_size, False, False)
+
+        key = (server, port, compression)
+
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(server, port, buffer_size, True, compression)
+            return cls._shared[key]
+
+    def new_id(self):
+        """
+        Return a new request ID.
+
+        Returns:
+        int: request ID, None if requests are not sent over a persistent connection
+        """
+        if not self._persistent:
+            return None
+
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def exchange(self, data, request_id, size_max):
+        """
+        Send a request to the server and return its response.
+
+        Parameters:
+        data (dict): request
+        request_id (int): request ID as returned by function new_id
+        size_max (int): maximum size of the encoded request in bytes
+
+        Returns:
+        dict: response
+
+        Raises:
+        GameServerAPI._EncodingFailed: if the request could not be encoded
+        GameServerAPI._SizeExceeded: if the encoded request is too large
+        """
+        pending = None
+
+        if request_id is not None:
+            with self._lock:
+                if self._persistent and self._sd is None:
+                    rejection = self._connect()
+                    if rejection: return rejection
+
+                if self._persistent:
+                    request = self._encode(self._codec, data, size_max)
+                    pending = _Pending(self._sd)
+                    self._pending[request_id] = pending
+
+                    try:
+                        self._sd.sendall(_HEADER.pack(len(request)) + request)
+                    except Exception as e:
+                        self._disconnect(self._sd, e)
+                        raise
+
+        if not pending: # no persistent connection
+            return self._exchange_once(self._encode(_JSON, data, size_max))
+
+        # wait for the response:
+        pending.done.wait()
+        if pending.error: raise pending.error
+
+        return pending.response
+
+    @staticmethod
+    def _encode(codec, data, size_max):
+        """
+        Encode a request.
+
+        Parameters:
+        codec (codec): codec
+        data (dict): request
+        size_max (int): maximum size of the encoded request in bytes
+
+        Returns:
+        bytes: encoded request
+        """
+        try:
+            request = codec.encode(data)
+        except:
+            raise GameServerAPI._EncodingFailed
+
+        if len(request) + len(_TERMINATOR) > size_max:
+            raise GameServerAPI._SizeExceeded
+
+        return request
+
+    def _exchange_once(self, request):
+        """
+        Send a request using a separate connection (protocol version 1).
+
+        Parameters:
+        request (bytes): JSON encoded request
+
+        Returns:
+        dict: response
+        """
+        with self._open() as sd:
+            sd.sendall(request + _TERMINATOR)
+            response = self._receive_all(sd)
+
+        if not response: raise GameServerAPI._NoResponse
+
+        return json.loads(str(response, 'utf-8'))
+
+    def stream(self, data, size_max):
+        """
+        Send a subscription over a persistent connection of its own and return
+        the responses pushed by the server (generator). The connection is closed
+        when the generator is closed. This connection object must not be used
+        for anything else.
+
+        Parameters:
+        data (dict): subscription request
+        size_max (int): maximum size of the encoded request in bytes
+
+        Yields:
+        dict: response, nothing at all if the server does not support
+              persistent connections
+        """
+        sd, reader, codec, rejection = self._handshake()
+        if rejection:
+            yield rejection
+            return
+        if not sd:
+            return
+
+        try:
+            request = self._encode(codec, dict(data, id=1), size_max)
+            sd.sendall(_HEADER.pack(len(request)) + request)
+
+            while True:
+                yield codec.decode(reader.read())
+        finally:
+            sd.close()
+
+    def _connect(self):
+        """
+        Establish a persistent connection (protocol version 2), which is shared
+        by all callers.
+
+        Returns:
+        dict: error message, if the server is overloaded, None otherwise
+        """
+        sd, reader, codec, rejection = self._handshake()
+        if not sd: return rejection
+
+        self._sd = sd
+        self._codec = codec
+        threading.Thread(target=self._receive_responses, args=(sd, reader, codec), daemon=True).start()
+
+        return None
+
+    def _handshake(self):
+        """
+        Open a connection and perform the protocol handshake.
+
+        A handshake is sent using version 1 framing. A server that supports
+        persistent connections replies with a frame. Any other server replies
+        with an error message and closes the connection, which is detected by
+        the first byte of the reply: a frame header starts with a zero byte,
+        since its payload is never that large, while JSON starts with a brace.
+        A server that is overloaded rejects the handshake as well. In that case,
+        the API keeps using persistent connections and tries again with the next
+        request.
+
+        Returns:
+        tuple(socket, _FrameReader, codec, dict):
+            socket: connected socket, None if the handshake was rejected
+            _FrameReader: reads frames from the socket
+            codec: codec picked by the server
+            dict: error message, if the server is overloaded, None otherwise
+        """
+        sd = self._open()
+        reader = _FrameReader(sd, self._buffer_size)
+
+        try:
+            handshake = {'type':'protocol', 'version':2, 'codecs':list(_CODECS)}
+            if self._compression: handshake['compression'] = 'zlib'
+            sd.sendall(json.dumps(handshake).encode() + _TERMINATOR)
+
+            if sd.recv(1, socket.MSG_PEEK) != b'\0': # handshake rejected
+                response = self._receive_all(sd)
+                if not response: raise GameServerAPI._NoResponse
+
+                response = json.loads(str(response, 'utf-8'))
+                sd.close()
+
+                if response.get('message') == 'server: overloaded':
+                    return None, None, None, response
+
+                self._persistent = False # server does not support persistent connections
+                return None, None, None, None
+
+            response = json.loads(str(reader.read(), 'utf-8'))
+            if response['status'] != 'ok': raise GameServerAPI._NoResponse
+        except:
+            sd.close()
+            raise
+
+        return sd, reader, _CODECS.get(response['data'].get('codec'), _JSON), None
+
+    def _receive_responses(self, sd, reader, codec):
+        """
+        Receive responses and hand them to the waiting callers. This function
+        runs in a separate thread until the connection is closed.
+
+        Parameters:
+        sd (socket): connected socket
+        reader (_FrameReader): reads frames from the socket
+        codec (codec): codec negotiated for the connection
+        """
+        try:
+            while True:
+                response = codec.decode(reader.read())
+
+                with self._lock:
+                    pending = self._pending.pop(response.get('id'), None)
+
+                if not pending: # response cannot be assigned to a request
+                    raise GameServerAPI._NoResponse
+
+                pending.response = response
+                pending.done.set()
+        except GameServerAPI._NoResponse:
+            self._disconnect(sd, ConnectionResetError())
+        except Exception as e:
+            self._disconnect(sd, e)
+
+    def _disconnect(self, sd, error):
+        """
+        Close a persistent connection and pass an error to all callers still
+        waiting for a response on that connection.
+
+        Parameters:
+        sd (socket): connected socket
+        error (Exception): error to be raised by the waiting callers
+        """
+        with self._lock:
+            if self._sd is sd:
+                self._sd = None
+
+            failed = [(request_id, pending) for request_id, pending in self._pending.items()
+                      if pending.sd is sd]
+            for request_id, _ in failed:
+                del self._pending[request_id]
+
+        try:
+            sd.shutdown(socket.SHUT_RDWR) # wakes up the thread receiving responses
+        except OSError:
+            pass
+        sd.close()
+
+        for _, pending in failed:
+            pending.error = error
+            pending.done.set()
+
+    def _open(self):
+        """
+        Open a connection to the server.
+
+        Returns:
+        socket: connected socket
+        """
+        if self._server.startswith(_UNIX_PREFIX): # Unix domain socket
+            sd = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self._server[len(_UNIX_PREFIX):]
+        else:
+            sd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (self._server, self._port)
+
+        try:
+            sd.connect(address)
+        except:
+            sd.close()
+            raise GameServerAPI._ConnectionFailed
+
+        return sd
+
+    def _receive_all(self, sd):
+        """
+        Receive data until the server closes the connection (protocol version 1).
+
+        The data is received directly into a buffer, which doubles its size
+        whenever it is full.
+
+        Parameters:
+        sd (socket): connected socket
+
+        Returns:
+        bytearray: received data
+        """
+        response = bytearray(self._buffer_size)
+        size = 0
+
+        while True:
+            if size == len(response):
+                response.extend(bytes(len(response)))
+
+            with memoryview(response) as view:
+                received = sd.recv_into(view[size:])
+
+            if not received: break
+            size += received
+
+        del response[size:]
+        return response
+
+class _FrameReader:
+    """
+    Class _FrameReader.
+
+    This class receives frames on a persistent connection (protocol version 2).
+    Data is received directly into a buffer, which is reused for all frames.
+    A payload is returned as a view into the buffer and is only valid until the
+    next frame is read. Compressed payloads are decompressed.
+    """
+
+    def __init__(self, sd, buffer_size):
+        """
+        Parameters:
+        sd (socket): connected socket
+        buffer_size (int): initial buffer size in bytes
+        """
+        self._sd = sd
+        self._buffer = bytearray(buffer_size)
+
+    def read(self):
+        """
+        Receive a frame.
+
+        Returns:
+        bytes-like object: payload
+        """
+        self._receive(_HEADER.size)
+        size, = _HEADER.unpack_from(self._buffer)
+        self._receive(size & ~_COMPRESSED)
+
+        if size & _COMPRESSED:
+            return zlib.decompress(memoryview(self._buffer)[:size & ~_COMPRESSED])
+
+        return memoryview(self._buffer)[:size]
+
+    def _receive(self, size):
+        """
+        Receive a given number of bytes into the beginning of the buffer. The
+        buffer is enlarged, if necessary.
+
+        Parameters:
+        size (int): number of bytes
+        """
+        if size > len(self._buffer):
+            self._buffer = bytearray(max(size, 2 * len(self._buffer)))
+
+        view = memoryview(self._buffer)
+        received = 0
+
+        while received < size:
+            chunk = self._sd.recv_into(view[received:size])
+            if not chunk: raise GameServerAPI._NoResponse
+            received += chunk
+
+class _Pending:
+    """
+    A request waiting for its response on a persistent connection.
+    """
+    def __init__(self, sd):
+        """
+        Parameters:
+        sd (socket): connection the request was sent over
+        """
+        self.sd = sd
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
@@ -31,9 +31,11 @@ def user_input(prompt):
             print('Integers only!')
 
 my_id = game.join()
-state = game.state()
 
-while not state['gameover']:
+for state in game.subscribe(): # a new state is received after every move
+    if state['gameover']:
+        break
+
     print_board(state['board'])
 
     if my_id in state['current']: # my turn
@@ -48,8 +50,6 @@ while not state['gameover']:
     else:
         print("Opponent's turn ...")
 
-    state = game.state()
-
 print_board(state['board'])
 winner = state['winner']
 
@@ -0,0 +1,788 @@
+"""
+Channel.
+
+This module provides classes for transferring frames over persistent
+connections (protocol version 2, see protocol module). A channel receives the
+requests of a single client and sends back the responses. Since requests that
+carry an ID are processed concurrently, responses can be sent by several
+threads or coroutines at the same time. A channel makes sure, that frames are
+never interleaved.
+
+Every connection owns a receive buffer. Data is received directly into that
+buffer, and requests are handed out as views into the buffer, so that they can
+be decoded without being copied first.
+
+WebSocket connections (see websocket module) are handled by channels of their
+own, which carry requests and responses as WebSocket messages instead of
+frames. Otherwise, they behave exactly the same.
+
+In threading mode, the first request of every connection is received by a
+single thread waiting for data on all new connections at once (see class
+RequestReceiver), so that clients sending slowly do not occupy a thread each.
+"""
+
+import asyncio
+import collections
+import queue
+import selectors
+import socket
+import threading
+import time
+import traceback
+
+import codec
+import config
+import protocol
+import utility
+import websocket
+
+class ClientDisconnect(Exception): pass
+class RequestSizeExceeded(Exception): pass
+class ConnectionIdle(Exception): pass
+class ConnectionClosed(Exception): pass # closed properly by a WebSocket client, carries the reply
+
+class ReceiveBuffer:
+    """
+    Class ReceiveBuffer.
+
+    This class provides a receive buffer that is reused for all requests of a
+    connection. Data is received into the free space at the end of the buffer
+    (function writable) using recv_into. Complete requests are returned as
+    memoryview slices of the buffer. Such a slice is only valid until data is
+    received again, so it must be decoded right away.
+
+    The buffer starts with the size defined in the config module and doubles
+    its size whenever a larger request arrives, up to the request size limit.
+    For requests using a terminator (protocol version 1), only newly received
+    data is searched for the terminator.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray(config.buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0 # beginning of data not yet handed out
+        self._end = 0 # end of received data
+        self._scanned = 0 # bytes after start already searched for the terminator
+        self._needed = 0 # size of the incomplete frame at the start, if known
+
+    def empty(self):
+        """
+        Check if the buffer contains data not yet handed out.
+
+        Returns:
+        bool: True, if there is no such data
+        """
+        return self._start == self._end
+
+    def writable(self):
+        """
+        Return the free space at the end of the buffer. If necessary, the
+        buffer is enlarged first.
+
+        Returns:
+        memoryview: free space to receive data into
+        """
+        data = self._end - self._start
+        needed = max(self._needed, data + 1)
+
+        if self._start + needed > len(self._buffer):
+            size = len(self._buffer)
+            while size < needed:
+                size *= 2
+
+            # move data to the beginning of a new buffer (views handed out stay valid):
+            buffer = bytearray(size)
+            buffer[:data] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+            self._start = 0
+            self._end = data
+
+        return self._view[self._end:]
+
+    def commit(self, size):
+        """
+        Register data received into the free space returned by function
+        writable.
+
+        Parameters:
+        size (int): number of bytes received
+        """
+        self._end += size
+
+    def next_request(self, terminator=protocol.TERMINATOR):
+        """
+        Return the next request terminated by b'EOT\0' (protocol version 1).
+
+        Parameters:
+        terminator (bytes): a different terminator, like the end of an HTTP header (optional)
+
+        Returns:
+        memoryview: request without terminator, None if it is incomplete
+
+        Raises:
+        RequestSizeExceeded: if the request is larger than allowed
+        """
+        start = max(self._start, self._start + self._scanned - len(terminator) + 1)
+        pos = self._buffer.find(terminator, start, self._end)
+
+        if pos < 0:
+            self._scanned = self._end - self._start
+            if self._scanned > config.request_size_max: raise RequestSizeExceeded
+            return None
+
+        if pos + len(terminator) - self._start > config.request_size_max:
+            raise RequestSizeExceeded
+
+        return self._hand_out(self._start, pos, pos + len(terminator))
+
+    def next_frame(self):
+        """
+        Return the payload of the next frame (protocol version 2).
+
+        Returns:
+        memoryview: payload, None if the frame is incomplete
+
+        Raises:
+        RequestSizeExceeded: if the payload is larger than allowed
+        """
+        if self._end - self._start < protocol.HEADER.size:
+            self._needed = protocol.HEADER.size
+            return None
+
+        size, = protocol.HEADER.unpack_from(self._buffer, self._start)
+        if size > config.request_size_max: raise RequestSizeExceeded
+
+        start = self._start + protocol.HEADER.size
+        if self._end < start + size:
+            self._needed = protocol.HEADER.size + size
+            return None
+
+        return self._hand_out(start, start + size, start + size)
+
+    def next_websocket_frame(self):
+        """
+        Return the next frame of a WebSocket connection (see websocket module).
+
+        Returns:
+        tuple(bool, int, bytes): None, if the frame is incomplete
+            bool: True, if this is the final fragment of a message
+            int: opcode
+            bytes: unmasked payload
+
+        Raises:
+        ProtocolError: if the frame is not masked
+        RequestSizeExceeded: if the payload is larger than allowed
+        """
+        header = websocket.parse_header(self._view[self._start:self._end])
+        if header is None:
+            self._needed = websocket.MAX_HEADER_SIZE
+            return None
+
+        final, opcode, header_size, size, mask = header
+        if size > config.request_size_max: raise RequestSizeExceeded
+
+        if self._end - self._start < header_size + size:
+            self._needed = header_size + size
+            return None
+
+        start = self._start + header_size
+        payload = self._hand_out(start, start + size, start + size)
+        return final, opcode, websocket.unmask(payload, mask)
+
+    def _hand_out(self, start, end, next_start):
+        """
+        Return a slice of the buffer and mark it as handed out.
+
+        Parameters:
+        start (int): beginning of the slice
+        end (int): end of the slice
+        next_start (int): beginning of the remaining data
+
+        Returns:
+        memoryview: slice
+        """
+        payload = self._view[start:end]
+        self._start = next_start
+        self._scanned = 0
+        self._needed = 0
+
+        if self._start == self._end: # buffer can be reused from the beginning
+            self._start = self._end = 0
+
+        return payload
+
+async def receive_request_async(conn, buffer, terminator=protocol.TERMINATOR):
+    """
+    Receive a request terminated by b'EOT\0' (protocol version 1, coroutine).
+    In threading mode, requests are received by class RequestReceiver instead.
+
+    Parameters:
+    conn (socket): connection socket (non-blocking)
+    buffer (ReceiveBuffer): receive buffer of the connection
+    terminator (bytes): a different terminator (optional)
+
+    Returns:
+    memoryview: request without terminator
+
+    Raises:
+    ClientDisconnect: if the connection was closed before the request was complete
+    RequestSizeExceeded: if the request is larger than allowed
+    asyncio.TimeoutError: if the connection timed out
+    """
+    loop = asyncio.get_running_loop()
+    request = buffer.next_request(terminator)
+
+    while request is None:
+        size = await asyncio.wait_for(
+            loop.sock_recv_into(conn, buffer.writable()), config.connection_timeout)
+        if not size: raise ClientDisconnect
+        buffer.commit(size)
+        request = buffer.next_request(terminator)
+
+    return request
+
+class RequestReceiver:
+    """
+    Class RequestReceiver.
+
+    This class receives the first request of new connections (threading mode).
+    A single thread waits for data on all connections using a selector. Once a
+    request is complete, it is passed to a callback, together with the
+    connection and its receive buffer. If the request could not be received,
+    the callback gets the exception instead (ClientDisconnect,
+    RequestSizeExceeded, socket.timeout or OSError). The time for receiving a
+    request is limited by the connection timeout defined in the config module.
+
+    Callbacks run in the receiving thread, so they must never block. They are
+    meant to pass the request on to a pool of worker threads.
+    """
+
+    def __init__(self):
+        self._log = utility.ServerLogger('receiver', 'connections')
+        self._selector = selectors.DefaultSelector()
+        self._added = queue.SimpleQueue() # connections added by other threads
+        self._receiving = {} # connection -> (buffer, terminator, callback, args)
+        self._deadlines = collections.deque() # (deadline, connection), in the order of adding
+        self._wakeup, self._signal = socket.socketpair() # wakes up the receiving thread
+        self._wakeup.setblocking(False)
+        self._signal.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def receive(self, conn, terminator, callback, *args):
+        """
+        Receive a request in the receiving thread. This function returns right
+        away.
+
+        Parameters:
+        conn (socket): connection socket
+        terminator (bytes): terminator of the request
+        callback (function): called with connection, buffer, request (or exception) and args
+        args: additional arguments passed to the callback
+        """
+        conn.setblocking(False)
+        self._added.put((conn, terminator, callback, args))
+
+        try:
+            self._signal.send(b'\0')
+        except BlockingIOError: # woken up already
+            pass
+
+    def _run(self):
+        """
+        Receive requests. This function runs in the receiving thread.
+        """
+        while True:
+            timeout = None
+            if self._deadlines:
+                timeout = max(0, self._deadlines[0][0] - time.monotonic())
+
+            for key, _ in self._selector.select(timeout):
+                if key.fileobj is self._wakeup:
+                    self._add()
+                else:
+                    self._receive(key.fileobj)
+
+            self._expire()
+
+    def _add(self):
+        """
+        Start receiving on connections added by other threads.
+        """
+        try:
+            while self._wakeup.recv(config.buffer_size):
+                pass
+        except BlockingIOError:
+            pass
+
+        deadline = time.monotonic() + config.connection_timeout
+
+        while not self._added.empty():
+            conn, terminator, callback, args = self._added.get()
+            self._receiving[conn] = (ReceiveBuffer(), terminator, callback, args)
+            self._deadlines.append((deadline, conn))
+
+            try:
+                self._selector.register(conn, selectors.EVENT_READ)
+            except (OSError, ValueError) as e: # closed in the meantime
+                self._finish(conn, e)
+
+    def _receive(self, conn):
+        """
+        Receive available data on a connection and pass on a complete request.
+
+        Parameters:
+        conn (socket): connection socket
+        """
+        buffer, terminator, _, _ = self._receiving[conn]
+
+        try:
+            size = conn.recv_into(buffer.writable())
+            if not size: raise ClientDisconnect
+            buffer.commit(size)
+            request = buffer.next_request(terminator)
+            if request is None:
+                return
+        except BlockingIOError:
+            return
+        except (ClientDisconnect, RequestSizeExceeded, OSError) as e:
+            request = e
+
+        self._finish(conn, request)
+
+    def _expire(self):
+        """
+        Give up on connections whose request did not arrive in time.
+        """
+        now = time.monotonic()
+
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, conn = self._deadlines.popleft()
+            if conn in self._receiving:
+                self._finish(conn, socket.timeout())
+
+    def _finish(self, conn, request):
+        """
+        Stop receiving on a connection and pass it to its callback.
+
+        Parameters:
+        conn (socket): connection socket
+        request (memoryview): request, or the exception raised while receiving it
+        """
+        buffer, _, callback, args = self._receiving.pop(conn)
+
+        try:
+            self._selector.unregister(conn)
+        except (KeyError, ValueError): # never registered
+            pass
+
+        try:
+            conn.setblocking(True)
+        except OSError: # closed
+            pass
+
+        try:
+            callback(conn, buffer, request, *args)
+        except:
+            self._log.error('unexpected exception in the receiving thread:\n' + traceback.format_exc())
+
+class FrameChannel:
+    """
+    Class FrameChannel.
+
+    This class transfers frames over a connection socket. It also keeps track
+    of the number of requests that are being processed concurrently, so that
+    the connection is not closed for being idle while responses are pending.
+    """
+
+    def __init__(self, conn, buffer):
+        """
+        Parameters:
+        conn (socket): connection socket
+        buffer (ReceiveBuffer): receive buffer of the connection
+        """
+        self._conn = conn
+        self._buffer = buffer
+        self.codec = codec.JSON # codec of the payloads, negotiated in the handshake
+        self.compress = False # compress responses, negotiated in the handshake
+        self.closed = False # set when the connection is closed
+        self._send_lock = threading.Lock()
+        self._busy_lock = threading.Lock()
+        self._busy = 0 # number of requests being processed concurrently
+
+    def receive(self):
+        """
+        Receive a single frame.
+
+        While waiting for the next request, the keep-alive timeout applies. Once
+        a frame has started, the regular connection timeout applies. The payload
+        is only valid until this function is called again.
+
+        Returns:
+        memoryview: payload, None if the connection was closed by the client
+
+        Raises:
+        ConnectionIdle: if no request was received within the keep-alive timeout
+        ClientDisconnect: if the connection was closed in the middle of a frame
+        RequestSizeExceeded: if the payload is larger than allowed
+        socket.timeout: if the connection timed out in the middle of a frame
+        """
+        try:
+            payload = self._next_payload()
+
+            while payload is None:
+                idle = self._buffer.empty()
+
+                try:
+                    self._conn.settimeout(config.keep_alive_timeout if idle else config.connection_timeout)
+                    size = self._conn.recv_into(self._buffer.writable())
+                except socket.timeout:
+                    if idle: raise ConnectionIdle
+                    raise
+
+                if not size:
+                    if idle: return None
+                    raise ClientDisconnect
+
+                self._buffer.commit(size)
+                payload = self._next_payload()
+        except ConnectionClosed:
+            return None
+
+        return payload
+
+    def _next_payload(self):
+        """
+        Return the payload of the next frame in the receive buffer.
+
+        Returns:
+        memoryview: payload, None if the frame is incomplete
+        """
+        return self._buffer.next_frame()
+
+    def send(self, payload):
+        """
+        Send a payload as a frame. This function can be called by several
+        threads at the same time.
+
+        Parameters:
+        payload (bytes): payload
+        """
+        self._send_frame(protocol.frame(payload, self.compress))
+
+    def _send_frame(self, frame):
+        """
+        Send a frame, which is never interleaved with other frames.
+
+        Parameters:
+        frame (bytes): frame
+        """
+        with self._send_lock:
+            self._conn.sendall(frame)
+
+    def close(self):
+        """
+        Close the connection.
+        """
+        self.closed = True
+        self._conn.close()
+
+    def request_started(self):
+        """
+        Register a request that is processed concurrently.
+        """
+        with self._busy_lock:
+            self._busy += 1
+
+    def request_finished(self):
+        """
+        Unregister a request that was processed concurrently.
+        """
+        with self._busy_lock:
+            self._busy -= 1
+
+    def busy(self):
+        """
+        Check if requests are being processed concurrently.
+
+        Returns:
+        bool: True, if responses are pending
+        """
+        return self._busy > 0
+
+class WebSocketChannel(FrameChannel):
+    """
+    Class WebSocketChannel.
+
+    This class transfers WebSocket messages over a connection socket. See
+    class FrameChannel for details.
+    """
+
+    def __init__(self, conn, buffer):
+        """
+        Parameters:
+        conn (socket): connection socket
+        buffer (ReceiveBuffer): receive buffer of the connection
+        """
+        super().__init__(conn, buffer)
+        self._messages = WebSocketMessages(buffer)
+
+    def _next_payload(self):
+        """
+        Return the next message in the receive buffer. Control frames are
+        answered right away.
+
+        Returns:
+        bytes-like object: message, None if it is incomplete
+
+        Raises:
+        ConnectionClosed: if the client closed the connection
+        """
+        try:
+            message, reply = self._messages.next()
+            while reply:
+                self._send_frame(reply)
+                message, reply = self._messages.next()
+        except ConnectionClosed as closed:
+            self._send_frame(closed.args[0])
+            raise
+
+        return message
+
+    def send(self, payload):
+        """
+        Send a payload as a text message. This function can be called by
+        several threads at the same time.
+
+        Parameters:
+        payload (bytes): payload
+        """
+        self._send_frame(websocket.frame(payload))
+
+class WebSocketMessages:
+    """
+    Class WebSocketMessages.
+
+    This class assembles the messages sent by a WebSocket client from the
+    frames in the receive buffer. Fragments are joined, and control frames are
+    turned into replies (see websocket module).
+    """
+
+    def __init__(self, buffer):
+        """
+        Parameters:
+        buffer (ReceiveBuffer): receive buffer of the connection
+        """
+        self._buffer = buffer
+        self._fragments = None # fragments of an incomplete message
+
+    def next(self):
+        """
+        Return the next message or the reply to a control frame.
+
+        Returns:
+        tuple(bytes-like object, bytes):
+            bytes-like object: message, None if there is no complete message
+            bytes: frame to be sent to the client, None if there is none
+
+        Raises:
+        ConnectionClosed: if the client closed the connection, carries the close frame to be sent back
+        ClientDisconnect: if the client violated the protocol
+        RequestSizeExceeded: if the message is larger than allowed
+        """
+        while True:
+            try:
+                frame = self._buffer.next_websocket_frame()
+            except websocket.ProtocolError:
+                raise ClientDisconnect
+
+            if frame is None:
+                return None, None
+
+            final, opcode, payload = frame
+
+            # control frames:
+            if opcode == websocket.PING:
+                return None, websocket.frame(payload, websocket.PONG)
+            if opcode == websocket.CLOSE:
+                raise ConnectionClosed(websocket.frame(payload[:2], websocket.CLOSE)) # echo status code
+            if opcode == websocket.PONG:
+                continue
+
+            # messages:
+            if opcode == websocket.CONTINUATION:
+                if self._fragments is None: raise ClientDisconnect
+                self._fragments += payload
+            elif opcode in (websocket.TEXT, websocket.BINARY):
+                if self._fragments is not None: raise ClientDisconnect
+                if final: return payload, None
+                self._fragments = bytearray(payload)
+            else:
+                raise ClientDisconnect
+
+            if len(self._fragments) > config.request_size_max:
+                raise RequestSizeExceeded
+
+            if final:
+                message, self._fragments = self._fragments, None
+                return message, None
+
+class AsyncFrameChannel:
+    """
+    Class AsyncFrameChannel.
+
+    This is the asyncio counterpart of class FrameChannel. Requests that are
+    processed concurrently are run as tasks, which are cancelled when the
+    connection is closed.
+    """
+
+    def __init__(self, conn, buffer):
+        """
+        Parameters:
+        conn (socket): connection socket (non-blocking)
+        buffer (ReceiveBuffer): receive buffer of the connection
+        """
+        self._conn = conn
+        self._buffer = buffer
+        self.codec = codec.JSON # codec of the payloads, negotiated in the handshake
+        self.compress = False # compress responses, negotiated in the handshake
+        self._loop = asyncio.get_running_loop()
+        self._send_lock = asyncio.Lock()
+        self._tasks = set() # requests being processed concurrently
+
+    async def receive(self):
+        """
+        Receive a single frame (coroutine). See FrameChannel.receive for
+        details.
+
+        Returns:
+        memoryview: payload, None if the connection was closed by the client
+        """
+        try:
+            payload = await self._next_payload()
+
+            while payload is None:
+                idle = self._buffer.empty()
+
+                try:
+                    size = await asyncio.wait_for(
+                        self._loop.sock_recv_into(self._conn, self._buffer.writable()),
+                        config.keep_alive_timeout if idle else config.connection_timeout)
+                except asyncio.TimeoutError:
+                    if idle: raise ConnectionIdle
+                    raise
+
+                if not size:
+                    if idle: return None
+                    raise ClientDisconnect
+
+                self._buffer.commit(size)
+                payload = await self._next_payload()
+        except ConnectionClosed:
+            return None
+
+        return payload
+
+    async def _next_payload(self):
+        """
+        Return the payload of the next frame in the receive buffer (coroutine).
+
+        Returns:
+        memoryview: payload, None if the frame is incomplete
+        """
+        return self._buffer.next_frame()
+
+    async def send(self, payload):
+        """
+        Send a payload as a frame (coroutine). This function can be called by
+        several tasks at the same time.
+
+        Parameters:
+        payload (bytes): payload
+        """
+        await self._send_frame(protocol.frame(payload, self.compress))
+
+    async def _send_frame(self, frame):
+        """
+        Send a frame, which is never interleaved with other frames (coroutine).
+
+        Parameters:
+        frame (bytes): frame
+        """
+        async with self._send_lock:
+            await asyncio.wait_for(
+                self._loop.sock_sendall(self._conn, frame),
+                config.connection_timeout)
+
+    def start(self, coroutine):
+        """
+        Process a request concurrently.
+
+        Parameters:
+        coroutine (coroutine): coroutine processing the request
+        """
+        task = self._loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def busy(self):
+        """
+        Check if requests are being processed concurrently.
+
+        Returns:
+        bool: True, if responses are pending
+        """
+        return len(self._tasks) > 0
+
+    def cancel(self):
+        """
+        Cancel all requests that are being processed concurrently.
+        """
+        for task in list(self._tasks):
+            task.cancel()
+
+class AsyncWebSocketChannel(AsyncFrameChannel):
+    """
+    Class AsyncWebSocketChannel.
+
+    This is the asyncio counterpart of class WebSocketChannel.
+    """
+
+    def __init__(self, conn, buffer):
+        """
+        Parameters:
+        conn (socket): connection socket (non-blocking)
+        buffer (ReceiveBuffer): receive buffer of the connection
+        """
+        super().__init__(conn, buffer)
+        self._messages = WebSocketMessages(buffer)
+
+    async def _next_payload(self):
+        """
+        Return the next message in the receive buffer (coroutine). See function
+        WebSocketChannel._next_payload for details.
+
+        Returns:
+        bytes-like object: message, None if it is incomplete
+        """
+        try:
+            message, reply = self._messages.next()
+            while reply:
+                await self._send_frame(reply)
+                message, reply = self._messages.next()
+        except ConnectionClosed as closed:
+            await self._send_frame(closed.args[0])
+            raise
+
+        return message
+
+    async def send(self, payload):
+        """
+        Send a payload as a text message (coroutine). This function can be
+        called by several tasks at the same time.
+
+        Parameters:
+        payload (bytes): payload
+        """
+        await self._send_frame(websocket.frame(payload))
@@ -0,0 +1,394 @@
+"""
+Codec.
+
+This module provides the codecs used to encode requests and responses on
+persistent connections (protocol version 2, see protocol module). A client
+proposes codecs in the protocol handshake, and the server picks the first one it
+supports. JSON is the default. Further codecs can be added using function
+register.
+
+A codec is an object with an attribute name and two methods:
+
+- encode(data): returns the data as bytes
+- decode(payload): returns the data contained in a bytes-like object
+
+Data sent to many clients, like a game state shared by all players, can be
+wrapped in class Shared, so that it is encoded only once per codec.
+"""
+
+import copy
+import json
+import struct
+import threading
+
+class DecodeError(Exception): pass
+
+class Shared(dict):
+    """
+    Class Shared.
+
+    A dictionary that is sent unchanged in several responses. It is encoded only
+    once per codec, the result is reused for all further responses. The codecs
+    of this module insert the encoded dictionary into the encoded response,
+    other codecs simply encode it like any other dictionary. A shared dictionary
+    must not be modified after it has been encoded.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._encoded = {} # codec name -> encoded dictionary
+        self._lock = threading.Lock()
+
+    def encoded(self, encoding):
+        """
+        Return the dictionary encoded by a codec.
+
+        Parameters:
+        encoding (codec): codec
+
+        Returns:
+        bytes: encoded dictionary
+
+        Raises:
+        TypeError: if the dictionary is not compatible with JSON
+        """
+        with self._lock: # other threads wait instead of encoding it as well
+            if encoding.name not in self._encoded:
+                self._encoded[encoding.name] = encoding.encode(dict(self))
+            return self._encoded[encoding.name]
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+class JSONCodec:
+    """
+    Class JSONCodec.
+
+    This codec encodes data as JSON. It is used on every connection that did not
+    negotiate a different codec.
+    """
+
+    name = 'json'
+
+    def encode(self, data):
+        """
+        Encode data. Shared dictionaries (see class Shared) are only reused, if
+        they are values of the dictionary passed, like the data of a response.
+
+        Parameters:
+        data: data compatible with JSON
+
+        Returns:
+        bytes: encoded data
+
+        Raises:
+        TypeError: if the data is not compatible with JSON
+        """
+        if isinstance(data, dict) and not isinstance(data, Shared) and any(isinstance(value, Shared) for value in data.values()):
+            return b'{' + b', '.join(
+                json.dumps(key).encode() + b': ' +
+                (value.encoded(self) if isinstance(value, Shared) else json.dumps(value).encode())
+                for key, value in data.items()) + b'}'
+
+        return json.dumps(data).encode()
+
+    def decode(self, payload):
+        """
+        Decode data without copying the payload first.
+
+        Parameters:
+        payload (bytes-like object): encoded data
+
+        Returns:
+        decoded data
+
+        Raises:
+        UnicodeDecodeError: if the data is not valid UTF-8
+        json.decoder.JSONDecodeError: if the data is not valid JSON
+        """
+        return json.loads(str(payload, 'utf-8'))
+
+class BinaryCodec:
+    """
+    Class BinaryCodec.
+
+    This codec encodes the same data types as JSON in a compact binary format.
+    Every value starts with a single byte (tag), followed by its content:
+
+    N, T, F: None, True, False
+    b, i, q: integer (8, 32 or 64 bit), L: larger integer (decimal string)
+    d: float (64 bit)
+    s: string with up to 255 bytes (8 bit length, UTF-8)
+    S: longer string (32 bit length, UTF-8)
+    a: list of 8 bit integers (32 bit length, packed in a single step)
+    l: list (32 bit length, values)
+    m: dictionary (32 bit length, pairs of string key and value)
+
+    All numbers are big-endian. Lists of small integers, like game boards, are
+    very common in game states, which is why they have a tag of their own. Like
+    JSON, tuples are encoded as lists, and dictionary keys are converted to
+    strings. Short strings are cached in both directions, since the same
+    dictionary keys appear in every game state.
+    """
+
+    name = 'binary'
+
+    _UINT32 = struct.Struct('!I')
+    _INT8 = struct.Struct('!b')
+    _INT32 = struct.Struct('!i')
+    _INT64 = struct.Struct('!q')
+    _FLOAT = struct.Struct('!d')
+    _CACHE_SIZE = 1024 # short strings, like dictionary keys, are cached
+
+    def __init__(self):
+        self._encoded = {} # string -> encoded string including tag and length
+        self._decoded = {} # encoded string -> string
+
+    def encode(self, data):
+        """
+        Encode data.
+
+        Parameters:
+        data: data compatible with JSON
+
+        Returns:
+        bytes: encoded data
+
+        Raises:
+        TypeError: if the data is not compatible with JSON
+        """
+        parts = []
+        self._encode(data, parts)
+        return b''.join(parts)
+
+    def _encode(self, value, parts):
+        """
+        Encode a single value and append the result to a list.
+
+        Parameters:
+        value: value
+        parts (list): encoded values
+        """
+        if value is None:
+            parts.append(b'N')
+        elif value is True:
+            parts.append(b'T')
+        elif value is False:
+            parts.append(b'F')
+        elif isinstance(value, str):
+            parts.append(self._encode_str(value))
+        elif isinstance(value, int):
+            if -0x80 <= value < 0x80:
+                parts.append(b'b' + self._INT8.pack(value))
+            elif -0x80000000 <= value < 0x80000000:
+                parts.append(b'i' + self._INT32.pack(value))
+            elif -0x8000000000000000 <= value < 0x8000000000000000:
+                parts.append(b'q' + self._INT64.pack(value))
+            else:
+                parts.append(b'L' + self._encode_str(str(int(value))))
+        elif isinstance(value, float):
+            parts.append(b'd' + self._FLOAT.pack(value))
+        elif isinstance(value, Shared):
+            parts.append(value.encoded(self))
+        elif isinstance(value, dict):
+            parts.append(b'm' + self._UINT32.pack(len(value)))
+            for key, val in value.items():
+                parts.append(self._encode_str(key if isinstance(key, str) else self._key(key)))
+                self._encode(val, parts)
+        elif isinstance(value, (list, tuple)):
+            if value and all(type(val) == int for val in value) and -0x80 <= min(value) and max(value) < 0x80:
+                parts.append(b'a' + self._UINT32.pack(len(value)) + struct.pack(f'!{len(value)}b', *value))
+            else:
+                parts.append(b'l' + self._UINT32.pack(len(value)))
+                for val in value:
+                    self._encode(val, parts)
+        else:
+            raise TypeError(f'Object of type {type(value).__name__} is not serializable')
+
+    def _encode_str(self, value):
+        """
+        Encode a string.
+
+        Parameters:
+        value (str): string
+
+        Returns:
+        bytes: encoded string
+        """
+        encoded = self._encoded.get(value)
+        if encoded: return encoded
+
+        encoded = value.encode()
+
+        if len(encoded) < 0x100:
+            encoded = bytes((0x73, len(encoded))) + encoded # s
+            if len(self._encoded) == self._CACHE_SIZE: self._encoded.clear()
+            self._encoded[value] = encoded
+            return encoded
+
+        return b'S' + self._UINT32.pack(len(encoded)) + encoded
+
+    @staticmethod
+    def _key(key):
+        """
+        Convert a dictionary key into a string, like JSON does.
+
+        Parameters:
+        key: dictionary key
+
+        Returns:
+        str: key
+        """
+        if key is None or isinstance(key, (int, float)):
+            return json.dumps(key)
+
+        raise TypeError(f'keys must be str, int, float, bool or None, not {type(key).__name__}')
+
+    def decode(self, payload):
+        """
+        Decode data.
+
+        Parameters:
+        payload (bytes-like object): encoded data
+
+        Returns:
+        decoded data
+
+        Raises:
+        DecodeError: if the data is corrupt
+        """
+        try:
+            data = bytes(payload)
+            value, offset = self._decode(data, 0)
+        except (struct.error, IndexError, TypeError, ValueError, RecursionError):
+            raise DecodeError('corrupt binary data')
+
+        if offset != len(data):
+            raise DecodeError('corrupt binary data')
+
+        return value
+
+    def _decode(self, data, offset):
+        """
+        Decode a single value.
+
+        Parameters:
+        data (bytes): encoded data
+        offset (int): position of the value's tag
+
+        Returns:
+        tuple(object, int):
+            object: value
+            int: position following the value
+        """
+        tag = data[offset]
+
+        if tag == 0x73: # s
+            end = offset + 2 + data[offset + 1]
+            encoded = data[offset:end]
+            value = self._decoded.get(encoded)
+
+            if value is None:
+                if end > len(data): raise ValueError('string exceeds data')
+                value = encoded[2:].decode()
+                if len(self._decoded) == self._CACHE_SIZE: self._decoded.clear()
+                self._decoded[encoded] = value
+
+            return value, end
+        if tag == 0x62: # b
+            return self._INT8.unpack_from(data, offset + 1)[0], offset + 2
+        if tag == 0x6d: # m
+            size, = self._UINT32.unpack_from(data, offset + 1)
+            offset += 5
+            value = {}
+            decoded = self._decoded
+            for _ in range(size):
+                # keys are short strings most of the time, which are cached:
+                key = None
+                if data[offset] == 0x73: # s
+                    end = offset + 2 + data[offset + 1]
+                    key = decoded.get(data[offset:end])
+                if key is None:
+                    key, end = self._decode(data, offset)
+                    if type(key) != str: raise ValueError('key must be a string')
+
+                # values without content are decoded right away:
+                tag = data[end]
+                if tag == 0x4e: # N
+                    value[key] = None
+                    offset = end + 1
+                elif tag == 0x54: # T
+                    value[key] = True
+                    offset = end + 1
+                elif tag == 0x46: # F
+                    value[key] = False
+                    offset = end + 1
+                else:
+                    value[key], offset = self._decode(data, end)
+            return value, offset
+        if tag == 0x61: # a
+            size, = self._UINT32.unpack_from(data, offset + 1)
+            offset += 5
+            return list(struct.unpack_from(f'!{size}b', data, offset)), offset + size
+        if tag == 0x6c: # l
+            size, = self._UINT32.unpack_from(data, offset + 1)
+            offset += 5
+            value = []
+            for _ in range(size):
+                val, offset = self._decode(data, offset)
+                value.append(val)
+            return value, offset
+        if tag == 0x54: # T
+            return True, offset + 1
+        if tag == 0x46: # F
+            return False, offset + 1
+        if tag == 0x4e: # N
+            return None, offset + 1
+        if tag == 0x69: # i
+            return self._INT32.unpack_from(data, offset + 1)[0], offset + 5
+        if tag == 0x64: # d
+            return self._FLOAT.unpack_from(data, offset + 1)[0], offset + 9
+        if tag == 0x53: # S
+            size, = self._UINT32.unpack_from(data, offset + 1)
+            end = offset + 5 + size
+            if end > len(data): raise ValueError('string exceeds data')
+            return data[offset + 5:end].decode(), end
+        if tag == 0x71: # q
+            return self._INT64.unpack_from(data, offset + 1)[0], offset + 9
+        if tag == 0x4c: # L
+            value, offset = self._decode(data, offset + 1)
+            return int(value), offset
+
+        raise ValueError('unknown tag')
+
+JSON = JSONCodec()
+
+_codecs = {} # name -> codec
+
+def register(codec):
+    """
+    Make a codec available to clients.
+
+    Parameters:
+    codec: codec (see module description)
+    """
+    _codecs[codec.name] = codec
+
+def negotiate(names):
+    """
+    Select a codec from a list of names proposed by a client.
+
+    Parameters:
+    names (list): codec names in order of preference
+
+    Returns:
+    codec: the first codec available, JSON if there is none
+    """
+    for name in names:
+        if name in _codecs:
+            return _codecs[name]
+
+    return JSON
+
+register(JSON)
+register(BinaryCodec())
@@ -7,9 +7,17 @@ This file contains configuration data for the server and framework.
 # SERVER:
 ip = '127.0.0.1'
 port = 4711
+websocket_port = None # port for WebSocket clients like browsers (e.g. 4712), None to disable
+websocket_origins = [] # web pages allowed to connect via WebSocket (e.g. ['https://example.com'], 'null' for local files), clients sending no origin like game engines are always accepted
+unix_socket = None # path of a Unix domain socket for clients on the same host (e.g. '/tmp/game_server.sock'), None to disable
+server_mode = 'threading' # 'threading' (pool of threads) or 'asyncio' (one event loop, scales to many waiting clients)
+worker_processes = 1 # game sessions are shared among worker processes listening on the same port (requires Linux)
+metrics_port = None # port on the loopback interface serving metrics (e.g. 4713), None to disable
 
 # FRAMEWORK:
 game_timeout = 1000 # seconds, timeout for inactive games and for joining a game
+delta_versions = 16 # states per view kept as base for differences in delta mode (see GameSession.delta_state)
+session_table_stripes = 64 # locks guarding the table of game sessions, each one for a part of the sessions
 
 # LOGGING:
 log_server_info = False # useful for debugging tcp connections (verbose)
@@ -17,6 +25,17 @@ log_server_errors = True # errors during tcp connections
 log_framework_request = True # client requests
 log_framework_response = True # server responses
 log_framework_actions = True # actions performed by the framework, such as terminating games
+log_level = 'debug' # least severe level logged: 'debug' (server information), 'info' (framework), 'warning' or 'error'
+log_format = 'text' # 'text' (human readable) or 'json' (one JSON object per line, for log processors)
+log_sampling = {} # fraction of messages logged per category ('server', 'request', 'response', 'actions'), e.g. {'request':0.01}
+log_payload_max = 1000 # characters, longer requests and responses are truncated in the log
+log_queue_size = 10000 # messages waiting to be written, further messages are dropped (and counted)
+slow_request_threshold = None # milliseconds, slower requests are logged with the time spent in each phase (see timing module), None to disable
+
+# PROFILING:
+profiler_signal = 'SIGUSR1' # signal starting and stopping the profiler (see profiler module), None to disable
+profiler_interval = 5 # milliseconds between snapshots of all stacks while profiling
+profiler_directory = '.' # directory the profiles are written to
 
 # TCP CONNECTIONS:
 # pick a higher value for request_size_max if required by a new game;
@@ -24,3 +43,22 @@ log_framework_actions = True # actions performed by the framework, such as termi
 request_size_max = int(1e6) # bytes, prevents clients from sending too much data
 buffer_size = 4096 # bytes, corresponds to client-side buffer size value
 connection_timeout = 60 # seconds, timeout for tcp transactions
+keep_alive_timeout = 600 # seconds, idle persistent connections are closed by the server
+subscription_check_interval = 10 # seconds, subscriptions check for closed connections at this interval
+compression_threshold = 1024 # bytes, smaller responses are never compressed (if requested by the client)
+compression_level = 6 # zlib compression level, 1 (fastest) to 9 (smallest)
+forward_timeout = 5 # seconds, timeout for connecting and sending to another worker process (see sharding module)
+
+# LOAD LIMITS:
+# when a limit is reached, the server replies 'server: overloaded' right away
+# instead of accepting more work than it can finish; short requests (move,
+# observe, restart) and long-poll requests (state, join) have separate limits,
+# so that clients waiting for the game state cannot starve moves; in asyncio
+# mode, no threads are used and each limit is the sum of workers and queue size
+connections_max = 1024 # connections sending their first request at the same time, all received by a single thread
+short_request_workers = 16 # threads processing short requests
+short_request_queue_size = 1024 # short requests waiting for a thread
+long_request_workers = 1024 # threads processing long-poll requests
+long_request_queue_size = 0 # long-poll requests waiting for a thread
+persistent_connections_max = 1024 # persistent connections open at the same time, each handled by a thread
+subscriptions_max = 1024 # subscriptions active at the same time (see protocol module), each handled by a thread
@@ -0,0 +1,86 @@
+"""
+Delta.
+
+This module computes the difference between two game states, so that a client
+only receives what has changed since the state it received before (see function
+GameSession.delta_state). A difference is a dictionary with these optional
+keys:
+
+- 'set': keys with new or changed values
+- 'del': list of removed keys
+- 'append': lists that have grown at the end, containing only the new items
+- 'dicts': nested dictionaries that have changed, containing their differences
+
+This way, a chat message appended to a long history only costs the message
+itself. The client rebuilds the state by applying the difference to its copy of
+the previous state.
+"""
+
+import json
+
+def diff(old, new):
+    """
+    Compute the difference between two dictionaries.
+
+    Parameters:
+    old (dict): state received by the client before
+    new (dict): current state
+
+    Returns:
+    dict: difference (see module description)
+    """
+    changed = {}
+    appended = {}
+    nested = {}
+
+    for key, value in new.items():
+        if key not in old:
+            changed[key] = value
+            continue
+
+        previous = old[key]
+        if _equal(previous, value):
+            continue
+
+        if type(value) == dict and type(previous) == dict:
+            nested[key] = diff(previous, value)
+        elif (type(value) == list and type(previous) == list and len(value) > len(previous)
+              and _equal(value[:len(previous)], previous)):
+            appended[key] = value[len(previous):]
+        else:
+            changed[key] = value
+
+    # keys are sent as strings, like JSON does:
+    removed = [key if isinstance(key, str) else json.dumps(key) for key in old if key not in new]
+
+    result = {}
+    if changed: result['set'] = changed
+    if removed: result['del'] = removed
+    if appended: result['append'] = appended
+    if nested: result['dicts'] = nested
+
+    return result
+
+def _equal(a, b):
+    """
+    Compare two values like the == operator, except that values of different
+    types are never equal, even in nested lists and dictionaries. Otherwise, a
+    change from 1 to True or from 0 to 0.0 would not be sent to the client.
+
+    Parameters:
+    a: value
+    b: value
+
+    Returns:
+    bool: True, if the values are equal
+    """
+    if a is b:
+        return True
+    if type(a) != type(b) or a != b:
+        return False
+
+    if type(a) == dict:
+        return all(_equal(value, b[key]) for key, value in a.items())
+    if type(a) in (list, tuple):
+        return all(map(_equal, a, b))
+    return True
@@ -15,12 +15,19 @@ To perform these actions, the framework calls the methods of the corresponding
 game class instance, if necessary.
 """
 
+import collections
+import heapq
+import itertools
 import threading
 import time
+import weakref
 
 import config
 import games_list
 import game_session
+import metrics
+import session_table
+import timing
 import utility
 
 log = utility.FrameworkLogger()
@@ -35,16 +42,22 @@ class GameFramework:
 
     def __init__(self):
         self._game_classes = {} # game name -> game class
-        self._game_sessions = {} # (game name, token) -> game session
+        self._game_sessions = session_table.SessionTable(config.session_table_stripes) # (game name, token) -> game session
+        self._expiry = [] # heap of (deadline, number, (game name, token), weak reference to game session)
+        self._expiry_numbers = itertools.count() # orders entries with equal deadlines
+        self._expiry_change = threading.Condition()
         self._handlers = {
             'join':self._join,
             'move':self._move,
             'state':self._state,
             'observe':self._observe,
             'restart':self._restart}
+        self._async_handlers = { # handlers that may have to wait (asyncio mode)
+            'join':self._join_async,
+            'state':self._state_async}
         self._build_game_class_dict()
         self._start_clean_up()
-        self._player_joins = threading.Event()
+        metrics.SESSIONS.collect_with(self._count_sessions)
 
     def _build_game_class_dict(self):
         """
@@ -67,27 +80,95 @@ class GameFramework:
         Returns:
         dict: reply
         """
-        if 'type' not in request:
-            return utility.framework_error('no request type specified')
-        if request['type'] not in self._handlers:
-            return utility.framework_error('invalid request type')
+        err = self._check_request_type(request)
+        if err: return err
 
+        start = time.perf_counter()
         log.request(request)
         response = self._handlers[request['type']](request)
         log.response(response)
+        self._record(request, response, start)
 
         return response
 
+    async def handle_request_async(self, request):
+        """
+        Handling a client request (coroutine).
+
+        This is the asyncio counterpart of function handle_request. Requests
+        that may have to wait, like joining a game or retrieving the game state,
+        are handled by coroutines, so that a waiting client does not occupy a
+        thread. All other requests never block and are handled directly.
+
+        Parameters:
+        request (dict): client request
+
+        Returns:
+        dict: reply
+        """
+        err = self._check_request_type(request)
+        if err: return err
+
+        start = time.perf_counter()
+        log.request(request)
+        if request['type'] in self._async_handlers:
+            response = await self._async_handlers[request['type']](request)
+        else:
+            response = self._handlers[request['type']](request)
+        log.response(response)
+        self._record(request, response, start)
+
+        return response
+
+    def _record(self, request, response, start):
+        """
+        Record metrics of a handled request (see metrics module).
+
+        Parameters:
+        request (dict): client request
+        response (dict): reply
+        start (float): time the request was received (perf_counter)
+        """
+        metrics.REQUESTS.inc(request['type'], response.get('status'))
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - start, request['type'])
+
+    def _count_sessions(self):
+        """
+        Count active game sessions per game, for metrics.
+
+        Returns:
+        dict: (game name,) -> number of sessions
+        """
+        counts = collections.Counter(game_name for game_name, _ in self._game_sessions.keys())
+        return {(game_name,):count for game_name, count in counts.items()}
+
+    def _check_request_type(self, request):
+        """
+        Check if a request specifies a valid request type.
+
+        Parameters:
+        request (dict): client request
+
+        Returns:
+        dict: error message, if the request type is invalid, None otherwise
+        """
+        if 'type' not in request:
+            return utility.framework_error('no request type specified')
+        if request['type'] not in self._handlers:
+            return utility.framework_error('invalid request type')
+
+        return None
+
     def _join(self, request):
         """
         Request handler for starting and joining a game session.
 
         This function first checks if a game session specified by the game's
         name and the token is already created and still waiting for clients to
-        join. If this is the case, the request is passed to the function for
-        joining a session. In all other cases, the function for starting a new
-        game session is called. This implies that an already running session
-        will be terminated.
+        join. If this is the case, the client joins that session. In all other
+        cases, a new game session is started. This implies that an already
+        running session will be terminated. See function _enter_session for
+        details.
 
         Parameters:
         request (dict): request containing game name and token
@@ -95,10 +176,59 @@ class GameFramework:
         Returns:
         dict: containing the player's ID and key
         """
+        joining, err = self._enter_session(request)
+        if err: return err
+
+        # wait for others to join:
+        timing.mark('framework')
+        joining.session.await_full(config.game_timeout)
+        timing.mark('wait')
+
+        return self._finish_join(joining)
+
+    async def _join_async(self, request):
+        """
+        Request handler for starting and joining a game session (coroutine).
+        See function _join for details.
+
+        Parameters:
+        request (dict): request containing game name and token
+
+        Returns:
+        dict: containing the player's ID and key
+        """
+        joining, err = self._enter_session(request)
+        if err: return err
+
+        # wait for others to join:
+        timing.mark('framework')
+        await joining.session.await_full_async(config.game_timeout)
+        timing.mark('wait')
+
+        return self._finish_join(joining)
+
+    def _enter_session(self, request):
+        """
+        Starting or joining a game session.
+
+        This function checks and parses a join request. If the game session
+        specified by the game's name and the token is still waiting for clients
+        to join, the client joins it. Otherwise, a new session is started. The
+        caller then has to wait for the remaining players to join, before
+        passing the returned object to function _finish_join.
+
+        Parameters:
+        request (dict): request containing game name and token
+
+        Returns:
+        tuple(_Joining, dict):
+            _Joining: the client's place in the session, None in case of an error
+            dict: error message, if a problem occurred, None otherwise
+        """
         # check and parse request:
         err = utility.check_dict(request, {
             'game':str, 'token':str, 'players':(int, type(None)), 'name':str})
-        if err: return utility.framework_error(err)
+        if err: return None, utility.framework_error(err)
 
         game_name = request['game']
         token = request['token']
@@ -106,37 +236,35 @@ class GameFramework:
         name = request['name']
 
         if game_name not in self._game_classes:
-            return utility.framework_error('no such game')
-
-        # retrieve game session, if it exists:
-        session, _ = self._retrieve_session(game_name, token)
-
-        # start or join a session:
-        if session and not session.full():
-            return self._join_session(session, name)
-        elif not session and not players:
-            return utility.framework_error('no such game session')
-        elif session and session.full() and not players:
-            return utility.framework_error('game session already full')
-        else:
-            return self._start_session(game_name, token, players, name)
+            return None, utility.framework_error('no such game')
+
+        # no other client may start or join the session in the meantime:
+        with self._game_sessions.locked((game_name, token)):
+            # retrieve game session, if it exists:
+            session, _ = self._retrieve_session(game_name, token)
+
+            # start or join a session:
+            if session and not session.full():
+                return self._join_session(session, game_name, token, name)
+            elif not session and not players:
+                return None, utility.framework_error('no such game session')
+            elif session and session.full() and not players:
+                return None, utility.framework_error('game session already full')
+            else:
+                return self._start_session(game_name, token, players, name)
 
     def _start_session(self, game_name, token, players, name):
         """
         Starting a game session.
 
         This function instantiates the requested game and adds it to the list of
-        active game sessions. After the required number of players has joined
-        the game, the function sends the player ID back to the client who
-        requested the start of the game. If not enough players have joined the
-        game before the timeout occurs, the game session is deleted and the
-        requesting client is informed. A repeated call of this function will end
-        an active game session and start a new one, which the other players will
+        active game sessions. A repeated call of this function will end an
+        active game session and start a new one, which the other players will
         have to join again.
 
-        In addition to the ID, a unique key is generated for the player and sent
-        to the client. It is automatically included in every future request sent
-        by the client and then checked by the framework to prevent cheating.
+        In addition to the ID, a unique key is generated for the player. It is
+        automatically included in every future request sent by the client and
+        then checked by the framework to prevent cheating.
 
         Parameters:
         game_name (str): name of the game
@@ -145,13 +273,13 @@ class GameFramework:
         name (str): player name, can be an empty string
 
         Returns:
-        dict: containing the player's ID and key
+        tuple(_Joining, dict): see function _enter_session
         """
         # check number of players:
         game_class = self._game_classes[game_name]
 
         if players > game_class.max_players() or players < game_class.min_players():
-            return utility.framework_error('invalid number of players')
+            return None, utility.framework_error('invalid number of players')
 
         # retrieve old game session, if it exists, and notify clients:
         old_session, _ = self._retrieve_session(game_name, token)
@@ -162,61 +290,69 @@ class GameFramework:
 
         # create game session and add it to dictionary of active sessions:
         session = game_session.GameSession(game_class, players)
-        self._game_sessions[(game_name, token)] = session
+        self._game_sessions.put((game_name, token), session)
+        self._schedule_expiry((game_name, token), session, session.last_access() + config.game_timeout)
 
         # get player ID and key:
         player_id, key, _ = session.next_id(name)
 
-        # wait for others to join:
-        self._await_game_start(session)
-
-        if not session.full(): # timeout reached
-            if (game_name, token) in self._game_sessions:
-                del self._game_sessions[(game_name, token)] # remove game session
-            return utility.framework_error('timeout while waiting for others to join')
-
-        log.info(f'Starting session {game_name}:{token}')
+        return _Joining(session, game_name, token, player_id, key, True), None
 
-        return self._return_data({
-            'player_id':player_id,
-            'key':key,
-            'request_size_max':config.request_size_max})
-
-    def _join_session(self, session, name):
+    def _join_session(self, session, game_name, token, name):
         """
         Joining a game session.
 
-        This function lets a client join an existing game session. After the
-        required number of players has joined the game, the function sends the
-        player ID back to the client who requested to join the game. If not
-        enough players have joined the game before the timeout occurs, the
-        requesting client is informed.
-
-        In addition to the ID, a unique key is generated for the player and sent
-        to the client. It is automatically included in every future request sent
-        by the client and then checked by the framework to prevent cheating.
+        This function lets a client join an existing game session. In addition
+        to the ID, a unique key is generated for the player. It is automatically
+        included in every future request sent by the client and then checked by
+        the framework to prevent cheating.
 
         Parameters:
         session (GameSession): game session
+        game_name (str): name of the game
+        token (str): name of the game session
         name (str): player name, can be an empty string
 
         Returns:
-        dict: containing the player's ID and key
+        tuple(_Joining, dict): see function _enter_session
         """
         # get player ID and key:
         player_id, key, err = session.next_id(name)
-        if err: return utility.framework_error(err)
+        if err: return None, utility.framework_error(err)
 
-        # wait for others to join:
-        self._player_joins.set()
-        self._await_game_start(session)
+        return _Joining(session, game_name, token, player_id, key, False), None
+
+    def _finish_join(self, joining):
+        """
+        Completing a join request after waiting for the other players.
+
+        After the required number of players has joined the game, the player's
+        ID and key are sent back to the client. If not enough players have
+        joined the game before the timeout occurs, the requesting client is
+        informed. A session that timed out in this way is deleted by the client
+        who started it.
+
+        Parameters:
+        joining (_Joining): the client's place in the session
+
+        Returns:
+        dict: containing the player's ID and key
+        """
+        session = joining.session
+        game_name = joining.game_name
+        token = joining.token
 
         if not session.full(): # timeout reached
+            if joining.starter:
+                self._game_sessions.remove((game_name, token), session) # remove game session
             return utility.framework_error('timeout while waiting for others to join')
 
+        if joining.starter:
+            log.info('Starting session %s:%s', game_name, token)
+
         return self._return_data({
-            'player_id':player_id,
-            'key':key,
+            'player_id':joining.player_id,
+            'key':joining.key,
             'request_size_max':config.request_size_max})
 
     def _move(self, request):
@@ -281,29 +417,103 @@ class GameFramework:
         Returns:
         dict: containing the game state
         """
+        session, err = self._state_session(request)
+        if err: return err
+
+        # retrieve the game state:
+        if 'since_version' in request:
+            state = session.versioned_state(
+                request['player_id'], request['since_version'], request.get('timeout'))
+        else:
+            state = session.game_state(request['player_id'], request['observer'])
+
+        return self._state_result(session, state, request)
+
+    async def _state_async(self, request):
+        """
+        Request handler for game state requests (coroutine). See function
+        _state for details.
+
+        Parameters:
+        request (dict): containing information about the game session and the player
+
+        Returns:
+        dict: containing the game state
+        """
+        session, err = self._state_session(request)
+        if err: return err
+
+        # retrieve the game state:
+        if 'since_version' in request:
+            state = await session.versioned_state_async(
+                request['player_id'], request['since_version'], request.get('timeout'))
+        else:
+            state = await session.game_state_async(request['player_id'], request['observer'])
+
+        return self._state_result(session, state, request)
+
+    def _state_session(self, request):
+        """
+        Checking a game state request and retrieving the game session.
+
+        Parameters:
+        request (dict): containing information about the game session and the player
+
+        Returns:
+        tuple(GameSession, dict):
+            GameSession: game session, None in case of an error
+            dict: error message, if a problem occurred, None otherwise
+        """
         # check and parse request:
         err = utility.check_dict(request, {
             'game':str, 'token':str, 'player_id':int, 'key':str, 'observer':bool})
-        if err: return utility.framework_error(err)
+        if err: return None, utility.framework_error(err)
+
+        # optional delta mode (see function GameSession.delta_state):
+        if 'delta' in request and type(request['delta']) != bool:
+            return None, utility.framework_error("value of key 'delta' must be of type bool")
+        if 'base' in request and type(request['base']) != int:
+            return None, utility.framework_error("value of key 'base' must be of type int")
+
+        # optional conditional request (see function GameSession.versioned_state):
+        if 'since_version' in request and type(request['since_version']) != int:
+            return None, utility.framework_error("value of key 'since_version' must be of type int")
+        if 'timeout' in request and (type(request['timeout']) not in (int, float) or request['timeout'] < 0):
+            return None, utility.framework_error("value of key 'timeout' must be a non-negative number")
 
         game_name = request['game']
         token = request['token']
         player_id = request['player_id']
         key = request['key']
-        observer = request['observer']
 
         # retrieve the game session:
         session, err = self._retrieve_session(game_name, token)
         if err: # no such game or game session
-            return err
+            return None, err
 
         # check if key and ID match:
         if not session.key_valid(player_id, key):
-            return utility.framework_error('invalid key')
+            return None, utility.framework_error('invalid key')
 
-        # retrieve the game state:
-        state = session.game_state(player_id, observer)
+        return session, None
 
+    def _state_result(self, session, state, request):
+        """
+        Returning the game state after it was retrieved from the game session.
+
+        If the client asked for delta mode, only the difference to the state it
+        received before is returned, if possible, together with the state
+        version. If a conditional request returns an unchanged state, the
+        difference is empty.
+
+        Parameters:
+        session (GameSession): game session
+        state (dict): game state
+        request (dict): game state request
+
+        Returns:
+        dict: containing the game state
+        """
         # check if session was overwritten while clients are waiting for state change:
         if session.overwritten():
             return utility.framework_error('game session was overwritten')
@@ -312,6 +522,16 @@ class GameFramework:
         if session.timed_out():
             return utility.framework_error('game session has timed out')
 
+        if request.get('delta'):
+            version = state['version']
+
+            if version == request.get('since_version') and 'base' in request: # timeout expired
+                state = {'base':request['base'], 'delta':{}}
+            else:
+                state = session.delta_state(request['player_id'], state, request.get('base'))
+
+            state['version'] = version
+
         return self._return_data(state)
 
     def _observe(self, request):
@@ -390,22 +610,6 @@ class GameFramework:
 
         return self._return_data(None)
 
-    def _await_game_start(self, session):
-        """
-        Waits for players to join the game.
-
-        This function waits until the required number of players has joined the
-        game or until the timeout is reached.
-
-        Parameters:
-        session (GameSession): game session
-        """
-        start = session.last_access()
-
-        while not session.full() and time.time() - start < config.game_timeout:
-            self._player_joins.clear()
-            self._player_joins.wait(config.game_timeout)
-
     def _retrieve_session(self, game_name, token):
         """
         Retrieves an active game session.
@@ -424,10 +628,11 @@ class GameFramework:
         # check if game session exists:
         if game_name not in self._game_classes:
             return None, utility.framework_error('no such game')
-        if (game_name, token) not in self._game_sessions:
+        session = self._game_sessions.get((game_name, token))
+        if not session:
             return None, utility.framework_error('no such game session')
 
-        return self._game_sessions[(game_name, token)], None
+        return session, None
 
     def _return_data(self, data):
         """
@@ -444,24 +649,79 @@ class GameFramework:
         """
         threading.Thread(target=self._clean_up, args=(), daemon=True).start()
 
+    def _schedule_expiry(self, key, session, deadline):
+        """
+        Add a game session to the expiry heap, so that the clean up thread
+        checks it at the given time.
+
+        Parameters:
+        key (tuple): game name and token
+        session (GameSession): game session
+        deadline (float): time of the check (time.time)
+        """
+        with self._expiry_change:
+            heapq.heappush(self._expiry, (deadline, next(self._expiry_numbers), key, weakref.ref(session)))
+            if self._expiry[0][0] == deadline:
+                self._expiry_change.notify() # new earliest deadline
+
     def _clean_up(self):
         """
         Deleting inactive game sessions after a defined time span without read
         or write access.
+
+        Each game session has a single entry in a heap ordered by deadlines, so
+        the thread sleeps until the earliest deadline and only checks sessions
+        that are due. Accessing a session does not touch the heap: when its
+        deadline is reached, a session that has been accessed in the meantime
+        is scheduled again for its new deadline. Entries of sessions that have
+        been replaced or deleted in the meantime are dropped.
         """
         while True:
-            time.sleep(config.game_timeout)
-
-            # mark sessions for deletion:
-            old_sessions = []
-            for (game_name, token), session in self._game_sessions.items():
-                if session.last_access() + config.game_timeout < time.time():
-                    old_sessions.append((game_name, token))
-
-            # delete old sessions:
-            for (game_name, token) in old_sessions:
-                session = self._game_sessions[(game_name, token)]
-                session.mark_timed_out()
-                session.wake_up_threads()
-                del self._game_sessions[(game_name, token)]
-                log.info(f'Deleting session {game_name}:{token}')
+            # wait for the earliest deadline:
+            with self._expiry_change:
+                while not self._expiry or self._expiry[0][0] > time.time():
+                    self._expiry_change.wait(self._expiry[0][0] - time.time() if self._expiry else None)
+                _, _, key, ref = heapq.heappop(self._expiry)
+
+            session = ref()
+
+            # no other client may join the session in the meantime:
+            with self._game_sessions.locked(key):
+                if session is None or self._game_sessions.get(key) is not session:
+                    continue # replaced or deleted
+
+                deadline = session.last_access() + config.game_timeout
+                if deadline > time.time(): # accessed in the meantime
+                    self._schedule_expiry(key, session, deadline)
+                    continue
+
+                # delete old session:
+                self._game_sessions.remove(key, session)
+
+            session.mark_timed_out()
+            session.wake_up_threads()
+            lag = time.time() - deadline
+            metrics.SESSIONS_EXPIRED.inc(key[0])
+            metrics.EXPIRY_LAG.observe(lag)
+            log.info('Deleting session %s:%s (%.3f s after its deadline)', key[0], key[1], lag)
+
+class _Joining:
+    """
+    A client's place in a game session while waiting for others to join.
+    """
+    def __init__(self, session, game_name, token, player_id, key, starter):
+        """
+        Parameters:
+        session (GameSession): game session
+        game_name (str): name of the game
+        token (str): name of the game session
+        player_id (int): player ID
+        key (str): player key
+        starter (bool): True, if the client started the session
+        """
+        self.session = session
+        self.game_name = game_name
+        self.token = token
+        self.player_id = player_id
+        self.key = key
+        self.starter = starter
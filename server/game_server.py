@@ -6,10 +6,18 @@ A lightweight server and framework for turn-based multiplayer games.
 Copyright (C) 2025, 2026 Fabian Eberts
 Licensed under the GPL v3.0 (see LICENSE)
 
-This server program opens a port and handles client connections in separate
-threads. It passes the data received from a client to the game framework and
-sends the framework's reply back to the client. Parameters like IP or port
-number are defined in the config module.
+This server program opens a port and handles client connections either in
+separate threads or as coroutines of a single asyncio event loop (see config
+module). It passes the data received from a client to the game framework and
+sends the framework's reply back to the client. Clients can either send a single
+request per connection or negotiate a persistent connection carrying many
+requests (see protocol module). Browsers and game engines can connect using
+WebSockets on a separate port (see websocket module). Clients on the same host
+can connect via a Unix domain socket, avoiding the TCP stack. Game sessions can
+be shared among several worker processes (see sharding module). Metrics can be
+retrieved on a separate port (see metrics module), and a profiler can be started
+and stopped by a signal (see profiler module). Parameters like IP or port number
+are defined in the config module.
 
 This program is distributed in the hope that it will be useful,
 but WITHOUT ANY WARRANTY; without even the implied warranty of
@@ -17,21 +25,63 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.
 """
 
+import asyncio
 import json
+import os
 import socket
+import stat
 import threading
 import traceback
 
+import channel
+import codec
 import config
 import game_framework
+import metrics
+import profiler
+import protocol
+import sharding
+import timing
 import utility
+import websocket
+import workers
 
-framework = game_framework.GameFramework()
+from channel import ClientDisconnect, RequestSizeExceeded, ConnectionIdle
 
-class ClientDisconnect(Exception): pass
-class RequestSizeExceeded(Exception): pass
+framework = None # created once the worker processes have been started
+shards = None # routing of requests, if there are several worker processes
+receiver = None # receives the first request of every connection in threading mode
 
-def handle_connection(conn, ip, port):
+# limits (see config module):
+connections = workers.WorkerPool(config.connections_max, 0, 'connections') # limit only
+short_requests = workers.WorkerPool(config.short_request_workers, config.short_request_queue_size, 'short_requests')
+long_requests = workers.WorkerPool(config.long_request_workers, config.long_request_queue_size, 'long_requests')
+persistent_connections = workers.WorkerPool(config.persistent_connections_max, 0, 'persistent_connections')
+subscriptions = workers.WorkerPool(config.subscriptions_max, 0, 'subscriptions')
+
+metrics.POOL_JOBS.collect_with(lambda: {
+    ('connections',):connections.admitted(),
+    ('short_requests',):short_requests.admitted(),
+    ('long_requests',):long_requests.admitted(),
+    ('persistent_connections',):persistent_connections.admitted(),
+    ('subscriptions',):subscriptions.admitted()})
+
+def receive_connection(conn, ip, port):
+    """
+    Start receiving the first request of a new connection (threading mode). The
+    request is received by the receiving thread, which then calls function
+    handle_connection.
+
+    Parameters:
+    conn (socket): connection socket
+    ip (str): client IP
+    port (int): client port
+    """
+    log = utility.ServerLogger(ip, port)
+    log.info('connection accepted')
+    receiver.receive(conn, protocol.TERMINATOR, handle_connection, log, timing.RequestTiming())
+
+def handle_connection(conn, buffer, request, log, timer):
     """
     Handling a connection.
 
@@ -47,43 +97,688 @@ def handle_connection(conn, ip, port):
     corresponding parameters are defined in the config module. Whenever
     possible, error messages are sent back to the client.
 
+    The request has been received by the receiving thread (see class
+    channel.RequestReceiver), which runs this function, so it must never block.
+    The request is passed on to the pool responsible for that type of request
+    (see function request_pool). If that pool is saturated, the client is told
+    that the server is overloaded. Error messages are sent without blocking.
+
+    If the client's first request is a protocol handshake, the connection is
+    kept open and handled by function handle_persistent instead, in a thread
+    of the pool of persistent connections (see protocol module).
+
+    Parameters:
+    conn (socket): connection socket
+    buffer (ReceiveBuffer): receive buffer of the connection
+    request (memoryview): request, or the exception raised while receiving it
+    log (ServerLogger): logger
+    timer (RequestTiming): phases of the request
+    """
+    connections.release() # no longer receiving
+    conn.settimeout(config.connection_timeout)
+
+    try:
+        if isinstance(request, Exception):
+            raise request
+
+        timer.mark('receive')
+        log_request(log, request)
+        request = protocol.parse_request(request)
+        timer.mark('decode')
+
+        if protocol.is_handshake(request):
+            # switch to a persistent connection:
+            response, encoding, compress = protocol.handshake(request)
+            if response['status'] == 'ok':
+                frames = channel.FrameChannel(conn, buffer)
+                if persistent_connections.submit(handle_persistent, frames, response, encoding, compress, log):
+                    metrics.CONNECTIONS.inc('persistent')
+                    return
+                response = overloaded(log)
+        else:
+            # pass request to the responsible pool:
+            metrics.CONNECTIONS.inc('single')
+            if request_pool(request).submit(respond_and_close, conn, request, log, timer):
+                return
+            response = overloaded(log)
+
+    except RequestSizeExceeded:
+        log.error('request size limit exceeded by client')
+        response = utility.server_error('request size exceeded by client')
+    except socket.timeout:
+        log.error('connection timed out on server')
+        response = utility.server_error('connection timed out on server')
+    except ClientDisconnect:
+        log.error('disconnect by client')
+        response = None
+    except ConnectionResetError:
+        log.error('connection reset by client')
+        response = None
+    except UnicodeDecodeError:
+        log.error('could not decode binary data received from client')
+        response = utility.server_error('could not decode binary data received from client')
+    except json.decoder.JSONDecodeError:
+        log.error('corrupt json received from client')
+        response = utility.server_error('corrupt json received from client')
+    except:
+        log.error('unexpected exception on the server:\n' + traceback.format_exc())
+        response = utility.server_error('internal error')
+
+    if response:
+        response = protocol.encode_response(response, log)
+        log.info('responding: %s', response)
+        refuse(conn, response)
+    else:
+        conn.close()
+    log.info('connection closed by server')
+    if not isinstance(request, Exception): timer.report(request, log)
+
+def respond_and_close(conn, request, log, timer):
+    """
+    Pass a request to the framework, send the response to the client and close
+    the connection. This function runs in a thread of a request pool.
+
+    Parameters:
+    conn (socket): connection socket
+    request (dict): client request
+    log (ServerLogger): logger
+    timer (RequestTiming): phases of the request
+    """
+    timer.mark('queue')
+    send_and_close(conn, call_framework(request, log, timer), log, timer)
+    timer.report(request, log)
+
+def send_and_close(conn, response, log, timer=None):
+    """
+    Send a response to the client (protocol version 1) and close the
+    connection.
+
+    Parameters:
+    conn (socket): connection socket
+    response (dict): response, None if there is nothing to send
+    log (ServerLogger): logger
+    timer (RequestTiming): phases of the request (optional)
+    """
+    try:
+        if response:
+            response = protocol.encode_response(response, log)
+            if timer: timer.mark('encode')
+            conn.sendall(response)
+            if timer: timer.mark('send')
+            log.info('responding: %s', response)
+    except BrokenPipeError:
+        log.error('connection closed by client after sending request')
+    except ConnectionResetError:
+        log.error('connection reset by client after sending request')
+    except:
+        log.error('unexpected exception on the server:\n' + traceback.format_exc())
+    finally:
+        conn.close()
+        log.info('connection closed by server')
+
+def handle_persistent(frames, response, encoding, compress, log):
+    """
+    Handling a persistent connection after a successful handshake. This
+    function runs in a thread of the pool of persistent connections until the
+    connection is closed.
+
+    Parameters:
+    frames (FrameChannel): channel
+    response (dict): response to the handshake, None if it has been sent already
+    encoding (codec): codec negotiated in the handshake
+    compress (bool): compress responses, as negotiated in the handshake
+    log (ServerLogger): logger
+    """
+    try:
+        if response: send_response(frames, response, log) # always JSON, uncompressed
+        frames.codec = encoding
+        frames.compress = compress
+        handle_frames(frames, log)
+    except BrokenPipeError:
+        log.error('connection closed by client')
+    except ConnectionResetError:
+        log.error('connection reset by client')
+    except:
+        log.error('unexpected exception on the server:\n' + traceback.format_exc())
+    finally:
+        frames.close() # also ends subscriptions
+        log.info('connection closed by server')
+
+def receive_websocket(conn, ip, port):
+    """
+    Start receiving the HTTP upgrade request of a new WebSocket connection. The
+    request is received by the receiving thread, which then calls function
+    handle_websocket.
+
     Parameters:
     conn (socket): connection socket
     ip (str): client IP
     port (int): client port
     """
     log = utility.ServerLogger(ip, port)
-    log.info('connection accepted')
+    log.info('websocket connection accepted')
+    receiver.receive(conn, websocket.HEADER_TERMINATOR, handle_websocket, log)
+
+def handle_websocket(conn, buffer, request, log):
+    """
+    Handling a WebSocket connection.
+
+    This function checks the HTTP upgrade request (see websocket module). If the
+    connection is upgraded, it is handled like a persistent connection using
+    JSON (see function handle_upgraded). Otherwise, the reply is sent without
+    blocking and the connection is closed. Like function handle_connection, this
+    function runs in the receiving thread.
 
+    Parameters:
+    conn (socket): connection socket
+    buffer (ReceiveBuffer): receive buffer of the connection
+    request (memoryview): upgrade request, or the exception raised while receiving it
+    log (ServerLogger): logger
+    """
+    connections.release() # no longer receiving
     conn.settimeout(config.connection_timeout)
 
     try:
+        if isinstance(request, Exception):
+            raise request
+
+        log_request(log, request)
+        response, upgraded = websocket.handshake(request)
+
+        if upgraded:
+            if persistent_connections.submit(handle_upgraded, conn, buffer, response, log):
+                metrics.CONNECTIONS.inc('websocket')
+                return
+            response = websocket.response(503)
+            overloaded(log)
+
+        log.error('websocket upgrade rejected')
+        refuse(conn, response)
+        log.info('connection closed by server')
+        return
+    except RequestSizeExceeded:
+        log.error('request size limit exceeded by client')
+    except socket.timeout:
+        log.error('connection timed out on server')
+    except (ClientDisconnect, OSError):
+        log.error('disconnect by client')
+    except:
+        log.error('unexpected exception on the server:\n' + traceback.format_exc())
+
+    conn.close()
+    log.info('connection closed by server')
+
+def handle_upgraded(conn, buffer, response, log):
+    """
+    Accept the upgrade of a WebSocket connection and handle it like a
+    persistent connection using JSON (see function handle_persistent), with
+    WebSocket messages instead of frames. This function runs in a thread of the
+    pool of persistent connections until the connection is closed.
+
+    Parameters:
+    conn (socket): connection socket
+    buffer (ReceiveBuffer): receive buffer of the connection
+    response (bytes): HTTP response accepting the upgrade
+    log (ServerLogger): logger
+    """
+    try:
+        conn.sendall(response)
+    except OSError:
+        log.error('disconnect by client')
+        conn.close()
+        log.info('connection closed by server')
+        return
+
+    handle_persistent(channel.WebSocketChannel(conn, buffer), None, codec.JSON, False, log)
+
+def reject_connection(conn, ip, port):
+    """
+    Tell a client that the server is overloaded without receiving its request
+    and close the connection. This function is called by the thread accepting
+    connections, so it must never block.
+
+    Parameters:
+    conn (socket): connection socket
+    ip (str): client IP
+    port (int): client port
+    """
+    log = utility.ServerLogger(ip, port)
+    refuse(conn, protocol.encode_response(overloaded(log), log))
+
+def reject_websocket(conn, ip, port):
+    """
+    Tell a WebSocket client that the server is overloaded without receiving
+    its request and close the connection. See function reject_connection.
+
+    Parameters:
+    conn (socket): connection socket
+    ip (str): client IP
+    port (int): client port
+    """
+    overloaded(utility.ServerLogger(ip, port))
+    refuse(conn, websocket.response(503))
+
+def refuse(conn, response):
+    """
+    Send a short response and close the connection, without ever blocking. Data
+    the client has already sent is read first, so that closing the connection
+    does not reset it before the client could read the response.
+
+    Parameters:
+    conn (socket): connection socket
+    response (bytes): response
+    """
+    try:
+        conn.setblocking(False)
+
+        try:
+            received = 0
+            while received <= config.request_size_max:
+                data = conn.recv(config.buffer_size)
+                if not data: break
+                received += len(data)
+        except BlockingIOError: # no more data available
+            pass
+
+        conn.send(response)
+        conn.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+def request_pool(request):
+    """
+    Return the pool responsible for a request. State and join requests can wait
+    for a long time, so they are processed by a pool of their own. Subscriptions
+    last as long as the connection, so they have a pool of their own as well,
+    and idle subscribers cannot starve state and join requests.
+
+    Parameters:
+    request (dict): client request
+
+    Returns:
+    WorkerPool: pool
+    """
+    if isinstance(request, dict) and request.get('type') in ('state', 'join'):
+        return long_requests
+    if is_subscription(request):
+        return subscriptions
+    return short_requests
+
+def overloaded(log):
+    """
+    Return the error message sent to clients while the server is saturated.
+
+    Parameters:
+    log (ServerLogger): logger
+
+    Returns:
+    dict: error message
+    """
+    metrics.OVERLOADED.inc()
+    log.error('server overloaded, request rejected')
+    return utility.server_error('overloaded')
+
+def handle_frames(frames, log):
+    """
+    Handling a persistent connection (protocol version 2).
+
+    Requests are received as frames and every response is sent back as a frame.
+    Requests are processed one after the other, unless they carry an ID chosen
+    by the client (key 'id'). Such requests are processed concurrently, and the
+    response, which contains the same ID, is sent as soon as it is available.
+    This way, a client waiting for the game state to change can still submit
+    moves over the same connection. A subscription (see function subscribe)
+    is processed like a request carrying an ID, but it results in any number
+    of responses.
+
+    The connection stays open until the client closes it or until it has been
+    idle for longer than the keep-alive timeout defined in the config module.
+    Errors that leave the connection in an undefined state are reported to the
+    client before the connection is closed. Exceptions raised while sending are
+    handled by the caller.
+
+    Parameters:
+    frames (FrameChannel): channel
+    log (ServerLogger): logger
+    """
+    while True:
+        timer = None
+
         try:
             # receive data from client:
-            request = bytearray()
+            request = frames.receive()
+            if request is None: # closed by client
+                return
 
-            while True:
-                data = conn.recv(config.buffer_size)
-                if not data: raise ClientDisconnect
-                request += data
-                if len(request) > config.request_size_max: raise RequestSizeExceeded
-                if request.endswith(b'EOT\0'): break
+            timer = timing.RequestTiming()
+            log_request(log, request)
+            request = protocol.parse_request(request, frames.codec)
+            timer.mark('decode')
 
-            log.info(f'received {len(request)} bytes: {request}')
-            request = request[:-4] # strip EOT
-            request = json.loads(request.decode())
+            pool = request_pool(request)
+
+            # process requests carrying an ID concurrently:
+            if isinstance(request, dict) and 'id' in request:
+                if is_subscription(request):
+                    job, args = subscribe, (frames, request, log)
+                else:
+                    job, args = respond, (frames, request, log, timer)
+                frames.request_started()
+                if pool.submit(job, *args):
+                    continue
+
+                frames.request_finished()
+                response = dict(overloaded(log), id=request['id'])
 
             # pass request to the framework:
-            try:
-                response = framework.handle_request(request)
-            except:
-                log.error('unexpected exception in the framework:\n' + traceback.format_exc())
-                response = utility.framework_error('internal error')
+            elif pool.admit():
+                try:
+                    response = call_framework(request, log, timer)
+                finally:
+                    pool.release()
+            else:
+                response = overloaded(log)
 
+        except ConnectionIdle:
+            if frames.busy(): continue
+            log.info('closing idle connection')
+            return
         except RequestSizeExceeded:
             log.error('request size limit exceeded by client')
-            response = utility.server_error('request size exceeded by client')
+            send_response(frames, utility.server_error('request size exceeded by client'), log)
+            return
         except socket.timeout:
+            log.error('connection timed out on server')
+            send_response(frames, utility.server_error('connection timed out on server'), log)
+            return
+        except ClientDisconnect:
+            log.error('disconnect by client')
+            return
+        except UnicodeDecodeError:
+            log.error('could not decode binary data received from client')
+            response = utility.server_error('could not decode binary data received from client')
+        except json.decoder.JSONDecodeError:
+            log.error('corrupt json received from client')
+            response = utility.server_error('corrupt json received from client')
+        except codec.DecodeError:
+            log.error('corrupt data received from client')
+            response = utility.server_error('corrupt data received from client')
+
+        # send response to client:
+        send_response(frames, response, log, timer)
+        if timer: timer.report(request, log)
+
+def respond(frames, request, log, timer):
+    """
+    Process a request carrying an ID and send the response, which contains the
+    same ID. This function runs in a thread of a request pool.
+
+    Parameters:
+    frames (FrameChannel): channel
+    request (dict): client request
+    log (ServerLogger): logger
+    timer (RequestTiming): phases of the request
+    """
+    timer.mark('queue')
+
+    try:
+        response = call_framework(request, log, timer)
+        response['id'] = request['id']
+        send_response(frames, response, log, timer)
+        timer.report(request, log)
+    except OSError:
+        log.error('connection closed before the response could be sent')
+    except:
+        log.error('unexpected exception on the server:\n' + traceback.format_exc())
+    finally:
+        frames.request_finished()
+
+def subscribe(frames, request, log):
+    """
+    Push the game state to a client whenever it changes. This function runs in
+    a thread of the pool of subscriptions until the connection is closed or an
+    error occurs. The state requests are not counted towards the limit of
+    long-poll requests.
+
+    A subscription is a series of conditional state requests (see function
+    GameSession.versioned_state), each one passing the version of the state
+    pushed before. Every state is sent as a response carrying the ID of the
+    subscription. The next state is only retrieved once the previous one has
+    been sent. States changing in the meantime are coalesced into the newest
+    one, so the server never buffers more than a single state for a client that
+    reads slowly (backpressure). Waiting is interrupted regularly to notice
+    closed connections (see config module).
+
+    Parameters:
+    frames (FrameChannel): channel
+    request (dict): subscription request
+    log (ServerLogger): logger
+    """
+    state_request = subscription_state_request(request)
+
+    try:
+        while not frames.closed:
+            response = call_framework(state_request, log)
+            if not advance_subscription(state_request, response):
+                continue # state unchanged
+
+            response['id'] = request['id']
+            send_response(frames, response, log)
+            if response['status'] != 'ok':
+                return
+    except OSError:
+        log.error('connection closed during subscription')
+    except:
+        log.error('unexpected exception on the server:\n' + traceback.format_exc())
+    finally:
+        frames.request_finished()
+
+def is_subscription(request):
+    """
+    Check if a request is a subscription.
+
+    Parameters:
+    request: client request
+
+    Returns:
+    bool: True, if the request is a subscription
+    """
+    return isinstance(request, dict) and request.get('type') == 'subscribe'
+
+def subscription_state_request(request):
+    """
+    Convert a subscription into a conditional state request. A subscription
+    contains the same keys as a state request. The optional key since_version
+    lets the client continue from a state it has already received.
+
+    Parameters:
+    request (dict): subscription request
+
+    Returns:
+    dict: state request
+    """
+    state_request = dict(request, type='state', timeout=config.subscription_check_interval)
+    del state_request['id']
+    state_request.setdefault('since_version', -1)
+    return state_request
+
+def advance_subscription(state_request, response):
+    """
+    Check if a response to a conditional state request has to be pushed to the
+    subscriber. If so, the state request is updated to wait for the next state.
+
+    Parameters:
+    state_request (dict): state request of the subscription
+    response (dict): response to the state request
+
+    Returns:
+    bool: True, if the response has to be pushed
+    """
+    if response['status'] != 'ok':
+        return True
+
+    data = response['data']
+    if data['version'] == state_request['since_version']: # timeout expired
+        return False
+
+    state_request['since_version'] = data['version']
+    if 'base' in data: state_request['base'] = data['base'] # delta mode
+    return True
+
+def send_response(frames, response, log, timer=None):
+    """
+    Send a response as a frame (protocol version 2).
+
+    Parameters:
+    frames (FrameChannel): channel
+    response (dict): response
+    log (ServerLogger): logger
+    timer (RequestTiming): phases of the request (optional)
+    """
+    response = protocol.encode_response(response, log, frames.codec)
+    if timer: timer.mark('encode')
+    frames.send(response)
+    if timer: timer.mark('send')
+    log.info('responding: %s', response)
+
+def log_request(log, request):
+    """
+    Log a request received from a client. The request is only copied for
+    logging, if server information is logged at all.
+
+    Parameters:
+    log (ServerLogger): logger
+    request (memoryview): request
+    """
+    if config.log_server_info:
+        log.info('received %s bytes: %s', len(request), bytes(request))
+
+def call_framework(request, log, timer=None):
+    """
+    Pass a request to the framework. A request for a game session owned by
+    another worker process is forwarded to that worker instead.
+
+    Parameters:
+    request (dict): client request
+    log (ServerLogger): logger
+    timer (RequestTiming): phases of the request (optional)
+
+    Returns:
+    dict: response
+    """
+    if is_subscription(request):
+        return no_subscription(log)
+
+    if timer: token = timer.activate()
+
+    try:
+        if shards and not shards.local(request):
+            response = shards.forward(request).result()
+        else:
+            response = framework.handle_request(request)
+    except:
+        log.error('unexpected exception in the framework:\n' + traceback.format_exc())
+        response = utility.framework_error('internal error')
+    finally:
+        if timer: timer.deactivate(token)
+
+    if timer: add_timing(request, response, timer)
+    return response
+
+def add_timing(request, response, timer):
+    """
+    Mark the end of the framework phase of a request and add the phases to the
+    response, if the client asked for them (key 'timing', see timing module).
+
+    Parameters:
+    request (dict): client request
+    response (dict): response
+    timer (RequestTiming): phases of the request
+    """
+    timer.mark('framework')
+    if isinstance(request, dict) and request.get('timing') is True:
+        response['timing'] = timer.phases()
+
+def no_subscription(log):
+    """
+    Return the error message sent to clients subscribing without a persistent
+    connection or without a request ID.
+
+    Parameters:
+    log (ServerLogger): logger
+
+    Returns:
+    dict: error message
+    """
+    log.error('subscription rejected')
+    return utility.server_error('subscriptions require a persistent connection and a request ID')
+
+async def handle_connection_async(conn, ip, port):
+    """
+    Handling a connection (coroutine).
+
+    This is the asyncio counterpart of function handle_connection. The protocol
+    is exactly the same. While a client waits for the game state to change, the
+    coroutine is parked in the event loop instead of blocking a thread. See
+    function handle_connection for details.
+
+    The connection has been admitted by the connection pool, which is released
+    when the connection is closed or becomes a persistent connection, since
+    persistent connections have a limit of their own.
+
+    Parameters:
+    conn (socket): connection socket (non-blocking)
+    ip (str): client IP
+    port (int): client port
+    """
+    log = utility.ServerLogger(ip, port)
+    log.info('connection accepted')
+
+    loop = asyncio.get_running_loop()
+    buffer = channel.ReceiveBuffer()
+    admitted = True # connection still counts towards the limit of the connection pool
+    timer = timing.RequestTiming()
+    request = None
+
+    try:
+        try:
+            # receive data from client:
+            request = await channel.receive_request_async(conn, buffer)
+            timer.mark('receive')
+            log_request(log, request)
+            request = protocol.parse_request(request)
+            timer.mark('decode')
+
+            if protocol.is_handshake(request):
+                # switch to a persistent connection:
+                response, encoding, compress = protocol.handshake(request)
+                if response['status'] == 'ok':
+                    if persistent_connections.admit():
+                        connections.release()
+                        admitted = False
+                        metrics.CONNECTIONS.inc('persistent')
+                        frames = channel.AsyncFrameChannel(conn, buffer)
+                        try:
+                            await send_response_async(frames, response, log) # always JSON, uncompressed
+                            frames.codec = encoding
+                            frames.compress = compress
+                            await handle_frames_async(frames, log)
+                        finally:
+                            frames.cancel()
+                            persistent_connections.release()
+                        return
+                    response = overloaded(log)
+            else:
+                # pass request to the framework:
+                metrics.CONNECTIONS.inc('single')
+                response = await call_framework_async(request, log, timer)
+
+        except RequestSizeExceeded:
+            log.error('request size limit exceeded by client')
+            response = utility.server_error('request size exceeded by client')
+        except (socket.timeout, asyncio.TimeoutError):
             log.error('connection timed out on server')
             response = utility.server_error('connection timed out on server')
         except ClientDisconnect:
@@ -104,44 +799,441 @@ def handle_connection(conn, ip, port):
 
         # send response to client:
         if response:
-            try:
-                response = json.dumps(response).encode()
-            except:
-                log.error('response could not be converted to JSON')
-                response = utility.framework_error('response could not be converted to JSON')
-                response = json.dumps(response).encode()
-
-            conn.sendall(response)
-            log.info(f'responding: {response}')
+            response = protocol.encode_response(response, log)
+            timer.mark('encode')
+            await asyncio.wait_for(loop.sock_sendall(conn, response), config.connection_timeout)
+            timer.mark('send')
+            log.info('responding: %s', response)
+            if request is not None: timer.report(request, log)
 
     except BrokenPipeError:
         log.error('connection closed by client after sending request')
     except ConnectionResetError:
         log.error('connection reset by client after sending request')
+    except (socket.timeout, asyncio.TimeoutError):
+        log.error('connection timed out on server while sending response')
     except:
         log.error('unexpected exception on the server:\n' + traceback.format_exc())
     finally:
+        if admitted: connections.release()
         conn.close()
         log.info('connection closed by server')
 
+async def handle_websocket_async(conn, ip, port):
+    """
+    Handling a WebSocket connection (coroutine). See function handle_websocket
+    for details.
+
+    Parameters:
+    conn (socket): connection socket (non-blocking)
+    ip (str): client IP
+    port (int): client port
+    """
+    log = utility.ServerLogger(ip, port)
+    log.info('websocket connection accepted')
+
+    loop = asyncio.get_running_loop()
+    buffer = channel.ReceiveBuffer()
+    admitted = True # connection still counts towards the limit of the connection pool
+
+    try:
+        # receive upgrade request from client:
+        request = await channel.receive_request_async(conn, buffer, websocket.HEADER_TERMINATOR)
+        log_request(log, request)
+        response, upgraded = websocket.handshake(request)
+
+        if upgraded and not persistent_connections.admit():
+            response, upgraded = websocket.response(503), False
+            overloaded(log)
+
+        await asyncio.wait_for(loop.sock_sendall(conn, response), config.connection_timeout)
+
+        if upgraded:
+            connections.release()
+            admitted = False
+            metrics.CONNECTIONS.inc('websocket')
+            frames = channel.AsyncWebSocketChannel(conn, buffer)
+            try:
+                await handle_frames_async(frames, log)
+            finally:
+                frames.cancel()
+                persistent_connections.release()
+        else:
+            log.error('websocket upgrade rejected')
+
+    except RequestSizeExceeded:
+        log.error('request size limit exceeded by client')
+    except (socket.timeout, asyncio.TimeoutError):
+        log.error('connection timed out on server')
+    except (ClientDisconnect, OSError):
+        log.error('disconnect by client')
+    except:
+        log.error('unexpected exception on the server:\n' + traceback.format_exc())
+    finally:
+        if admitted: connections.release()
+        conn.close()
+        log.info('connection closed by server')
+
+async def handle_frames_async(frames, log):
+    """
+    Handling a persistent connection (coroutine). Requests carrying an ID are
+    processed in separate tasks. See function handle_frames for details.
+
+    Parameters:
+    frames (AsyncFrameChannel): channel
+    log (ServerLogger): logger
+    """
+    while True:
+        timer = None
+
+        try:
+            # receive data from client:
+            request = await frames.receive()
+            if request is None: # closed by client
+                return
+
+            timer = timing.RequestTiming()
+            log_request(log, request)
+            request = protocol.parse_request(request, frames.codec)
+            timer.mark('decode')
+
+            # process requests carrying an ID concurrently:
+            if isinstance(request, dict) and 'id' in request:
+                if is_subscription(request):
+                    frames.start(subscribe_async(frames, request, log))
+                else:
+                    frames.start(respond_async(frames, request, log, timer))
+                continue
+
+            # pass request to the framework:
+            response = await call_framework_async(request, log, timer)
+
+        except ConnectionIdle:
+            if frames.busy(): continue
+            log.info('closing idle connection')
+            return
+        except RequestSizeExceeded:
+            log.error('request size limit exceeded by client')
+            await send_response_async(frames, utility.server_error('request size exceeded by client'), log)
+            return
+        except (socket.timeout, asyncio.TimeoutError):
+            log.error('connection timed out on server')
+            await send_response_async(frames, utility.server_error('connection timed out on server'), log)
+            return
+        except ClientDisconnect:
+            log.error('disconnect by client')
+            return
+        except UnicodeDecodeError:
+            log.error('could not decode binary data received from client')
+            response = utility.server_error('could not decode binary data received from client')
+        except json.decoder.JSONDecodeError:
+            log.error('corrupt json received from client')
+            response = utility.server_error('corrupt json received from client')
+        except codec.DecodeError:
+            log.error('corrupt data received from client')
+            response = utility.server_error('corrupt data received from client')
+
+        # send response to client:
+        await send_response_async(frames, response, log, timer)
+        if timer: timer.report(request, log)
+
+async def respond_async(frames, request, log, timer):
+    """
+    Process a request carrying an ID and send the response (coroutine). See
+    function respond for details.
+
+    Parameters:
+    frames (AsyncFrameChannel): channel
+    request (dict): client request
+    log (ServerLogger): logger
+    timer (RequestTiming): phases of the request
+    """
+    timer.mark('queue')
+
+    try:
+        response = await call_framework_async(request, log, timer)
+        response['id'] = request['id']
+        await send_response_async(frames, response, log, timer)
+        timer.report(request, log)
+    except (OSError, asyncio.TimeoutError):
+        log.error('connection closed before the response could be sent')
+    except asyncio.CancelledError:
+        raise
+    except:
+        log.error('unexpected exception on the server:\n' + traceback.format_exc())
+
+async def subscribe_async(frames, request, log):
+    """
+    Push the game state to a client whenever it changes (coroutine). The task
+    is cancelled when the connection is closed. See function subscribe for
+    details. The subscription counts towards the limit of subscriptions until
+    it ends, its state requests are not counted separately.
+
+    Parameters:
+    frames (AsyncFrameChannel): channel
+    request (dict): subscription request
+    log (ServerLogger): logger
+    """
+    state_request = subscription_state_request(request)
+    admitted = subscriptions.admit()
+
+    try:
+        if not admitted:
+            await send_response_async(frames, dict(overloaded(log), id=request['id']), log)
+            return
+
+        while True:
+            response = await call_framework_async(state_request, log, admitted=True)
+            if not advance_subscription(state_request, response):
+                continue # state unchanged
+
+            response['id'] = request['id']
+            await send_response_async(frames, response, log)
+            if response['status'] != 'ok':
+                return
+    except (OSError, asyncio.TimeoutError):
+        log.error('connection closed during subscription')
+    except asyncio.CancelledError:
+        raise
+    except:
+        log.error('unexpected exception on the server:\n' + traceback.format_exc())
+    finally:
+        if admitted: subscriptions.release()
+
+async def send_response_async(frames, response, log, timer=None):
+    """
+    Send a response as a frame (coroutine).
+
+    Parameters:
+    frames (AsyncFrameChannel): channel
+    response (dict): response
+    log (ServerLogger): logger
+    timer (RequestTiming): phases of the request (optional)
+    """
+    response = protocol.encode_response(response, log, frames.codec)
+    if timer: timer.mark('encode')
+    await frames.send(response)
+    if timer: timer.mark('send')
+    log.info('responding: %s', response)
+
+async def call_framework_async(request, log, timer=None, admitted=False):
+    """
+    Pass a request to the framework (coroutine), provided the pool responsible
+    for the request admits it (see function request_pool). See function
+    call_framework for details.
+
+    Parameters:
+    request (dict): client request
+    log (ServerLogger): logger
+    timer (RequestTiming): phases of the request (optional)
+    admitted (bool): True, if the request counts towards a limit already, like the state requests of a subscription (optional)
+
+    Returns:
+    dict: response
+    """
+    if is_subscription(request):
+        return no_subscription(log)
+
+    pool = None if admitted else request_pool(request)
+    if pool and not pool.admit():
+        return overloaded(log)
+
+    if timer: token = timer.activate()
+
+    try:
+        if shards and not shards.local(request):
+            future = await asyncio.get_running_loop().run_in_executor(None, shards.forward, request) # may connect
+            response = await asyncio.wrap_future(future)
+        else:
+            response = await framework.handle_request_async(request)
+    except asyncio.CancelledError: # connection closed
+        raise
+    except:
+        log.error('unexpected exception in the framework:\n' + traceback.format_exc())
+        response = utility.framework_error('internal error')
+    finally:
+        if pool: pool.release()
+        if timer: timer.deactivate(token)
+
+    if timer: add_timing(request, response, timer)
+    return response
+
+def serve_threading(listeners, websocket_listener):
+    """
+    Accept connections on all listening sockets, each in a separate thread.
+
+    Parameters:
+    listeners (list): listening sockets
+    websocket_listener (socket): listening socket for WebSocket clients, None if disabled
+    """
+    if websocket_listener:
+        threading.Thread(target=accept_connections, args=(websocket_listener, receive_websocket, reject_websocket),
+                         daemon=True).start()
+
+    for sd in listeners[1:]:
+        threading.Thread(target=accept_connections, args=(sd,), daemon=True).start()
+
+    accept_connections(listeners[0])
+
+def accept_connections(sd, receive=receive_connection, reject=reject_connection):
+    """
+    Accept connections and pass each of them to the receiving thread. If the
+    limit for connections is reached, the connection is rejected.
+
+    Parameters:
+    sd (socket): listening socket
+    receive (function): starts receiving on a connection (optional, default: function receive_connection)
+    reject (function): rejects a connection (optional, default: function reject_connection)
+    """
+    while True:
+        # accept a connection:
+        conn, client = sd.accept()
+        ip, port = client_address(client)
+
+        # receive the request in the receiving thread:
+        if connections.admit():
+            receive(conn, ip, port)
+        else:
+            reject(conn, ip, port)
+
+async def serve_asyncio(listeners, websocket_listener):
+    """
+    Accept connections on all listening sockets (coroutine).
+
+    Parameters:
+    listeners (list): listening sockets
+    websocket_listener (socket): listening socket for WebSocket clients, None if disabled
+    """
+    accepting = [accept_connections_async(sd) for sd in listeners]
+    if websocket_listener:
+        accepting.append(accept_connections_async(websocket_listener, handle_websocket_async, reject_websocket))
+
+    await asyncio.gather(*accepting)
+
+async def accept_connections_async(sd, handle=handle_connection_async, reject=reject_connection):
+    """
+    Accept connections and handle each of them in a separate coroutine. If the
+    limit for connections is reached, the connection is rejected.
+
+    Parameters:
+    sd (socket): listening socket
+    handle (function): coroutine function handling a connection (optional, default: handle_connection_async)
+    reject (function): rejects a connection (optional, default: function reject_connection)
+    """
+    loop = asyncio.get_running_loop()
+    sd.setblocking(False)
+    tasks = set() # keep references to running tasks
+
+    while True:
+        # accept a connection:
+        conn, client = await loop.sock_accept(sd)
+        conn.setblocking(False)
+        ip, port = client_address(client)
+
+        if not connections.admit():
+            reject(conn, ip, port)
+            continue
+
+        # handle connection in separate task:
+        task = loop.create_task(handle(conn, ip, port))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+def client_address(client):
+    """
+    Return IP and port of a client. Clients connected via Unix domain socket
+    have neither, they are logged as local clients instead.
+
+    Parameters:
+    client (tuple or str): address returned when accepting a connection
+
+    Returns:
+    tuple(str, int): IP and port
+    """
+    if isinstance(client, tuple):
+        return client[:2]
+
+    return 'local', 0
+
+def listen(port, reuse_port):
+    """
+    Create a listening socket for the IP defined in the config module.
+
+    Parameters:
+    port (int): port number
+    reuse_port (bool): if True, several sockets can listen on the same port
+
+    Returns:
+    socket: listening socket
+    """
+    sd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sd.bind((config.ip, port))
+    sd.listen()
+    return sd
+
+def listen_unix(path):
+    """
+    Create a listening Unix domain socket. A socket file left behind by a
+    previous run is removed first.
+
+    Parameters:
+    path (str): path of the socket file
+
+    Returns:
+    socket: listening socket
+    """
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+
+    sd = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sd.bind(path)
+    sd.listen()
+    return sd
+
 # start the server:
 print('This is free software with ABSOLUTELY NO WARRANTY.')
 try:
-    # create listening socket:
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sd:
-        sd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sd.bind((config.ip, config.port))
-        sd.listen()
+    processes = config.worker_processes
+    if processes > 1 and not sharding.supported():
+        print('Multiple worker processes are not supported on this system, using a single process')
+        processes = 1
 
-        print(f'Listening on {config.ip}:{config.port}')
+    # create listening sockets, one per worker process and port:
+    listeners = [[listen(config.port, processes > 1)] for _ in range(processes)]
+    print(f'Listening on {config.ip}:{config.port} ({config.server_mode} mode, {processes} worker process(es))')
 
-        while True:
-            # accept a connection:
-            conn, client = sd.accept()
-            ip, port = client
+    if config.unix_socket:
+        local = listen_unix(config.unix_socket) # a single socket shared by all worker processes
+        for sockets in listeners:
+            sockets.append(local)
+        print(f'Listening on {config.unix_socket}')
+
+    if config.websocket_port:
+        for sockets in listeners:
+            sockets.append(listen(config.websocket_port, processes > 1))
+        print(f'Listening for WebSocket clients on {config.ip}:{config.websocket_port}')
+
+    # start worker processes:
+    if processes > 1:
+        shards, public, internal = sharding.start_workers(listeners)
+        listeners = [public[0], internal] + public[1:] if shards else []
+    else:
+        listeners = listeners[0]
+
+    if listeners:
+        framework = game_framework.GameFramework()
+        if config.metrics_port:
+            metrics.serve(config.metrics_port + (shards.index if shards else 0))
+        profiler.install()
+        websocket_listener = listeners.pop() if config.websocket_port else None
 
-            # handle connection in separate thread:
-            t = threading.Thread(target=handle_connection, args=(conn, ip, port), daemon=True)
-            t.start()
+        if config.server_mode == 'asyncio':
+            asyncio.run(serve_asyncio(listeners, websocket_listener))
+        else:
+            receiver = channel.RequestReceiver()
+            serve_threading(listeners, websocket_listener)
 except KeyboardInterrupt:
     print('')
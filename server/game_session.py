@@ -4,12 +4,19 @@ Game session.
 This module provides a class that handles a single game session.
 """
 
+import asyncio
 import copy
 import random
 import string
 import threading
 import time
 
+import codec
+import config
+import delta
+import metrics
+import timing
+
 class GameSession:
     """
     Class GameSession.
@@ -36,10 +43,20 @@ class GameSession:
         self._keys = {} # player ID -> key
         self._last_access = time.time()
         self._lock = threading.Lock()
-        self._state_change = threading.Event()
-        self._no_delay = [] # IDs, players will receive the state immediately
-        self._in_previous_game = [] # IDs, after restart, receive state of previous game once
+        self._player_joins = threading.Condition()
+        self._waiter_lock = threading.Lock()
+        self._state_waiters = [] # (event loop, future), coroutines waiting for a state change
+        self._join_waiters = [] # (event loop, future), coroutines waiting for players to join
+        self._delivered_versions = [-1] * (players * 2) # internal ID -> version of the last state delivered
+        self._in_previous_game = set() # internal IDs, after restart, receive state of previous game once
         self._previous_game = None # previous game instance stored upon restart
+        self._version = 0 # state version, increases with every state change
+        self._previous_version = None # version of the previous game's final state
+        self._version_change = threading.Condition()
+        self._views = {} # view key -> state of the current version shared by all clients with that view
+        self._views_version = None # version of the shared states
+        self._previous_views = {} # view key -> final state of the previous game shared by all clients with that view
+        self._delivered = {} # view key -> {version:state}, last states delivered in delta mode
         self._new_game()
         self._timed_out = False
         self._overwritten = False
@@ -77,7 +94,12 @@ class GameSession:
             key = self._key()
             self._keys[player_id] = key
 
-            return player_id, key, None
+        # wake up clients waiting for this session to fill:
+        with self._player_joins:
+            self._player_joins.notify_all()
+        self._notify_async(self._join_waiters)
+
+        return player_id, key, None
 
     def full(self):
         """
@@ -88,6 +110,38 @@ class GameSession:
         """
         return self._n_players == self._next_id
 
+    def await_full(self, timeout):
+        """
+        Wait for all players to join the game session.
+
+        The calling thread is woken up by joins to this session only, and
+        returns as soon as the session is full or when the timeout is reached.
+
+        Parameters:
+        timeout (float): seconds, measured from the session's last access
+        """
+        start = self.last_access()
+
+        with self._player_joins:
+            self._player_joins.wait_for(self.full, start + timeout - time.time())
+
+    async def await_full_async(self, timeout):
+        """
+        Wait for all players to join the game session (coroutine).
+
+        This is the asyncio counterpart of function await_full. The coroutine
+        returns as soon as the session is full or when the timeout is reached.
+
+        Parameters:
+        timeout (float): seconds, measured from the session's last access
+        """
+        start = self.last_access()
+
+        while not self.full():
+            remaining = start + timeout - time.time()
+            if remaining <= 0: break
+            await self._wait_async(self._join_waiters, self.full, remaining)
+
     def get_id(self, player_name):
         """
         Return player ID and key by name.
@@ -166,12 +220,18 @@ class GameSession:
         Returns:
         error message in case the move was illegal, None otherwise (see AbstractGame.move)
         """
+        start = time.perf_counter()
+        timing.mark('framework')
+
         with self._lock:
+            timing.mark('lock')
             ret = self._game.move(move, player_id)
+            timing.mark('move')
             self._update_last_access()
             self.wake_up_threads()
 
-            return ret
+        metrics.MOVE_DURATION.observe(time.perf_counter() - start, self._game_class.__name__)
+        return ret
 
     def game_state(self, player_id, observer):
         """
@@ -190,17 +250,18 @@ class GameSession:
         - after a move was performed to allow clients to get the new state
         - when the game was restarted and a client still has to get the old game's state
 
-        To achieve this, the thread that changes the state triggers an event to
-        wake up other threads waiting for that event.
+        To achieve this, the version of the last state delivered is stored for
+        each client. A client waits until the session's state version differs
+        from this version. Every state change increases the version and wakes
+        up all waiting threads, so a state change cannot get lost, no matter
+        when it happens.
 
         If the game has been restarted by some client, then for a single time
         the state of the previous game is returned to each client. This is
         necessary for a client to be able to detect the end of the previous
         game. See function restart_game for details.
 
-        A list containing IDs is used for deciding whether the state should be
-        returned immediately or only after it changes. At the same time, the
-        function has to distinguish between active players and passive
+        The function has to distinguish between active players and passive
         observers. Since observers are assigned the same IDs as the observed
         clients, the IDs have to be converted internally. The observer's IDs are
         increased so they come after the regular IDs: 0...n-1 = players,
@@ -213,53 +274,297 @@ class GameSession:
         Returns:
         dict: game state
         """
-        p_id = player_id
-        if observer:
-            p_id += self._n_players # convert observer IDs
+        p_id = self._view_id(player_id, observer)
+
+        # wait for game state to change:
+        with self._version_change:
+            if not self._state_ready(p_id):
+                timing.mark('framework')
+                with metrics.WAITING.track(self._game_class.__name__):
+                    self._version_change.wait_for(lambda: self._state_ready(p_id))
+                timing.mark('wait')
+
+        return self._collect_state(p_id, player_id)
+
+    async def game_state_async(self, player_id, observer):
+        """
+        Retrieve the game state from the game instance (coroutine).
+
+        This is the asyncio counterpart of function game_state. Instead of
+        blocking a thread, a waiting client is parked as a future that is
+        resolved when the game state changes. See function game_state for
+        details.
+
+        Parameters:
+        player_id (int): player ID
+        observer (bool): if True, client requesting the state is a passive observer
+
+        Returns:
+        dict: game state
+        """
+        p_id = self._view_id(player_id, observer)
+
+        # wait for game state to change:
+        if not self._state_ready(p_id):
+            timing.mark('framework')
+            with metrics.WAITING.track(self._game_class.__name__):
+                await self._wait_async(self._state_waiters, lambda: self._state_ready(p_id))
+            timing.mark('wait')
+
+        return self._collect_state(p_id, player_id)
+
+    def versioned_state(self, player_id, since_version, timeout=None):
+        """
+        Retrieve the game state, if its version differs from a given version.
+
+        Every state change increases the session's state version, which is
+        returned as part of the state. A client passing the version of the last
+        state it received gets the state as soon as it is newer. Unlike function
+        game_state, no information about clients is stored in the session, so
+        a request can be repeated safely, and any number of clients can share a
+        view.
+
+        A client that has not received any state yet passes a negative version
+        and gets the current state right away. If the game has been restarted,
+        and the client has not received the final state of the previous game
+        yet, that state is returned first (see function restart_game).
+
+        Parameters:
+        player_id (int): player ID
+        since_version (int): version of the last state received by the client
+        timeout (float): seconds to wait at most (optional, default: no timeout)
+
+        Returns:
+        dict: game state, the state is unchanged if the timeout expired
+        """
+        # wait for game state to change:
+        with self._version_change:
+            if self._version == since_version:
+                timing.mark('framework')
+                with metrics.WAITING.track(self._game_class.__name__):
+                    self._version_change.wait_for(lambda: self._version != since_version, timeout)
+                timing.mark('wait')
+
+        return self._collect_versioned_state(player_id, since_version)
+
+    async def versioned_state_async(self, player_id, since_version, timeout=None):
+        """
+        Retrieve the game state, if its version differs from a given version
+        (coroutine). See function versioned_state for details.
+
+        Parameters:
+        player_id (int): player ID
+        since_version (int): version of the last state received by the client
+        timeout (float): seconds to wait at most (optional, default: no timeout)
+
+        Returns:
+        dict: game state, the state is unchanged if the timeout expired
+        """
+        ready = lambda: self._version != since_version
+        deadline = None if timeout is None else time.monotonic() + timeout
 
         # wait for game state to change:
-        if p_id not in self._no_delay and p_id not in self._in_previous_game:
-            self._state_change.clear()
-            self._state_change.wait()
+        if not ready():
+            timing.mark('framework')
+            with metrics.WAITING.track(self._game_class.__name__):
+                while not ready():
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0: break
+                    await self._wait_async(self._state_waiters, ready, remaining)
+            timing.mark('wait')
+
+        return self._collect_versioned_state(player_id, since_version)
 
+    def _view_id(self, player_id, observer):
+        """
+        Convert a player ID into an internal ID that distinguishes players from
+        observers. See function game_state for details.
+
+        Parameters:
+        player_id (int): player ID
+        observer (bool): if True, client is a passive observer
+
+        Returns:
+        int: internal ID
+        """
+        if observer:
+            return player_id + self._n_players # convert observer IDs
+        return player_id
+
+    def _state_ready(self, p_id):
+        """
+        Check if the state can be returned without waiting for a change.
+
+        Parameters:
+        p_id (int): internal ID (see function _view_id)
+
+        Returns:
+        bool: True, if the state can be returned immediately
+        """
+        return self._delivered_versions[p_id] != self._version or p_id in self._in_previous_game
+
+    def _collect_state(self, p_id, player_id):
+        """
+        Return the state after waiting for a state change (if necessary).
+
+        Parameters:
+        p_id (int): internal ID (see function _view_id)
+        player_id (int): player ID
+
+        Returns:
+        dict: game state
+        """
         # if required, return the previous game's state:
-        # (this must NOT be done inside the lock below to avoid deadlocks)
         if p_id in self._in_previous_game:
-            self._in_previous_game.remove(p_id)
-            return self._assemble_state(self._previous_game, player_id)
+            self._in_previous_game.discard(p_id)
+            with self._lock:
+                return self._previous_state(player_id)
 
         # return current game's state:
+        timing.mark('framework')
+        with self._lock:
+            timing.mark('lock')
+            self._update_last_access()
+            self._delivered_versions[p_id] = self._version
+            return self._shared_state(player_id)
+
+    def _collect_versioned_state(self, player_id, since_version):
+        """
+        Return the state after waiting for a newer version (if necessary).
+
+        Parameters:
+        player_id (int): player ID
+        since_version (int): version of the last state received by the client
+
+        Returns:
+        dict: game state
+        """
+        timing.mark('framework')
         with self._lock:
+            timing.mark('lock')
+
+            # if the client missed the end of the previous game, return its final state:
+            previous_version = self._previous_version
+            if previous_version is not None and 0 <= since_version < previous_version:
+                return self._previous_state(player_id)
+
+            # return current game's state:
             self._update_last_access()
-            self._no_delay.remove(p_id)
-            return self._assemble_state(self._game, player_id)
+            return self._shared_state(player_id)
+
+    def delta_state(self, player_id, state, base):
+        """
+        Return the difference between a state and a state delivered before.
+
+        The states of the last few versions delivered in delta mode are stored
+        per view (see AbstractGame.view), so they are shared by all clients
+        with that view, like the observers of a player. The version of a state
+        serves as its ID, which is sent to the client. If the state with the ID
+        the client passes as base is still stored, only the difference is
+        returned (see delta module). Otherwise, the full state is returned.
+
+        States returned by the session are snapshots that are never modified
+        (see function _assemble_state), so they are stored without copying
+        them.
+
+        Parameters:
+        player_id (int): player ID
+        state (dict): game state returned by the session
+        base (int): ID of the state the client has, None if there is none
+
+        Returns:
+        dict: {'base':ID, 'delta':difference} or {'base':ID, 'state':full state}
+        """
+        version = state['version']
+
+        with self._lock:
+            delivered = self._delivered.setdefault(self._game.view(player_id), {})
+            previous = delivered.get(base)
+            if version not in delivered:
+                delivered[version] = state
+                if len(delivered) > config.delta_versions:
+                    del delivered[min(delivered)]
+
+        if previous is None:
+            return {'base':version, 'state':state}
+
+        return {'base':version, 'delta':delta.diff(previous, state)}
+
+    def _shared_state(self, player_id):
+        """
+        Return the current game's state, which is assembled only once per state
+        version for all clients sharing a view (see AbstractGame.view). The
+        state is then encoded only once as well (see codec.Shared). This
+        function must be called while holding the session's lock.
+
+        Parameters:
+        player_id (int): player ID
+
+        Returns:
+        Shared: game state, must not be modified
+        """
+        if self._views_version != self._version:
+            self._views = {}
+            self._views_version = self._version
+
+        view = self._game.view(player_id)
+        state = self._views.get(view)
+        if state is None:
+            state = self._views[view] = self._assemble_state(self._game, player_id, self._version)
+        return state
 
-    def _assemble_state(self, game, player_id):
+    def _previous_state(self, player_id):
+        """
+        Return the previous game's final state, which is assembled only once per
+        view, like the current game's state (see function _shared_state). This
+        function must be called while holding the session's lock.
+
+        Parameters:
+        player_id (int): player ID
+
+        Returns:
+        Shared: game state, must not be modified
+        """
+        view = self._previous_game.view(player_id)
+        state = self._previous_views.get(view)
+        if state is None:
+            state = self._previous_views[view] = self._assemble_state(self._previous_game, player_id, self._previous_version)
+        return state
+
+    def _assemble_state(self, game, player_id, version):
         """
         Prepare the state to be returned to the client by adding current
-        player(s) and game status.
+        player(s), game status and state version.
+
+        The state is a snapshot, taken while the game cannot change. Games may
+        return their own data structures, like a list they keep appending to,
+        which would otherwise change while the state is compared or encoded
+        after the session's lock has been released. Taking the snapshot costs
+        time proportional to the size of the state, so it is only done once per
+        version and view (see functions _shared_state and _previous_state).
+        This function must be called while holding the session's lock.
 
         Parameters:
         game (AbstractGame): game instance
         player_id (int): player ID
+        version (int): state version
 
         Returns:
-        dict: game state
+        Shared: game state, must not be modified
         """
-        state = game.state(player_id)
+        state = copy.deepcopy(game.state(player_id))
         state['current'] = self.current_player(game)
         state['gameover'] = game.game_over()
-        return state
+        state['version'] = version
+        return codec.Shared(state)
 
     def _new_game(self):
         """
-        Instantiate a new game and add IDs to the no-delay list so that all
-        clients can retrieve the state even before any move has been performed.
-        The observer's IDs are appended to the regular IDs. See function
-        game_state for details.
+        Instantiate a new game. No client has received a state of this game
+        yet, so all clients can retrieve the state even before any move has
+        been performed. See function game_state for details.
         """
         self._game = self._game_class(self._n_players)
-        self._no_delay = self._all_ids()
 
     def restart_game(self, player_id):
         """
@@ -268,24 +573,31 @@ class GameSession:
         The game instance is replaced with a new one. The old instance is
         stored. This is necessary to allow the other clients to detect the end
         of the previous game. Otherwise, they would suddenly find themselves in
-        a new game without being notified about it. To achieve this, a list of
+        a new game without being notified about it. To achieve this, a set of
         client IDs is created upon restarting a game. When a client then calls
         the state function, the state of the previous game is returned a single
-        time, and the client's ID is removed from the list. From then on, the
+        time, and the client's ID is removed from the set. From then on, the
         client will receive the game state of the new game instance.
 
+        Clients requesting versioned states (see function versioned_state) need
+        no such set. They receive the previous game's state, if the version
+        they pass is older than the version of the previous game's final state.
+
         Parameters:
         player_id (int): player ID
         """
-        # store old game instance and a list of player IDs:
-        if self._game.game_over():
-            self._in_previous_game = self._all_ids()
-            self._in_previous_game.remove(player_id) # exclude client that restarted the game
-            self._previous_game = copy.deepcopy(self._game)
-
-        # create new game instance and wake up waiting threads:
-        self._new_game()
-        self.wake_up_threads()
+        with self._lock:
+            # store old game instance and a set of player IDs:
+            if self._game.game_over():
+                self._in_previous_game = set(range(self._n_players * 2))
+                self._in_previous_game.discard(player_id) # exclude client that restarted the game
+                self._previous_game = copy.deepcopy(self._game)
+                self._previous_version = self._version
+                self._previous_views = {}
+
+            # create new game instance and wake up waiting threads:
+            self._new_game()
+            self.wake_up_threads()
 
     def _key(self, length=5):
         """
@@ -315,10 +627,57 @@ class GameSession:
 
     def wake_up_threads(self):
         """
-        Wake up other threads waiting for the game state to change.
+        Wake up other threads and coroutines waiting for the game state to
+        change. The state version is increased.
+        """
+        with self._version_change:
+            self._version += 1
+            self._version_change.notify_all()
+
+        self._notify_async(self._state_waiters)
+
+    async def _wait_async(self, waiters, ready, timeout=None):
+        """
+        Park the calling coroutine until it is notified or the timeout expires.
+
+        The future is registered before the condition is checked, so that a
+        notification sent by another thread in between cannot get lost.
+
+        Parameters:
+        waiters (list): list to register the future in
+        ready (function): returns True, if there is no need to wait
+        timeout (float): seconds (optional, default: no timeout)
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        with self._waiter_lock:
+            waiters.append((loop, future))
+
+        try:
+            if not ready():
+                await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._waiter_lock:
+                if (loop, future) in waiters:
+                    waiters.remove((loop, future))
+
+    def _notify_async(self, waiters):
         """
-        self._no_delay = self._all_ids()
-        self._state_change.set()
+        Resolve the futures of all coroutines registered in a list of waiters.
+        This function can be called from any thread.
+
+        Parameters:
+        waiters (list): registered waiters
+        """
+        with self._waiter_lock:
+            pending = waiters[:]
+            waiters.clear()
+
+        for loop, future in pending:
+            loop.call_soon_threadsafe(_resolve, future)
 
     def mark_timed_out(self):
         """
@@ -350,11 +709,9 @@ class GameSession:
         """
         return self._overwritten
 
-    def _all_ids(self):
-        """
-        Return a list of all player IDs, including observer IDs.
-
-        Returns:
-        list: all player IDs
-        """
-        return list(range(self._n_players * 2))
+def _resolve(future):
+    """
+    Resolve a future, unless it was cancelled in the meantime.
+    """
+    if not future.done():
+        future.set_result(None)
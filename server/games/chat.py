@@ -45,3 +45,6 @@ class Chat(AbstractGame):
 
     def state(self, player_id):
         return {'messages': self._messages}
+
+    def view(self, player_id):
+        return None # all players receive the same messages
@@ -46,3 +46,6 @@ class Echo(AbstractGame):
 
     def state(self, player_id):
         return {'echo': self._message}
+
+    def view(self, player_id):
+        return None
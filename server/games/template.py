@@ -186,3 +186,24 @@ class MyNewGame(AbstractGame): # TODO pick a proper name
         """
         raise NotImplementedError
         # TODO return a dictionary containing the game state
+
+    def view(self, player_id):
+        """
+        Returns a key identifying the player's view of the game.
+
+        Players with the same key must receive the same state from function
+        state. The framework then calls function state only once per move for
+        all players sharing a view, and the state is encoded only once, no
+        matter how many clients are waiting for it. If the state is the same
+        for all players, a constant like None can be returned. Implementing
+        this function is optional. By default, every player has a view of its
+        own.
+
+        Parameters:
+        player_id (int): player ID (no parameter check required)
+
+        Returns:
+        hashable object: view key
+        """
+        return player_id
+        # TODO optionally return None, if the state is the same for all players
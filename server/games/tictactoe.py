@@ -47,6 +47,18 @@ class TicTacToe(AbstractGame):
         """
         return {'board':self._state.board, 'winner':self._state.winner}
 
+    def view(self, player_id): # override
+        """
+        Both players see the same board.
+
+        Parameters:
+        player_id (int): player ID (unused)
+
+        Returns:
+        None: same view for all players
+        """
+        return None
+
     def move(self, args, player_id): # override
         """
         Submit a move.
@@ -0,0 +1,341 @@
+"""
+Metrics.
+
+This module records what the server is doing, like request rates per request
+type, active game sessions per game, state requests waiting for a move, and
+the time it takes to process moves. Metrics are counters, gauges and latency
+histograms. They are exposed in the Prometheus text format on a separate port
+of the loopback interface (see config module):
+
+    curl http://127.0.0.1:4713/metrics
+
+Recording a value only takes an uncontended lock and a dictionary update, so
+metrics are always recorded. Some gauges, like the number of sessions, are not
+recorded at all but collected when the metrics are requested.
+
+With several worker processes, every worker records its own metrics and serves
+them on a port of its own: the configured port plus the index of the worker.
+"""
+
+import bisect
+import socket
+import threading
+
+import config
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+
+_registry = [] # all metrics, in order of definition
+
+class _Metric:
+    """
+    Base class of all metrics. A metric holds one value per combination of
+    label values.
+    """
+
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        """
+        Parameters:
+        name (str): metric name
+        description (str): help text
+        labels (tuple): label names (optional)
+        """
+        self.name = name
+        self._description = description
+        self._labels = tuple(labels)
+        self._values = {} # label values -> value
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def exposition(self):
+        """
+        Return the metric in the text exposition format.
+
+        Returns:
+        str: metric
+        """
+        lines = [f'# HELP {self.name} {self._description}', f'# TYPE {self.name} {self.type}']
+
+        with self._lock:
+            values = list(self._collect().items())
+
+        for labels, value in sorted(values):
+            lines += self._samples(labels, value)
+
+        return '\n'.join(lines) + '\n'
+
+    def _collect(self):
+        """
+        Return the current values, called while holding the lock.
+
+        Returns:
+        dict: label values -> value
+        """
+        return dict(self._values)
+
+    def _samples(self, labels, value):
+        """
+        Return the sample lines of a single combination of label values.
+
+        Parameters:
+        labels (tuple): label values
+        value: value
+
+        Returns:
+        list: lines
+        """
+        return [f'{self.name}{_format_labels(self._labels, labels)} {_format_value(value)}']
+
+class Counter(_Metric):
+    """
+    A value that only increases, like the number of requests handled.
+    """
+
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        """
+        Increase the counter.
+
+        Parameters:
+        labels (str): label values
+        amount (float): increment (optional, default: 1)
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(_Metric):
+    """
+    A value that can go up and down, like the number of waiting requests.
+    Instead of being recorded, the values can also be provided by a function
+    that is called when the metrics are requested (see function collect_with).
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, description, labels=()):
+        """
+        Parameters:
+        name (str): metric name
+        description (str): help text
+        labels (tuple): label names (optional)
+        """
+        super().__init__(name, description, labels)
+        self._function = None
+
+    def inc(self, *labels, amount=1):
+        """
+        Increase the gauge.
+
+        Parameters:
+        labels (str): label values
+        amount (float): increment (optional, default: 1)
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        """
+        Decrease the gauge.
+
+        Parameters:
+        labels (str): label values
+        amount (float): decrement (optional, default: 1)
+        """
+        self.inc(*labels, amount=-amount)
+
+    def track(self, *labels):
+        """
+        Return a context manager increasing the gauge while it is active.
+
+        Parameters:
+        labels (str): label values
+
+        Returns:
+        context manager
+        """
+        return _Tracking(self, labels)
+
+    def collect_with(self, function):
+        """
+        Provide the values by a function instead of recording them.
+
+        Parameters:
+        function (function): returns a dictionary mapping tuples of label values to values
+        """
+        self._function = function
+
+    def _collect(self):
+        if self._function:
+            return self._function()
+        return dict(self._values)
+
+class Histogram(_Metric):
+    """
+    The distribution of observed values, like the time it takes to process
+    requests. Observations are counted in buckets defined by upper bounds.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Parameters:
+        name (str): metric name
+        description (str): help text
+        labels (tuple): label names (optional)
+        buckets (tuple): upper bounds of the buckets in ascending order (optional)
+        """
+        super().__init__(name, description, labels)
+        self._buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """
+        Record an observation.
+
+        Parameters:
+        value (float): observed value
+        labels (str): label values
+        """
+        index = bisect.bisect_left(self._buckets, value)
+
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self._buckets) + 1) + [0.0] # buckets, +Inf, sum
+            counts[index] += 1
+            counts[-1] += value
+
+    def _collect(self):
+        return {labels: list(counts) for labels, counts in self._values.items()}
+
+    def _samples(self, labels, counts):
+        lines = []
+        cumulative = 0
+
+        for bound, count in zip(self._buckets + ('+Inf',), counts):
+            cumulative += count
+            le = _format_value(bound) if bound != '+Inf' else bound
+            lines.append(f'{self.name}_bucket{_format_labels(self._labels + ("le",), labels + (le,))} {cumulative}')
+
+        lines.append(f'{self.name}_sum{_format_labels(self._labels, labels)} {_format_value(counts[-1])}')
+        lines.append(f'{self.name}_count{_format_labels(self._labels, labels)} {cumulative}')
+        return lines
+
+class _Tracking:
+    """
+    Context manager increasing a gauge while it is active.
+    """
+    def __init__(self, gauge, labels):
+        self._gauge = gauge
+        self._labels = labels
+
+    def __enter__(self):
+        self._gauge.inc(*self._labels)
+
+    def __exit__(self, *exc):
+        self._gauge.dec(*self._labels)
+
+def _format_labels(names, values):
+    """
+    Format label names and values, like {type="move"}.
+
+    Parameters:
+    names (tuple): label names
+    values (tuple): label values
+
+    Returns:
+    str: labels, empty if there are none
+    """
+    if not names:
+        return ''
+
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+def _format_value(value):
+    """
+    Format a sample value.
+
+    Parameters:
+    value (float): value
+
+    Returns:
+    str: value
+    """
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def exposition():
+    """
+    Return all metrics in the text exposition format.
+
+    Returns:
+    str: metrics
+    """
+    return ''.join(metric.exposition() for metric in _registry)
+
+def serve(port):
+    """
+    Serve the metrics over HTTP on the loopback interface in a separate thread.
+    Every request is answered with all metrics, regardless of its path.
+
+    Parameters:
+    port (int): port number
+    """
+    sd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sd.bind(('127.0.0.1', port))
+    sd.listen()
+    threading.Thread(target=_accept, args=(sd,), daemon=True).start()
+
+def _accept(sd):
+    """
+    Accept HTTP requests for metrics and answer them one at a time.
+
+    Parameters:
+    sd (socket): listening socket
+    """
+    while True:
+        conn, _ = sd.accept()
+
+        try:
+            conn.settimeout(config.connection_timeout)
+
+            # receive request header, its content does not matter:
+            request = b''
+            while b'\r\n\r\n' not in request and len(request) < config.buffer_size:
+                data = conn.recv(config.buffer_size)
+                if not data: break
+                request += data
+
+            body = exposition().encode()
+            header = ('HTTP/1.1 200 OK\r\n'
+                      'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                      f'Content-Length: {len(body)}\r\n'
+                      'Connection: close\r\n\r\n')
+            conn.sendall(header.encode() + body)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+# server:
+CONNECTIONS = Counter('game_server_connections_total', 'Connections handled, by protocol', ('protocol',))
+OVERLOADED = Counter('game_server_overloaded_total', 'Requests and connections rejected because the server was overloaded')
+POOL_JOBS = Gauge('game_server_pool_jobs', 'Jobs running or waiting in a pool, by pool', ('pool',))
+
+# framework:
+REQUESTS = Counter('game_server_requests_total', 'Requests handled by the framework, by type and status', ('type', 'status'))
+REQUEST_DURATION = Histogram('game_server_request_duration_seconds', 'Time spent in the framework per request, including waiting, by type', ('type',))
+SESSIONS = Gauge('game_server_sessions', 'Active game sessions, by game', ('game',))
+SESSIONS_EXPIRED = Counter('game_server_sessions_expired_total', 'Game sessions deleted after the timeout for inactive games, by game', ('game',))
+EXPIRY_LAG = Histogram('game_server_session_expiry_lag_seconds', 'Delay between the deadline of an inactive game session and its deletion')
+
+# game sessions:
+MOVE_DURATION = Histogram('game_server_move_duration_seconds', 'Time to process a move, including waiting for the session, by game', ('game',))
+WAITING = Gauge('game_server_waiting_state_requests', 'State requests waiting for the game state to change, by game', ('game',))
@@ -0,0 +1,163 @@
+"""
+Profiler.
+
+This module provides a sampling profiler, which is started and stopped while the
+server is running by sending a signal to the server process (see config module):
+
+    kill -USR1 <pid>
+
+While the profiler is running, a background thread takes a snapshot of the
+stacks of all threads at a fixed interval. Each stack is weighted by the CPU
+time its thread has consumed since the previous snapshot, so threads waiting
+for clients, like state requests waiting for a move, do not show up at all.
+Stacks of threads processing a request in the framework are labelled with the
+request type and the game, so the time spent in Yahtzee.move shows up separately
+from the time spent in Chat.state. All other stacks (receiving, decoding,
+encoding, sending) are labelled as server stacks. In asyncio mode, all requests
+share a single thread, and a stack belongs to the coroutine running at the time
+of the snapshot.
+
+Stopping the profiler writes the profile to a file in the collapsed stack
+format, which can be turned into a flame graph by tools like flamegraph.pl or
+speedscope. Every line holds a stack and the microseconds of CPU time spent in
+it:
+
+    move;Yahtzee;game_server.py:respond;...;yahtzee.py:Yahtzee.move 1250
+
+The CPU time per request type and game is printed as well. With several worker
+processes, the signal sent to the main process is passed on to every worker,
+and each worker writes a profile of its own.
+
+This profiler requires a system providing the CPU time of single threads, like
+Linux.
+"""
+
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+import config
+import game_framework
+
+HANDLERS = (game_framework.GameFramework.handle_request.__code__,
+            game_framework.GameFramework.handle_request_async.__code__) # frames holding the request
+
+_stop = None # event stopping the running profiler, None if the profiler is not running
+
+def supported():
+    """
+    Check if the system supports the profiler.
+
+    Returns:
+    bool: True, if supported
+    """
+    return hasattr(time, 'pthread_getcpuclockid') and hasattr(signal, config.profiler_signal)
+
+def install():
+    """
+    Start and stop the profiler whenever the signal defined in the config
+    module is received. Has no effect, if the profiler is disabled or not
+    supported.
+    """
+    if config.profiler_signal and supported():
+        signal.signal(getattr(signal, config.profiler_signal), lambda *_: toggle())
+
+def toggle():
+    """
+    Start the profiler, or stop it and write the profile, if it is running.
+    """
+    global _stop
+
+    if _stop:
+        _stop.set()
+        _stop = None
+    else:
+        _stop = threading.Event()
+        threading.Thread(target=_run, args=(_stop,), daemon=True).start()
+        print(f'Profiler started (process {os.getpid()})')
+
+def _run(stop):
+    """
+    Take snapshots of all stacks until the profiler is stopped, then write the
+    profile.
+
+    Parameters:
+    stop (Event): stops the profiler
+    """
+    profile = collections.Counter() # stack -> microseconds
+    totals = collections.Counter() # request type and game -> microseconds
+    clocks = {} # thread ID -> CPU time at the previous snapshot (nanoseconds)
+    own = threading.get_ident()
+
+    while not stop.wait(config.profiler_interval / 1000):
+        previous, clocks = clocks, {}
+
+        for ident, frame in sys._current_frames().items():
+            if ident == own: continue
+
+            try:
+                clocks[ident] = time.clock_gettime_ns(time.pthread_getcpuclockid(ident))
+            except OSError: # thread has just finished
+                continue
+
+            used = (clocks[ident] - previous.get(ident, clocks[ident])) // 1000
+            if used:
+                label, stack = _stack(frame)
+                profile[stack] += used
+                totals[label] += used
+
+    _write(profile, totals)
+
+def _stack(frame):
+    """
+    Convert a stack into a line of the collapsed stack format, starting with the
+    request type and the game, or 'server' outside of the framework.
+
+    Parameters:
+    frame (frame): innermost frame of the stack
+
+    Returns:
+    tuple(str, str):
+        str: request type and game, 'server' outside of the framework
+        str: stack, frames separated by semicolons, outermost frame first
+    """
+    names = []
+    label = ['server']
+
+    while frame:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{getattr(code, "co_qualname", code.co_name)}')
+        if code in HANDLERS:
+            request = frame.f_locals.get('request')
+            if isinstance(request, dict):
+                label = [str(request.get('type')), str(request.get('game'))]
+        frame = frame.f_back
+
+    return ' '.join(label), ';'.join(label + names[::-1])
+
+def _write(profile, totals):
+    """
+    Write a profile to a file in the directory defined in the config module and
+    print the CPU time per request type and game.
+
+    Parameters:
+    profile (Counter): stack -> microseconds
+    totals (Counter): request type and game -> microseconds
+    """
+    name = f'profile-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}.collapsed'
+    path = os.path.join(config.profiler_directory, name)
+
+    try:
+        with open(path, 'w') as file:
+            for stack, microseconds in sorted(profile.items()):
+                file.write(f'{stack} {microseconds}\n')
+    except OSError as err:
+        print(f'Profile could not be written: {err}')
+        return
+
+    print(f'Profile written to {path} ({sum(totals.values()) / 1e6:.3f} s CPU time)')
+    for label, microseconds in totals.most_common():
+        print(f'    {label}: {microseconds / 1e6:.3f} s')
@@ -0,0 +1,166 @@
+"""
+Protocol.
+
+This module defines the wire format used between server and clients. Two
+protocol versions are supported:
+
+Version 1 (default): A client opens a connection, sends a JSON encoded request
+terminated by b'EOT\0' and receives the JSON encoded response. The server closes
+the connection after responding. Clients don't have to do anything to use this
+version.
+
+Version 2 (opt-in): A client opens a connection and sends a handshake request
+using version 1 framing:
+
+    {'type':'protocol', 'version':2}
+
+The server replies with a frame and keeps the connection open. From then on,
+both sides exchange frames over that connection, so that a single connection
+carries any number of requests. A frame consists of a header containing the
+length of the payload (4 bytes, unsigned, big-endian) followed by the JSON
+encoded payload. Since the server knows the size of a request in advance, it no
+longer has to scan the data for a terminator.
+
+The handshake can propose codecs for the payloads of all following frames in
+order of preference, for example a compact binary encoding (see codec module):
+
+    {'type':'protocol', 'version':2, 'codecs':['binary', 'json']}
+
+The server picks the first codec it supports and names it in its reply. JSON is
+used, if no codec is proposed. The reply to the handshake itself is always
+encoded as JSON.
+
+A client can also ask for compressed responses by adding 'compression':'zlib'
+to the handshake. The server then compresses responses larger than a threshold
+(see config module). The highest bit of the frame header marks a compressed
+payload, the remaining bits contain its length. Requests are never compressed.
+
+Over a version 2 connection, a client can subscribe to the game state by sending
+a request of type 'subscribe' carrying an ID and the same keys as a state
+request. The server then pushes every new state as a response carrying that ID
+until the connection is closed.
+
+The handshake is a request of its own instead of being part of the join request,
+so that observers and clients reconnecting to a running session can use version
+2 as well. Servers that don't support version 2 reply to the handshake with an
+error message using version 1 framing, which allows clients to fall back to
+version 1.
+"""
+
+import struct
+import zlib
+
+import codec
+import config
+import utility
+
+VERSION = 2 # highest protocol version supported
+TERMINATOR = b'EOT\0' # version 1, terminates a request
+HEADER = struct.Struct('!I') # version 2, frame header containing the payload length
+COMPRESSED = 0x80000000 # version 2, header flag for compressed payloads
+
+def is_handshake(request):
+    """
+    Check if a request is a protocol handshake.
+
+    Parameters:
+    request (dict): client request
+
+    Returns:
+    bool: True, if the request is a handshake
+    """
+    return isinstance(request, dict) and request.get('type') == 'protocol'
+
+def handshake(request):
+    """
+    Negotiate the protocol version of a connection.
+
+    Parameters:
+    request (dict): handshake request
+
+    Returns:
+    tuple(dict, codec, bool):
+        dict: response, status 'ok' if the connection switches to version 2
+        codec: codec for all following frames
+        bool: True, if responses are to be compressed
+    """
+    err = utility.check_dict(request, {'version':int})
+    if err: return utility.server_error(err), None, False
+
+    if request['version'] < 2:
+        return utility.server_error('unsupported protocol version'), None, False
+
+    names = request.get('codecs', [])
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        return utility.server_error('codecs must be a list of names'), None, False
+
+    selected = codec.negotiate(names)
+    compress = request.get('compression') == 'zlib'
+
+    data = {
+        'version':min(request['version'], VERSION),
+        'codec':selected.name,
+        'compression':'zlib' if compress else None}
+
+    return {'status':'ok', 'data':data}, selected, compress
+
+def parse_request(payload, encoding=codec.JSON):
+    """
+    Convert the payload received from a client into a dictionary. The payload
+    is decoded directly, without copying it first.
+
+    Parameters:
+    payload (memoryview): data received, without terminator or header
+    encoding (codec): codec of the connection (optional, default: JSON)
+
+    Returns:
+    dict: request
+
+    Raises:
+    UnicodeDecodeError: if the data is not valid UTF-8 (JSON)
+    json.decoder.JSONDecodeError: if the data is not valid JSON
+    codec.DecodeError: if the data is corrupt (other codecs)
+    """
+    return encoding.decode(payload)
+
+def encode_response(response, log, encoding=codec.JSON):
+    """
+    Convert a response into encoded bytes.
+
+    If the response cannot be converted, an error message is returned instead.
+
+    Parameters:
+    response (dict): response
+    log (ServerLogger): logger
+    encoding (codec): codec of the connection (optional, default: JSON)
+
+    Returns:
+    bytes: response
+    """
+    try:
+        return encoding.encode(response)
+    except:
+        log.error('response could not be converted to JSON')
+        response = utility.framework_error('response could not be converted to JSON')
+        return encoding.encode(response)
+
+def frame(payload, compress=False):
+    """
+    Prepend the frame header to a payload (version 2).
+
+    A payload is only compressed, if it is at least as large as the threshold
+    defined in the config module, and if compression actually saves space.
+
+    Parameters:
+    payload (bytes): payload
+    compress (bool): compress the payload (optional)
+
+    Returns:
+    bytes: frame
+    """
+    if compress and len(payload) >= config.compression_threshold:
+        compressed = zlib.compress(payload, config.compression_level)
+        if len(compressed) < len(payload):
+            return HEADER.pack(len(compressed) | COMPRESSED) + compressed
+
+    return HEADER.pack(len(payload)) + payload
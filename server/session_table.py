@@ -0,0 +1,113 @@
+"""
+Session table.
+
+This module provides the table of active game sessions shared by all threads
+of the framework. The table is split into stripes, each holding the sessions of
+some keys and guarded by a lock of its own, so threads accessing different
+sessions rarely wait for each other, even without a global interpreter lock.
+"""
+
+import threading
+
+class SessionTable:
+    """
+    Class SessionTable.
+
+    The table maps keys (game name and token) to game sessions. The stripe of a
+    key is chosen by the key's hash. Single operations are atomic. Sequences of
+    operations on a key, like checking for a session and then starting or
+    joining it, are made atomic by holding the key's lock (see function
+    locked). Operations on the same key may be called while holding it.
+    """
+
+    def __init__(self, stripes):
+        """
+        Parameters:
+        stripes (int): number of stripes
+        """
+        self._stripes = [({}, threading.RLock()) for _ in range(stripes)]
+
+    def _stripe(self, key):
+        """
+        Return the stripe of a key.
+
+        Parameters:
+        key (tuple): game name and token
+
+        Returns:
+        tuple(dict, RLock): sessions of the stripe and its lock
+        """
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def locked(self, key):
+        """
+        Return the lock of a key. While it is held, no other thread can add or
+        remove the key's session.
+
+        Parameters:
+        key (tuple): game name and token
+
+        Returns:
+        RLock: lock, to be used in a with statement
+        """
+        return self._stripe(key)[1]
+
+    def get(self, key):
+        """
+        Return the session of a key.
+
+        Parameters:
+        key (tuple): game name and token
+
+        Returns:
+        GameSession: session, None if there is none
+        """
+        sessions, lock = self._stripe(key)
+        with lock:
+            return sessions.get(key)
+
+    def put(self, key, session):
+        """
+        Add a session, replacing the key's previous session.
+
+        Parameters:
+        key (tuple): game name and token
+        session (GameSession): session
+        """
+        sessions, lock = self._stripe(key)
+        with lock:
+            sessions[key] = session
+
+    def remove(self, key, session):
+        """
+        Remove the session of a key, unless it has been replaced by another
+        session in the meantime.
+
+        Parameters:
+        key (tuple): game name and token
+        session (GameSession): session to be removed
+
+        Returns:
+        bool: True, if the session was removed
+        """
+        sessions, lock = self._stripe(key)
+        with lock:
+            if sessions.get(key) is not session:
+                return False
+            del sessions[key]
+            return True
+
+    def keys(self):
+        """
+        Return the keys of all sessions. Each stripe is copied while holding
+        its lock, sessions added or removed meanwhile may or may not be
+        included.
+
+        Returns:
+        list: keys (game name and token)
+        """
+        keys = []
+        for sessions, lock in self._stripes:
+            with lock:
+                keys.extend(sessions)
+        return keys
@@ -0,0 +1,408 @@
+"""
+Sharding.
+
+This module lets several worker processes share the work of the server, so that
+game logic is no longer limited to a single core. All workers listen on the
+same port (SO_REUSEPORT), and the operating system distributes incoming
+connections among them. Every game session is owned by exactly one worker,
+which is determined by the game name and token. A worker receiving a request for
+a session owned by another worker forwards the request to that worker and
+passes the response back to the client. Clients don't notice any of this.
+
+For forwarding, every worker listens on an additional port on the loopback
+interface. Forwarded requests are sent over persistent connections (protocol
+version 2, see protocol module) carrying IDs, so that a single connection
+between two workers carries any number of concurrent requests.
+
+This mode requires a system supporting fork and SO_REUSEPORT, like Linux.
+"""
+
+import concurrent.futures
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import zlib
+
+import config
+import protocol
+import utility
+
+def supported():
+    """
+    Check if the system supports several worker processes.
+
+    Returns:
+    bool: True, if supported
+    """
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+def start_workers(listeners):
+    """
+    Start a worker process for each set of listening sockets.
+
+    For every worker, a listening socket for forwarded requests is created on
+    the loopback interface. Then the worker processes are forked. In the parent
+    process, this function waits for all workers to exit. If the parent process
+    is terminated, it terminates the workers as well.
+
+    Parameters:
+    listeners (list): one list of listening sockets per worker, sockets at the same position share a port or are identical
+
+    Returns:
+    tuple(Shards, list, socket):
+        Shards: routing information of the worker, None in the parent process
+        list: public listening sockets of the worker
+        socket: listening socket for forwarded requests
+    """
+    internal = []
+    for _ in listeners:
+        sd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sd.bind(('127.0.0.1', 0))
+        sd.listen()
+        internal.append(sd)
+
+    addresses = [sd.getsockname() for sd in internal]
+
+    workers = set() # process IDs
+
+    for index in range(len(listeners)):
+        pid = os.fork()
+
+        if pid == 0: # worker process
+            for i, sockets in enumerate(listeners):
+                if i != index:
+                    for sd in sockets + [internal[i]]:
+                        if sd not in listeners[index]: # sockets can be shared by all workers
+                            sd.close()
+            return Shards(index, addresses), listeners[index], internal[index]
+
+        workers.add(pid)
+
+    # parent process:
+    for sockets in listeners:
+        for sd in sockets:
+            sd.close()
+    for sd in internal:
+        sd.close()
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+    if config.profiler_signal and hasattr(signal, config.profiler_signal): # see profiler module
+        number = getattr(signal, config.profiler_signal)
+        signal.signal(number, lambda *_: _signal_workers(workers, number))
+
+    try:
+        while workers:
+            pid, _ = os.wait()
+            workers.discard(pid)
+    finally:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    return None, None, None
+
+def _signal_workers(workers, number):
+    """
+    Pass a signal received by the parent process on to all worker processes.
+
+    Parameters:
+    workers (set): process IDs
+    number (int): signal
+    """
+    for pid in workers:
+        os.kill(pid, number)
+
+class Shards:
+    """
+    Class Shards.
+
+    This class decides which worker owns a game session, and it forwards
+    requests to the other workers.
+    """
+
+    def __init__(self, index, addresses):
+        """
+        Parameters:
+        index (int): index of this worker
+        addresses (list): addresses of all workers for forwarded requests
+        """
+        self.index = index
+        self._peers = [None if i == index else _Peer(address) for i, address in enumerate(addresses)]
+
+    def local(self, request):
+        """
+        Check if a request is to be handled by this worker. Requests that do not
+        specify a game session are handled locally, the framework will reply
+        with an error message.
+
+        Parameters:
+        request (dict): client request
+
+        Returns:
+        bool: True, if the request is handled by this worker
+        """
+        return self._owner(request) == self.index
+
+    def forward(self, request):
+        """
+        Forward a request to the worker owning the game session.
+
+        Parameters:
+        request (dict): client request
+
+        Returns:
+        concurrent.futures.Future: resolves to the response
+        """
+        return self._peers[self._owner(request)].forward(request)
+
+    def _owner(self, request):
+        """
+        Return the index of the worker owning the game session of a request.
+
+        Parameters:
+        request (dict): client request
+
+        Returns:
+        int: index
+        """
+        if not isinstance(request, dict):
+            return self.index
+
+        game = request.get('game')
+        token = request.get('token')
+        if type(game) != str or type(token) != str:
+            return self.index
+
+        key = json.dumps([game, token]).encode()
+        return zlib.crc32(key) % len(self._peers)
+
+class _Peer:
+    """
+    Class _Peer.
+
+    This class forwards requests to another worker over a persistent
+    connection. A separate thread receives the responses and resolves the
+    corresponding futures. The connection is established when the first request
+    is forwarded, and again after it was closed.
+
+    Connecting and sending are bounded by a timeout (see config module), so a
+    worker that does not respond cannot block the threads forwarding requests
+    to it for long. Connecting happens outside the lock guarding the pending
+    requests, so responses on an existing connection are not held up meanwhile.
+    """
+
+    def __init__(self, address):
+        """
+        Parameters:
+        address (tuple): IP and port of the worker's listening socket
+        """
+        self._address = address
+        self._sd = None
+        self._lock = threading.Lock() # guards connection, pending requests and IDs
+        self._connect_lock = threading.Lock() # only one thread connects at a time
+        self._send_lock = threading.Lock() # frames must not be interleaved
+        self._attempts = 0 # connection attempts
+        self._pending = {} # request ID -> (socket, future)
+        self._next_id = 0
+
+    def forward(self, request):
+        """
+        Forward a request.
+
+        Parameters:
+        request (dict): client request
+
+        Returns:
+        concurrent.futures.Future: resolves to the response
+        """
+        future = concurrent.futures.Future()
+
+        try:
+            sd = self._connection()
+        except OSError:
+            future.set_result(_unavailable())
+            return future
+
+        with self._lock:
+            if self._sd is not sd: # closed in the meantime
+                future.set_result(_unavailable())
+                return future
+
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = (sd, future)
+
+        try:
+            with self._send_lock:
+                sd.sendall(protocol.frame(json.dumps(dict(request, id=request_id)).encode()))
+        except OSError: # the future is resolved when disconnecting
+            with self._lock:
+                self._disconnect(sd)
+
+        return future
+
+    def _connection(self):
+        """
+        Return the connection to the worker, connecting first if necessary.
+
+        Returns:
+        socket: connected socket
+
+        Raises:
+        OSError: if the worker cannot be reached
+        """
+        with self._lock:
+            if self._sd: return self._sd
+            attempts = self._attempts
+
+        with self._connect_lock:
+            with self._lock:
+                if self._sd: return self._sd # connected by another thread meanwhile
+                if self._attempts != attempts: # another thread failed meanwhile
+                    raise ConnectionRefusedError
+                self._attempts += 1
+
+            sd = self._connect()
+
+            with self._lock:
+                self._sd = sd
+
+        threading.Thread(target=self._receive_responses, args=(sd,), daemon=True).start()
+        return sd
+
+    def _connect(self):
+        """
+        Connect to the worker and perform the protocol handshake.
+
+        Returns:
+        socket: connected socket
+
+        Raises:
+        OSError: if the worker cannot be reached or rejects the handshake
+        """
+        sd = socket.create_connection(self._address, config.forward_timeout)
+
+        try:
+            sd.sendall(json.dumps({'type':'protocol', 'version':protocol.VERSION}).encode() + protocol.TERMINATOR)
+            if sd.recv(1, socket.MSG_PEEK) != b'\0': # handshake rejected (see protocol module)
+                raise ConnectionRefusedError
+
+            response = json.loads(str(_receive_frame(sd), 'utf-8'))
+            if response['status'] != 'ok': raise ConnectionRefusedError
+
+            # responses are awaited without a timeout, but sending still times out:
+            sd.settimeout(None)
+            seconds = int(config.forward_timeout)
+            microseconds = int((config.forward_timeout - seconds) * 1e6)
+            sd.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack('ll', seconds, microseconds))
+        except:
+            sd.close()
+            raise
+
+        return sd
+
+    def _receive_responses(self, sd):
+        """
+        Receive responses and resolve the corresponding futures. This function
+        runs in a separate thread until the connection is closed.
+
+        Parameters:
+        sd (socket): connected socket
+        """
+        try:
+            while True:
+                response = json.loads(str(_receive_frame(sd), 'utf-8'))
+
+                with self._lock:
+                    _, future = self._pending.pop(response.pop('id', None), (None, None))
+
+                if future: _resolve(future, response)
+        except:
+            with self._lock:
+                self._disconnect(sd)
+
+    def _disconnect(self, sd):
+        """
+        Close a connection and resolve the futures of all requests still
+        waiting for a response on that connection. Must be called while holding
+        the lock.
+
+        Parameters:
+        sd (socket): connected socket
+        """
+        if self._sd is sd:
+            self._sd = None
+
+        failed = [request_id for request_id, (s, _) in self._pending.items() if s is sd]
+        for request_id in failed:
+            _, future = self._pending.pop(request_id)
+            _resolve(future, _unavailable())
+
+        try:
+            sd.shutdown(socket.SHUT_RDWR) # wakes up the thread receiving responses
+        except OSError:
+            pass
+        sd.close()
+
+def _receive_frame(sd):
+    """
+    Receive a frame.
+
+    Parameters:
+    sd (socket): connected socket
+
+    Returns:
+    bytearray: payload
+
+    Raises:
+    ConnectionResetError: if the connection was closed
+    """
+    size, = protocol.HEADER.unpack(_receive_exactly(sd, protocol.HEADER.size))
+    return _receive_exactly(sd, size)
+
+def _receive_exactly(sd, size):
+    """
+    Receive a given number of bytes.
+
+    Parameters:
+    sd (socket): connected socket
+    size (int): number of bytes
+
+    Returns:
+    bytearray: data
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+
+    while received < size:
+        chunk = sd.recv_into(view[received:])
+        if not chunk: raise ConnectionResetError
+        received += chunk
+
+    return data
+
+def _resolve(future, response):
+    """
+    Resolve a future, unless it was cancelled in the meantime. A future is
+    cancelled, if the client's connection was closed in asyncio mode.
+
+    Parameters:
+    future (concurrent.futures.Future): future
+    response (dict): response
+    """
+    if future.set_running_or_notify_cancel():
+        future.set_result(response)
+
+def _unavailable():
+    """
+    Return the error message sent to a client if a request could not be
+    forwarded.
+
+    Returns:
+    dict: error message
+    """
+    return utility.server_error('worker process not available')
@@ -0,0 +1,130 @@
+"""
+Timing.
+
+This module measures where the time of a single request goes. A request is
+split into phases, and the end of every phase is marked with a timestamp
+(perf_counter_ns). The time since the previous mark is added to the phase:
+
+    receive   receiving the request (single request connections only)
+    decode    decoding the request
+    queue     waiting for a thread of a request pool
+    lock      waiting for the lock of a game session
+    move      processing a move by the game instance
+    wait      waiting for the game state to change or for players to join
+    framework anything else done by the framework
+    encode    encoding the response
+    send      sending the response
+
+Requests taking longer than the threshold defined in the config module are
+logged with all of their phases. Waiting for other clients is a feature, not a
+delay, so it does not count towards the threshold. A client can also ask for
+the phases of its request by adding 'timing':True to the request. The phases
+are then returned in the response (in milliseconds), similar to the
+Server-Timing header of HTTP. Encoding and sending happen after the response
+has been created, so they are only logged.
+
+The server creates the timing of a request and passes it along with the
+request. The framework and the game sessions find the timing of the request
+they are processing in a context variable, so their functions need no
+additional parameter.
+"""
+
+import contextvars
+import time
+
+import config
+
+WAITING = ('wait',) # phases spent waiting for other clients
+
+_current = contextvars.ContextVar('timing', default=None)
+
+class RequestTiming:
+    """
+    Class RequestTiming.
+
+    This class holds the phases of a single request. Marks are always set by
+    the thread or coroutine currently processing the request, so no lock is
+    needed.
+    """
+
+    def __init__(self):
+        self._last = time.perf_counter_ns()
+        self._phases = {} # phase -> nanoseconds
+
+    def mark(self, phase):
+        """
+        Mark the end of a phase. The time since the previous mark is added to
+        the phase.
+
+        Parameters:
+        phase (str): phase
+        """
+        now = time.perf_counter_ns()
+        self._phases[phase] = self._phases.get(phase, 0) + now - self._last
+        self._last = now
+
+    def phases(self):
+        """
+        Return the time spent in every phase.
+
+        Returns:
+        dict: phase -> milliseconds
+        """
+        return {phase:round(ns / 1e6, 3) for phase, ns in self._phases.items()}
+
+    def active(self):
+        """
+        Return the time spent processing the request, excluding waiting for
+        other clients.
+
+        Returns:
+        float: milliseconds
+        """
+        return sum(ns for phase, ns in self._phases.items() if phase not in WAITING) / 1e6
+
+    def activate(self):
+        """
+        Make this timing the timing of the request processed by the current
+        thread or coroutine (see function mark).
+
+        Returns:
+        Token: token for function deactivate
+        """
+        return _current.set(self)
+
+    def deactivate(self, token):
+        """
+        Restore the timing active before function activate was called.
+
+        Parameters:
+        token (Token): token returned by function activate
+        """
+        _current.reset(token)
+
+    def report(self, request, log):
+        """
+        Log the phases of a request, if it took longer than the threshold
+        defined in the config module.
+
+        Parameters:
+        request: client request
+        log (ServerLogger): logger
+        """
+        threshold = config.slow_request_threshold
+        if threshold is None or self.active() <= threshold:
+            return
+
+        request_type = request.get('type') if isinstance(request, dict) else None
+        phases = ', '.join(f'{phase} {ms}' for phase, ms in self.phases().items())
+        log.warning('slow request (%s, %s ms): %s', request_type, round(self.active(), 3), phases)
+
+def mark(phase):
+    """
+    Mark the end of a phase of the request processed by the current thread or
+    coroutine, if any.
+
+    Parameters:
+    phase (str): phase
+    """
+    timing = _current.get()
+    if timing: timing.mark(phase)
@@ -2,9 +2,20 @@
 Utility.
 
 This module provides various utility functions and classes for logging and error
-handling.
+handling. Log messages are written by a background thread, so that logging does
+not slow down the handling of requests.
 """
 
+import atexit
+import json
+import os
+import queue
+import random
+import reprlib
+import sys
+import threading
+import time
+
 from datetime import datetime
 
 import config
@@ -49,12 +60,168 @@ def game_error(message):
     """
     return _generic_error('game', message, 'illegalmove')
 
+LEVELS = {'debug':10, 'info':20, 'warning':30, 'error':40}
+
+class _LogWriter:
+    """
+    Writing log messages in a background thread.
+
+    Loggers only decide whether a message is written and format it. The
+    message is then put into a bounded queue, and a background thread adds the
+    timestamp and writes it to stdout, so that request handling never waits
+    for the output. If the queue is full, messages are dropped and the number
+    of dropped messages is logged later. The thread is started with the first
+    message of each process, since threads do not survive forking worker
+    processes (see sharding module).
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._dropped = 0
+        self._second = None # timestamps are formatted once per second
+        self._timestamp = None
+
+    def write(self, level, category, client, message):
+        """
+        Queue a log message.
+
+        Parameters:
+        level (str): log level
+        category (str): category of the message, like 'request'
+        client (str): client IP and port, None if the message is not about a client
+        message (str): message
+        """
+        if self._pid != os.getpid():
+            self._start()
+
+        try:
+            self._queue.put_nowait((time.time(), level, category, client, message))
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    def _start(self):
+        """
+        Start the background thread of this process.
+        """
+        with self._lock:
+            if self._pid == os.getpid(): return
+
+            self._queue = queue.Queue(config.log_queue_size)
+            self._dropped = 0
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        """
+        Write queued messages to stdout, as many at a time as are available.
+        """
+        while True:
+            records = [self._queue.get()]
+            while len(records) < 1000:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            with self._lock:
+                dropped, self._dropped = self._dropped, 0
+            if dropped:
+                records.append((time.time(), 'warning', 'logging', None, f'{dropped} log messages dropped'))
+
+            sys.stdout.write(''.join(self._format(*record) for record in records))
+            sys.stdout.flush()
+
+    def _format(self, timestamp, level, category, client, message):
+        """
+        Format a log message as a line of text or as a JSON object.
+
+        Returns:
+        str: line
+        """
+        second = int(timestamp)
+        if second != self._second:
+            self._second = second
+            self._timestamp = datetime.fromtimestamp(second).strftime('%Y-%m-%d %X')
+
+        if config.log_format == 'json':
+            record = {'time':self._timestamp, 'level':level, 'category':category, 'message':message}
+            if client: record['client'] = client
+            return json.dumps(record) + '\n'
+
+        if client:
+            return f'[{self._timestamp} {client}] {message}\n'
+
+        return message + '\n'
+
+    def flush(self, timeout=1):
+        """
+        Wait until all queued messages have been written, used at exit.
+
+        Parameters:
+        timeout (float): seconds
+        """
+        deadline = time.monotonic() + timeout
+        while self._queue and not self._queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+_writer = _LogWriter()
+atexit.register(_writer.flush)
+
+_repr = reprlib.Repr() # limits the size of logged requests and responses before they are formatted
+_repr.maxlevel = 6
+_repr.maxdict = _repr.maxlist = _repr.maxtuple = _repr.maxset = 100
+_repr.maxstring = _repr.maxother = _repr.maxlong = config.log_payload_max
+_repr.repr_Shared = _repr.repr_dict # game states shared among clients (see codec.Shared)
+
+def _enabled(level, category):
+    """
+    Check if a message is to be logged, based on the log level and on the
+    sampling rate of its category (see config module).
+
+    Parameters:
+    level (str): log level
+    category (str): category
+
+    Returns:
+    bool: True, if the message is to be logged
+    """
+    if LEVELS[level] < LEVELS[config.log_level]:
+        return False
+
+    rate = config.log_sampling.get(category, 1)
+    return rate >= 1 or random.random() < rate
+
+def _payload(data):
+    """
+    Convert a request, a response or any other data into text for logging. The
+    text is truncated to the size defined in the config module.
+
+    Parameters:
+    data: data
+
+    Returns:
+    str: text
+    """
+    text = data if isinstance(data, str) else _repr.repr(data)
+
+    if len(text) > config.log_payload_max:
+        text = text[:config.log_payload_max] + f'... ({len(text)} characters)'
+
+    return text
+
 class ServerLogger:
     """
     Logging server information.
 
     The output contains a timestamp, the client's IP and port, and the log
     message itself. The log level can be set in the config file.
+
+    Messages are formatted lazily: arguments are only converted and inserted
+    into the message (printf-style), if the message is actually logged. Large
+    arguments are truncated.
     """
     def __init__(self, ip, port):
         """
@@ -65,45 +232,58 @@ class ServerLogger:
         self._ip = ip
         self._port = port
 
-    def info(self, message):
+    def info(self, message, *args):
         """
         Log server information. See function _log for details.
         """
-        if config.log_server_info:
-            self._log(message)
+        if config.log_server_info and _enabled('debug', 'server'):
+            self._log('debug', message, args)
+
+    def warning(self, message, *args):
+        """
+        Log server warnings, like slow requests. See function _log for details.
+        """
+        if _enabled('warning', 'server'):
+            self._log('warning', message, args)
 
-    def error(self, message):
+    def error(self, message, *args):
         """
         Log server errors. See function _log for details.
         """
-        if config.log_server_errors:
-            self._log(message)
+        if config.log_server_errors and _enabled('error', 'server'):
+            self._log('error', message, args)
 
-    def _log(self, message):
+    def _log(self, level, message, args):
         """
-        Print log message.
+        Format a log message and pass it to the background thread.
 
         Parameters:
-        message (str): message
+        level (str): log level
+        message (str): message, may contain printf-style placeholders
+        args (tuple): arguments for the placeholders
         """
-        time = datetime.strftime(datetime.now(), "%Y-%m-%d %X")
-        print(f'[{time} {self._ip}:{self._port}] {message}')
+        if args:
+            message = message % tuple(_payload(arg) for arg in args)
+
+        _writer.write(level, 'server', f'{self._ip}:{self._port}', message)
 
 class FrameworkLogger:
     """
     Logging framework information.
 
-    The log level can be set in the config file.
+    The log level can be set in the config file. Requests and responses are
+    only formatted, if they are actually logged, and they are truncated.
     """
-    def info(self, message):
+    def info(self, message, *args):
         """
         Logging actions initiated by the framework.
 
         Parameters:
-        message (str): message
+        message (str): message, may contain printf-style placeholders
+        args: arguments for the placeholders
         """
-        if config.log_framework_actions:
-            self._log(message)
+        if config.log_framework_actions and _enabled('info', 'actions'):
+            self._log('info', 'actions', message % args if args else message)
 
     def request(self, request):
         """
@@ -112,8 +292,8 @@ class FrameworkLogger:
         Parameters:
         request (dict): client request
         """
-        if config.log_framework_request:
-            self._log(f'Request:  {request}')
+        if config.log_framework_request and _enabled('info', 'request'):
+            self._log('info', 'request', f'Request:  {_payload(request)}')
 
     def response(self, response):
         """
@@ -122,11 +302,11 @@ class FrameworkLogger:
         Parameters:
         response (dict): server response
         """
-        if config.log_framework_response:
-            self._log(f'Response: {response}')
+        if config.log_framework_response and _enabled('info', 'response'):
+            self._log('info', 'response', f'Response: {_payload(response)}')
 
-    def _log(self, message):
-        print(message)
+    def _log(self, level, category, message):
+        _writer.write(level, category, None, message)
 
 def check_dict(d, expected):
     """
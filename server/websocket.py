@@ -0,0 +1,184 @@
+"""
+WebSocket.
+
+This module implements the parts of the WebSocket protocol (RFC 6455) needed to
+serve browsers and game engines, which cannot open raw TCP connections. A
+WebSocket client connects to a port of its own (see config module) and sends an
+HTTP upgrade request. Once the server has accepted it, both sides exchange
+messages over the same connection.
+
+Every message carries a single JSON encoded request, exactly like a frame of a
+persistent connection (protocol version 2, see protocol module), and every
+response is sent back as a text message. Requests carrying an ID are processed
+concurrently, and subscriptions push new states to the client as they change.
+Messages sent by the client can be text or binary and can be split into
+several fragments. Pings are answered, extensions are not supported.
+
+Browsers send the origin of the web page opening a connection. Only origins
+listed in the config module are accepted, so that other web pages cannot use
+the server on behalf of their visitors. Clients sending no origin, like game
+engines, are not affected.
+"""
+
+import base64
+import hashlib
+import struct
+
+import config
+
+HEADER_TERMINATOR = b'\r\n\r\n' # terminates the HTTP upgrade request
+MAX_HEADER_SIZE = 14 # bytes, header of a frame including the mask
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11' # defined by RFC 6455
+
+# opcodes:
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+class ProtocolError(Exception): pass
+
+def handshake(request):
+    """
+    Check an HTTP upgrade request and return the response.
+
+    Parameters:
+    request (bytes-like object): HTTP request without the terminating empty line
+
+    Returns:
+    tuple(bytes, bool):
+        bytes: HTTP response
+        bool: True, if the connection has been upgraded
+    """
+    try:
+        lines = str(request, 'latin-1').split('\r\n')
+        method, _, version = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    except ValueError:
+        return response(400), False
+
+    if (method != 'GET' or not version.startswith('HTTP/1.')
+        or headers.get('upgrade', '').lower() != 'websocket'
+        or 'upgrade' not in [token.strip().lower() for token in headers.get('connection', '').split(',')]
+        or 'sec-websocket-key' not in headers):
+        return response(400), False
+
+    if headers.get('sec-websocket-version') != '13':
+        return response(426, 'Sec-WebSocket-Version: 13'), False
+
+    if 'origin' in headers and headers['origin'] not in config.websocket_origins:
+        return response(403), False
+
+    digest = hashlib.sha1((headers['sec-websocket-key'] + GUID).encode()).digest()
+    accept = base64.b64encode(digest).decode()
+
+    return response(101, 'Upgrade: websocket', 'Connection: Upgrade', f'Sec-WebSocket-Accept: {accept}'), True
+
+def response(status, *headers):
+    """
+    Return an HTTP response without a body.
+
+    Parameters:
+    status (int): status code (101, 400, 403, 426 or 503)
+    headers (str): additional header lines
+
+    Returns:
+    bytes: HTTP response
+    """
+    reasons = {
+        101:'Switching Protocols',
+        400:'Bad Request',
+        403:'Forbidden',
+        426:'Upgrade Required',
+        503:'Service Unavailable'}
+
+    lines = [f'HTTP/1.1 {status} {reasons[status]}', *headers]
+    if status != 101:
+        lines += ['Content-Length: 0', 'Connection: close']
+
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+def parse_header(data):
+    """
+    Parse the header of a frame sent by a client.
+
+    Parameters:
+    data (memoryview): received data starting with the frame
+
+    Returns:
+    tuple(bool, int, int, int, bytes): None, if the header is incomplete
+        bool: True, if this is the final fragment of a message
+        int: opcode
+        int: header size in bytes
+        int: payload size in bytes
+        bytes: mask
+
+    Raises:
+    ProtocolError: if the frame is not masked
+    """
+    if len(data) < 2:
+        return None
+
+    first, second = data[0], data[1]
+    size = second & 0x7F
+    offset = 2
+
+    if size == 126:
+        if len(data) < 4: return None
+        size, = struct.unpack_from('!H', data, 2)
+        offset = 4
+    elif size == 127:
+        if len(data) < 10: return None
+        size, = struct.unpack_from('!Q', data, 2)
+        offset = 10
+
+    if not second & 0x80:
+        raise ProtocolError('frames sent by clients must be masked')
+
+    if len(data) < offset + 4:
+        return None
+
+    return bool(first & 0x80), first & 0x0F, offset + 4, size, bytes(data[offset:offset + 4])
+
+def unmask(payload, mask):
+    """
+    Unmask the payload of a frame sent by a client. The payload is processed as
+    a single large integer, which is much faster than processing every byte.
+
+    Parameters:
+    payload (bytes-like object): masked payload
+    mask (bytes): mask (4 bytes)
+
+    Returns:
+    bytes: payload
+    """
+    size = len(payload)
+    key = (mask * (size // 4 + 1))[:size]
+    return (int.from_bytes(payload, 'little') ^ int.from_bytes(key, 'little')).to_bytes(size, 'little')
+
+def frame(payload, opcode=TEXT):
+    """
+    Create an unfragmented frame sent by the server (never masked).
+
+    Parameters:
+    payload (bytes): payload
+    opcode (int): opcode (optional, default: text message)
+
+    Returns:
+    bytes: frame
+    """
+    size = len(payload)
+
+    if size < 126:
+        header = struct.pack('!BB', 0x80 | opcode, size)
+    elif size < 0x10000:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, size)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, size)
+
+    return header + payload
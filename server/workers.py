@@ -0,0 +1,114 @@
+"""
+Workers.
+
+This module provides a pool of worker threads with admission control. The
+number of jobs a pool accepts is limited, so that the server rejects requests
+right away when it is saturated, instead of starting an unlimited number of
+threads and stalling all game sessions.
+"""
+
+import queue
+import threading
+import traceback
+
+import utility
+
+class WorkerPool:
+    """
+    Class WorkerPool.
+
+    A pool runs jobs in a fixed maximum number of threads. Jobs that find all
+    workers busy are queued. The number of queued jobs is limited as well. A
+    job that does not fit into the queue is not accepted at all. Threads are
+    only started when they are needed, and they keep running afterwards.
+
+    In asyncio mode, no threads are used. The pool then only serves as a limit
+    for the number of coroutines running at the same time (see functions admit
+    and release). This limit is the sum of workers and queue size.
+    """
+
+    def __init__(self, workers, queue_size, name):
+        """
+        Parameters:
+        workers (int): maximum number of threads
+        queue_size (int): maximum number of jobs waiting for a thread
+        name (str): pool name, used in log messages
+        """
+        self._log = utility.ServerLogger('pool', name)
+        self._workers = workers
+        self._capacity = workers + queue_size
+        self._admitted = 0 # jobs running or waiting
+        self._threads = 0 # threads started
+        self._lock = threading.Lock()
+        self._jobs = queue.Queue() # bounded by admission control
+
+    def submit(self, function, *args):
+        """
+        Run a function in a worker thread, if the pool accepts the job.
+
+        Parameters:
+        function (function): job, must handle its own errors
+        args: arguments passed to the function
+
+        Returns:
+        bool: True, if the job was accepted, False if the pool is saturated
+        """
+        with self._lock:
+            if self._admitted == self._capacity:
+                return False
+
+            self._admitted += 1
+
+            # start another thread, if there are more jobs than threads:
+            start = self._admitted > self._threads and self._threads < self._workers
+            if start: self._threads += 1
+
+        if start:
+            threading.Thread(target=self._work, daemon=True).start()
+
+        self._jobs.put((function, args))
+        return True
+
+    def admit(self):
+        """
+        Register a job that is run by the caller itself.
+
+        Returns:
+        bool: True, if the job was accepted, False if the pool is saturated
+        """
+        with self._lock:
+            if self._admitted == self._capacity:
+                return False
+
+            self._admitted += 1
+            return True
+
+    def release(self):
+        """
+        Unregister a finished job.
+        """
+        with self._lock:
+            self._admitted -= 1
+
+    def admitted(self):
+        """
+        Return the number of jobs running or waiting.
+
+        Returns:
+        int: number of jobs
+        """
+        return self._admitted
+
+    def _work(self):
+        """
+        Run queued jobs. This function runs in a worker thread.
+        """
+        while True:
+            function, args = self._jobs.get()
+
+            try:
+                function(*args)
+            except:
+                self._log.error('unexpected exception in a worker thread:\n' + traceback.format_exc())
+            finally:
+                self.release()